@@ -84,10 +84,19 @@ bulk_edit_dates.short_description = "Edit start and end dates of selected " \
                                     "snippets"
 
 
+def profile_selected_rules(modeladmin, request, queryset):
+    selected = request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
+    url = '%s?ids=%s' % (reverse('admin_rule_profile'), ','.join(selected))
+    return HttpResponseRedirect(url)
+
+profile_selected_rules.short_description = "Time selected rules against " \
+                                           "sample client requests"
+
+
 class ClientMatchRuleAdmin(admin.ModelAdmin):
     change_list_template = 'smuggler/change_list.html'
 
-    actions = [dump_selected]
+    actions = [dump_selected, profile_selected_rules]
     dump_name = 'clientmatchrules'
 
     list_per_page = 250
@@ -0,0 +1,260 @@
+"""
+In-process caching in front of the shared Django cache
+"""
+import cPickle as pickle
+import logging
+import threading
+from time import sleep, time
+
+from django.db import close_connection
+
+from homesnippets.lru import LRUCache
+
+
+log = logging.getLogger('homesnippets.caches')
+
+LOCK_PREFIX = 'homesnippets_Lock_'
+STATS_PREFIX = 'homesnippets_Stats_'
+FLUSH_PREFIX = 'homesnippets_Flushed_'
+
+
+class LocalCache(object):
+    """Bounded per-process cache, for values also kept in the shared cache.
+
+    Entries are dropped least recently used first once max_size is reached,
+    and expire ttl seconds after being stored. Each entry is stored with the
+    shared version stamp current when its value was computed, and is only
+    served to lookups made under that same stamp, so a write anywhere that
+    moves the stamp on makes every older entry stale without having to
+    re-fetch or delete anything.
+    """
+
+    def __init__(self, max_size, ttl, clock=time):
+        self.entries = LRUCache(max_size)
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+
+    def get(self, key, stamp, default=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, entry_stamp, value = entry
+            if entry_stamp == stamp and expires > self.clock():
+                self.hits += 1
+                return value
+            self.entries.delete(key)
+            self.expirations += 1
+        self.misses += 1
+        return default
+
+    def set(self, key, value, stamp):
+        self.entries.set(key, (self.clock() + self.ttl, stamp, value))
+
+    def delete(self, key):
+        self.entries.delete(key)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """Counts of hits, misses, evictions and expirations (including
+        entries dropped for a stale stamp) since startup, and current size."""
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.entries.evictions,
+                    expirations=self.expirations, size=len(self.entries),
+                    max_size=self.entries.max_size)
+
+
+def single_flight(cache, key, compute, check, previous=None, lease=10,
+                  wait=0.05, retries=20, sleep=sleep):
+    """Recompute the value cached under key with compute(), one caller at a
+    time across all processes sharing cache.
+
+    Whoever takes the lease on key, by adding a lock key to the cache,
+    recomputes. Anyone else gets previous, the out of date value they found,
+    if there is one, or else polls check() for the new value every wait
+    seconds. After retries polls they give up and recompute anyway. The
+    lease lapses after lease seconds, in case its holder dies.
+
+    If the add failed without anyone holding the lease, eg. with the cache
+    server for key down, there is nothing to poll for, so they recompute
+    straight away instead.
+    """
+    lock_key = '%s%s' % (LOCK_PREFIX, key)
+    if cache.add(lock_key, 1, lease):
+        try:
+            return compute()
+        finally:
+            cache.delete(lock_key)
+
+    if previous is not None:
+        return previous
+    if cache.get(lock_key) is None:
+        return compute()
+    for attempt in range(retries):
+        sleep(wait)
+        value = check()
+        if value is not None:
+            return value
+    return compute()
+
+
+def refresh_later(pool, cache, key, compute, lease=10,
+                  close=close_connection):
+    """Have a thread from pool recompute the value cached under key with
+    compute(), unless someone already holds the lease on key, as for
+    single_flight(). Returns whether a refresh was started.
+
+    The thread's database connections are closed with close() after each
+    refresh, as at the end of a request. Otherwise they would stay open in
+    a transaction, and keep reading from its snapshot on databases with
+    repeatable reads."""
+    lock_key = '%s%s' % (LOCK_PREFIX, key)
+    if not cache.add(lock_key, 1, lease):
+        return False
+
+    def refresh():
+        try:
+            compute()
+        except Exception:
+            log.exception('Failed to refresh %s' % key)
+        finally:
+            cache.delete(lock_key)
+            close()
+
+    pool.apply_async(refresh)
+    return True
+
+
+class CacheStats(object):
+    """Hit, miss, invalidation and write counts for families of shared cache
+    entries, with the sizes of a sample of the values written.
+
+    Counts are kept in-process and added into totals in the shared cache at
+    most every interval seconds, so every process contributes to the same
+    totals without a cache write per count.
+
+    A whole family can be flushed, by storing the time of the flush: entries
+    cached before then are treated as invalidated. Flush times
+    are read back along with each sync, so a flush reaches every process
+    within interval seconds.
+
+    Measuring a value means pickling it again, so only one in every sample
+    values written is measured: sized counts those, and bytes their total
+    size.
+    """
+
+    EVENTS = ('hits', 'misses', 'invalidations', 'sets', 'sized', 'bytes')
+
+    def __init__(self, families, interval=10, timeout=None, clock=time,
+                 sample=1):
+        self.families = families
+        self.sample = sample
+        self.written = 0
+        self.interval = interval
+        self.timeout = timeout
+        self.clock = clock
+        self.counts = {}
+        self.flushed = {}
+        self.synced = None
+        self.lock = threading.Lock()
+
+    def count(self, cache, family, **events):
+        """Add to the counts of events for family, eg. hits=1."""
+        self.lock.acquire()
+        try:
+            for event, n in events.items():
+                if n:
+                    key = (family, event)
+                    self.counts[key] = self.counts.get(key, 0) + n
+        finally:
+            self.lock.release()
+        self.maybe_sync(cache)
+
+    def count_sets(self, cache, family, values):
+        """Count values written to family, measuring the pickled size of one
+        in every sample of them."""
+        self.lock.acquire()
+        try:
+            skip = -self.written % self.sample
+            self.written += len(values)
+        finally:
+            self.lock.release()
+        sized = values[skip::self.sample]
+        size = sum(len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                   for value in sized)
+        self.count(cache, family, sets=len(values), sized=len(sized),
+                   bytes=size)
+
+    def is_flushed(self, cache, family, cached_at):
+        """Was an entry cached at cached_at flushed along with its family?"""
+        self.maybe_sync(cache)
+        flushed = self.flushed.get(family)
+        return flushed is not None and flushed > cached_at
+
+    def flush(self, cache, family, now):
+        """Invalidate every entry in family cached before now."""
+        cache.set('%s%s' % (FLUSH_PREFIX, family), now, self.timeout)
+        self.flushed[family] = now
+
+    def maybe_sync(self, cache):
+        if self.synced is None or self.clock() >= self.synced + self.interval:
+            self.sync(cache)
+
+    def sync(self, cache):
+        """Add the counts made since the last sync into the shared totals,
+        and pick up flush times."""
+        self.lock.acquire()
+        try:
+            counts, self.counts = self.counts, {}
+            self.synced = self.clock()
+        finally:
+            self.lock.release()
+
+        # Stats must never fail a request: with the server for a stats key
+        # down, incr() raises and add() fails, so its counts are dropped.
+        cache.add('%sSince' % STATS_PREFIX, self.clock(), self.timeout)
+        for (family, event), n in counts.items():
+            key = '%s%s_%s' % (STATS_PREFIX, family, event)
+            try:
+                cache.incr(key, n)
+            except ValueError:
+                if not cache.add(key, n, self.timeout):
+                    try:
+                        cache.incr(key, n)
+                    except ValueError:
+                        pass
+
+        keys = [ '%s%s' % (FLUSH_PREFIX, family) for family in self.families ]
+        found = cache.get_many(keys)
+        self.flushed = dict((family, found[key]) for family, key
+                            in zip(self.families, keys) if key in found)
+
+    def totals(self, cache):
+        """Shared totals of each event for each family, as a dict of dicts,
+        and the time counting started at, or None."""
+        self.sync(cache)
+        keys = dict(('%s%s_%s' % (STATS_PREFIX, family, event),
+                     (family, event))
+                    for family in self.families for event in self.EVENTS)
+        since_key = '%sSince' % STATS_PREFIX
+        found = cache.get_many(keys.keys() + [since_key])
+        totals = dict((family, dict.fromkeys(self.EVENTS, 0))
+                      for family in self.families)
+        for key, (family, event) in keys.items():
+            totals[family][event] = found.get(key, 0)
+        return totals, found.get(since_key)
+
+    def reset(self, cache):
+        """Start counting over, across all processes."""
+        self.lock.acquire()
+        try:
+            self.counts = {}
+        finally:
+            self.lock.release()
+        cache.delete_many([ '%s%s_%s' % (STATS_PREFIX, family, event)
+                            for family in self.families
+                            for event in self.EVENTS ] +
+                          [ '%sSince' % STATS_PREFIX ])
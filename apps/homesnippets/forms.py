@@ -1,4 +1,10 @@
-from django.forms import Form, DateTimeField, DateInput, CharField, widgets
+from urlparse import urlparse
+
+from django.forms import (Form, DateTimeField, DateInput, CharField,
+                          ChoiceField, IntegerField, ValidationError, widgets)
+
+from homesnippets.models import CACHE_FAMILIES
+from homesnippets.profiling import parse_client
 
 
 class BulkDateForm(Form):
@@ -11,3 +17,63 @@ class BulkDateForm(Form):
                              widget=DateInput(attrs={'class': 'datetime'}),
                              required=False)
     ids = CharField(required=True, widget=widgets.HiddenInput())
+
+
+class RuleProfileForm(Form):
+    """Form for timing client match rules against sample client requests"""
+
+    clients = CharField(label='Sample client requests',
+                        help_text='One snippet URL or path per line',
+                        widget=widgets.Textarea(attrs={'rows': 15,
+                                                       'cols': 100}))
+    repeat = IntegerField(label='Repeat', initial=10, min_value=1,
+                          max_value=100)
+    ids = CharField(required=False, widget=widgets.HiddenInput())
+
+    def clean_clients(self):
+        """Client args for each line of sample requests, skipping blank
+        lines and comments."""
+        clients, bad = [], []
+        lines = self.cleaned_data['clients'].splitlines()
+        for number, line in enumerate(lines):
+            if not line.strip() or line.strip().startswith('#'):
+                continue
+            args = parse_client(line)
+            if args is None:
+                bad.append(str(number + 1))
+            else:
+                clients.append(args)
+        if bad:
+            raise ValidationError('No client found on line %s' %
+                                  ', '.join(bad[:10]))
+        if not clients:
+            raise ValidationError('No clients found')
+        return clients
+
+
+class CacheFamilyForm(Form):
+    """Form for flushing a whole family of cached entries"""
+
+    family = ChoiceField(choices=[ (family, family)
+                                   for family, prefix in CACHE_FAMILIES ],
+                         widget=widgets.HiddenInput())
+
+
+class CacheClientForm(Form):
+    """Form for exploring or flushing the entries cached for a client"""
+
+    client = CharField(label='Client',
+                       help_text='Snippet URL or path, including preview/ '
+                                 'for preview snippets',
+                       widget=widgets.TextInput(attrs={'size': 100}))
+
+    def clean_client(self):
+        """Client args for the snippet URL given, as view_snippets gets
+        them."""
+        url = self.cleaned_data['client']
+        args = parse_client(url)
+        if args is None:
+            raise ValidationError('Not a snippet URL or path')
+        segments = [ s for s in urlparse(url.strip()).path.split('/') if s ]
+        args['preview'] = segments[:1] == ['preview']
+        return args
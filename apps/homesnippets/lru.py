@@ -0,0 +1,122 @@
+"""
+Bounded least-recently-used mapping
+"""
+import threading
+
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """Mapping that holds at most max_size items, dropping the least recently
+    used item to make room for a new one.
+
+    Items are kept in a circular doubly linked list of [prev, next, key,
+    value] links, most recently used at the front, so that lookups, updates
+    and evictions are all constant time. Even lookups relink the list, so
+    every operation holds a lock, for caches shared by request threads.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.links = {}
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None]
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._push(link)
+            return link[VALUE]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[VALUE] = value
+            else:
+                if len(self.links) >= self.max_size:
+                    oldest = self.root[PREV]
+                    self._unlink(oldest)
+                    del self.links[oldest[KEY]]
+                    self.evictions += 1
+                link = [None, None, key, value]
+                self.links[key] = link
+            self._push(link)
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            link = self.links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self.lock.release()
+
+    def replace(self, key, value):
+        """Change the value of an existing key without counting it as a
+        use. Keys dropped meanwhile are left out."""
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is not None:
+                link[VALUE] = value
+        finally:
+            self.lock.release()
+
+    def items(self):
+        """(key, value) pairs from most to least recently used."""
+        self.lock.acquire()
+        try:
+            items, link = [], self.root[NEXT]
+            while link is not self.root:
+                items.append((link[KEY], link[VALUE]))
+                link = link[NEXT]
+            return items
+        finally:
+            self.lock.release()
+
+    def copy(self):
+        """Independent copy, with the same items in the same order of use."""
+        lru = LRUCache(self.max_size)
+        for key, value in reversed(self.items()):
+            lru.set(key, value)
+        return lru
+
+    def keys(self):
+        """Keys from most to least recently used."""
+        return [ key for key, value in self.items() ]
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _push(self, link):
+        first = self.root[NEXT]
+        link[PREV], link[NEXT] = self.root, first
+        first[PREV] = link
+        self.root[NEXT] = link
@@ -0,0 +1,65 @@
+"""
+Times client match rules against a sample of client requests
+
+Sample files hold one client per line, as snippet URLs or paths (eg. from a
+web server access log) or JSON objects of match field values. Rules are
+listed most costly first, along with regexes prone to catastrophic
+backtracking.
+"""
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from homesnippets.matching import compile_rule_safely, rule_row
+from homesnippets.models import ClientMatchRule
+from homesnippets.profiling import load_clients, profile_rules
+
+
+class Command(BaseCommand):
+
+    args = 'sample_file [sample_file ...]'
+    help = 'Time client match rules against a sample of client requests'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=10,
+                    help='Times to evaluate each rule against each client'),
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='Only list this many of the most costly rules'),
+        make_option('--sample-size', type='int', dest='sample_size',
+                    default=10000,
+                    help='Maximum number of clients to read from samples'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Usage: manage.py profilerules %s' % self.args)
+
+        clients = []
+        for filename in args:
+            if filename == '-':
+                lines = sys.stdin
+            else:
+                lines = open(filename, 'r')
+            clients.extend(load_clients(lines, options['sample_size']))
+        if not clients:
+            raise CommandError('No client requests found in samples')
+
+        rules = dict((rule.id, rule) for rule in ClientMatchRule.objects.all())
+        matchers = [compile_rule_safely(rule_row(rule))
+                    for rule in rules.values()]
+        profiles = profile_rules(matchers, clients, options['repeat'])
+
+        total = sum(profile.seconds for profile in profiles)
+        print "%d rules, %d clients, %.1fus per client for all rules" % (
+            len(profiles), len(clients),
+            1e6 * total / (len(clients) * options['repeat']))
+
+        for profile in profiles[:options['limit']]:
+            print "%8.2fus %6d matches  rule %s: %s" % (
+                profile.micros, profile.matches, profile.id,
+                rules[profile.id])
+            if profile.error:
+                print "           INVALID: %s" % profile.error
+            for hazard in profile.hazards:
+                print "           SLOW: %s" % hazard
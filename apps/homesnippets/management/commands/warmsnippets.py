@@ -0,0 +1,92 @@
+"""
+Warms the cache for the clients seen most often in request logs
+
+Logs hold one client per line, as snippet URLs or paths (eg. from a web
+server access log) or JSON objects of match field values. Rule matches,
+snippet lookups and, with SNIPPET_RESPONSE_CACHE, rendered responses are
+cached for the most frequent distinct clients, in batches spread across a
+pool of processes. Meant to be run before putting a node into rotation.
+
+Only public requests with every match field get warmed, since entries for
+anything else would be cached under keys no real request looks up. Other
+clients are counted as skipped.
+"""
+import sys
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from homesnippets.models import Snippet
+from homesnippets.profiling import parse_client, top_clients
+from homesnippets.views import render_snippets
+
+
+def render_public(snippets, generated):
+    return render_snippets(snippets, False, generated)
+
+
+def warm_batch(args_list):
+    """Cache snippets for a batch of clients, returning the number of
+    responses cached."""
+    return Snippet.objects.warm_rendered_snippets(args_list, render_public)
+
+
+class Command(BaseCommand):
+
+    args = 'log_file [log_file ...]'
+    help = 'Warm the snippet cache for the clients seen most in request logs'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--top', type='int', dest='top', default=10000,
+                    help='Number of most frequent clients to warm'),
+        make_option('--processes', type='int', dest='processes',
+                    default=cpu_count(),
+                    help='Worker processes to spread batches across, or 0 '
+                         'to warm in this process'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Clients to warm with each batch of cache calls'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Usage: manage.py warmsnippets %s' % self.args)
+
+        lines = []
+        for filename in args:
+            if filename == '-':
+                lines.extend(sys.stdin)
+            else:
+                lines.extend(open(filename, 'r'))
+        clients = top_clients(lines, options['top'], complete=True)
+        skipped = sum(1 for line in lines
+                      if parse_client(line, complete=True) is None and
+                      parse_client(line) is not None)
+        if not clients:
+            raise CommandError('No complete public client requests found in '
+                               'logs, %d skipped' % skipped)
+
+        # Requests from the public endpoint, as view_snippets sees them.
+        args_list = [ dict(client, preview=False) for count, client in clients ]
+        size = options['batch_size']
+        batches = [ args_list[start:start + size]
+                    for start in range(0, len(args_list), size) ]
+
+        if options['processes'] > 0:
+            # Workers open their own database connections.
+            connection.close()
+            pool = Pool(options['processes'])
+            try:
+                counts = pool.map(warm_batch, batches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            counts = map(warm_batch, batches)
+
+        print "Warmed %d clients, seen in %d of %d log lines, %d responses" % (
+            len(clients), sum(count for count, client in clients),
+            len(lines), sum(counts))
+        print "Skipped %d incomplete or preview clients" % skipped
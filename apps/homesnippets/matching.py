@@ -0,0 +1,1002 @@
+"""
+Client match rule evaluation
+
+Rules are compiled into matcher objects up front, so that patterns get parsed
+once per rule rather than once per rule per request.
+"""
+import copy
+import hashlib
+import logging
+import re
+import sre_constants
+import sre_parse
+from binascii import hexlify
+from bisect import bisect_left
+
+from homesnippets.lru import LRUCache
+
+
+log = logging.getLogger('homesnippets.matching')
+
+# Fields of a client match rule that are matched against URL segments.
+MATCH_FIELDS = ('startpage_version', 'name', 'version', 'appbuildid',
+                'build_target', 'locale', 'channel', 'os_version',
+                'distribution', 'distribution_version')
+
+# Order in which fields are checked within a single rule, most selective
+# first. A rule bails at the first mismatch, so checking fields likely to
+# differ between clients early saves the rest of the comparisons.
+FIELD_SELECTIVITY = ('locale', 'version', 'name', 'channel',
+                     'startpage_version', 'build_target', 'os_version',
+                     'distribution', 'distribution_version', 'appbuildid')
+
+
+class RuleCompileError(ValueError):
+    """A match rule field value could not be compiled into a condition."""
+
+    def __init__(self, field, value, reason):
+        ValueError.__init__(self, '%s: %s (%s)' % (field, value, reason))
+        self.field = field
+        self.value = value
+        self.reason = reason
+
+
+class ExactCondition(object):
+    """Field value must be equal to the rule value."""
+    __slots__ = ('field', 'value')
+
+    cost = 1
+
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+
+    def matches(self, value):
+        return value == self.value
+
+
+class RegexCondition(object):
+    """Field value must match the rule's /regex/, anchored at the start."""
+    __slots__ = ('field', 'pattern', 'regex')
+
+    cost = 10
+
+    def __init__(self, field, pattern):
+        self.field = field
+        self.pattern = pattern
+        try:
+            self.regex = re.compile(pattern)
+        except re.error as e:
+            raise RuleCompileError(field, '/%s/' % pattern, e)
+
+    def matches(self, value):
+        return self.regex.match(value) is not None
+
+
+def _subpatterns(op, av):
+    """Child subpatterns of a parsed regex node."""
+    if op == sre_constants.BRANCH:
+        return av[1]
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+              sre_constants.SUBPATTERN, sre_constants.ASSERT,
+              sre_constants.ASSERT_NOT):
+        return [av[-1]]
+    if op == sre_constants.GROUPREF_EXISTS:
+        return [p for p in av[1:] if p is not None]
+    return []
+
+
+def _is_unbounded(op, av):
+    return (op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and
+            av[1] == sre_constants.MAXREPEAT)
+
+
+def _first_literal(subpattern):
+    """Literal character a branch must start with, or None if unknown."""
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL:
+            return av
+        if op == sre_constants.SUBPATTERN:
+            return _first_literal(av[-1])
+        return None
+
+
+# Character classes for the categories sre_parse reduces \d, \w etc. to.
+CATEGORY_RES = dict((getattr(sre_constants, name), re.compile(pattern))
+                    for name, pattern in (
+                        ('CATEGORY_DIGIT', r'\d'),
+                        ('CATEGORY_NOT_DIGIT', r'\D'),
+                        ('CATEGORY_SPACE', r'\s'),
+                        ('CATEGORY_NOT_SPACE', r'\S'),
+                        ('CATEGORY_WORD', r'\w'),
+                        ('CATEGORY_NOT_WORD', r'\W')))
+
+
+def _may_match(op, av, char):
+    """Could a single-character regex node match char? True if unsure."""
+    code = ord(char)
+    if op == sre_constants.LITERAL:
+        return av == code
+    if op == sre_constants.NOT_LITERAL:
+        return av != code
+    if op == sre_constants.ANY:
+        return char != '\n'
+    if op == sre_constants.IN:
+        negate, hit = False, False
+        for item_op, item_av in av:
+            if item_op == sre_constants.NEGATE:
+                negate = True
+            elif item_op == sre_constants.LITERAL:
+                hit = hit or item_av == code
+            elif item_op == sre_constants.RANGE:
+                hit = hit or item_av[0] <= code <= item_av[1]
+            elif item_op == sre_constants.CATEGORY:
+                category = CATEGORY_RES.get(item_av)
+                hit = hit or category is None or bool(category.match(char))
+            else:
+                return True
+        return hit != negate
+    return True
+
+
+def _unbounded_repeats(subpattern):
+    """All unbounded repeat nodes within subpattern, as (op, av) pairs."""
+    found = []
+    for op, av in subpattern:
+        if _is_unbounded(op, av):
+            found.append((op, av))
+        for child in _subpatterns(op, av):
+            found.extend(_unbounded_repeats(child))
+    return found
+
+
+def _is_delimited(body, repeats):
+    """Does a repeated body contain a literal that none of the repeats
+    within it can match? Then there's only one way to split text between
+    iterations, as with (\d+\.)+, and no catastrophic backtracking."""
+    body = list(body)
+    while len(body) == 1 and body[0][0] == sre_constants.SUBPATTERN:
+        body = list(body[0][1][-1])
+    for op, av in body:
+        if op != sre_constants.LITERAL:
+            continue
+        char = unichr(av)
+        for repeat_op, repeat_av in repeats:
+            items = list(repeat_av[2])
+            if len(items) != 1 or _may_match(items[0][0], items[0][1], char):
+                break
+        else:
+            return True
+    return False
+
+
+def _find_hazards(subpattern, in_repeat, hazards):
+    previous = None
+    for op, av in subpattern:
+        unbounded = _is_unbounded(op, av)
+        if unbounded:
+            inner = _unbounded_repeats(av[2])
+            if inner and not _is_delimited(av[2], inner):
+                hazards.add('nested unbounded repeats, eg. (a+)+')
+            if (previous is not None and
+                    list(av[2]) == [(sre_constants.ANY, None)] and
+                    list(previous[2]) == [(sre_constants.ANY, None)]):
+                hazards.add('adjacent unbounded wildcards, eg. .*.*')
+        if op == sre_constants.BRANCH and in_repeat:
+            firsts = [_first_literal(branch) for branch in av[1]]
+            if None in firsts or len(set(firsts)) < len(firsts):
+                hazards.add('repeated alternatives that can match the '
+                            'same text, eg. (a|ab)*')
+        previous = unbounded and av or None
+        for child in _subpatterns(op, av):
+            _find_hazards(child, in_repeat or unbounded, hazards)
+
+
+def regex_hazards(pattern):
+    """Sorted list of the reasons a pattern is prone to catastrophic
+    backtracking, eg. nested unbounded repeats, which take exponential time
+    to fail on some inputs. Empty for safe or unparseable patterns."""
+    try:
+        tree = sre_parse.parse(pattern)
+    except (re.error, sre_constants.error):
+        return []
+    hazards = set()
+    _find_hazards(tree, False, hazards)
+    return sorted(hazards)
+
+
+VERSION_PART_RE = re.compile(r'^(-?\d*)([^-\d]*)(-?\d*)(.*)$')
+ZERO_VERSION_PART = (0, (1, ''), 0, (1, ''))
+MAX_VERSION_PARTS = 6
+INFINITE_VERSION_PART = float('inf')
+
+
+def _version_string_key(value):
+    # A missing string part sorts after any present one, so that eg. 4.0b1
+    # comes before 4.0.
+    return value and (0, value) or (1, '')
+
+
+def parse_version(value):
+    """Sort key for a Mozilla toolkit style version string, eg. 4.0b7pre.
+
+    Each dot-separated part is split into number, string, number, string,
+    compared in that order. Missing parts count as zero, so 4, 4.0 and 4.0.0
+    are equal. As in the toolkit, a part of * is infinitely high, so 4.*
+    comes after every 4.x, and a string part of + means the prerelease of
+    the next number, so 4.0+ equals 4.1pre. Raises ValueError for empty
+    versions, or versions with more than MAX_VERSION_PARTS significant parts.
+    """
+    if not value:
+        raise ValueError('empty version')
+    parts = []
+    for part in value.split('.'):
+        if part == '*':
+            parts.append((INFINITE_VERSION_PART, _version_string_key(''),
+                          0, _version_string_key('')))
+            continue
+        num_a, str_b, num_c, str_d = VERSION_PART_RE.match(part).groups()
+        num_a = int(num_a or 0)
+        if str_b == '+':
+            num_a, str_b = num_a + 1, 'pre'
+        parts.append((num_a, _version_string_key(str_b),
+                      int(num_c or 0), _version_string_key(str_d)))
+    while parts and parts[-1] == ZERO_VERSION_PART:
+        parts.pop()
+    if len(parts) > MAX_VERSION_PARTS:
+        raise ValueError('too many parts in version %s' % value)
+    # Padded to a fixed length so that keys compare part by part.
+    parts.extend([ZERO_VERSION_PART] * (MAX_VERSION_PARTS - len(parts)))
+    return tuple(parts)
+
+
+RANGE_CLAUSE_RE = re.compile(r'^(<=|>=|==|<|>|=)\s*([\w.+*-]+)$')
+
+
+class RangeCondition(object):
+    """Field value must fall within a range, written as comma-separated
+    comparisons, eg. >=4.0,<10. Subclasses define how values are parsed into
+    comparable keys.
+
+    The comparisons are reduced to a single interval, with lower and upper
+    bounds (None if unbounded) and flags for whether each bound is included.
+    """
+    __slots__ = ('field', 'spec', 'lower', 'lower_incl', 'upper',
+                 'upper_incl')
+
+    cost = 5
+
+    def __init__(self, field, spec):
+        self.field = field
+        self.spec = spec
+        self.lower, self.lower_incl = None, True
+        self.upper, self.upper_incl = None, True
+
+        for clause in spec.split(','):
+            match = RANGE_CLAUSE_RE.match(clause.strip())
+            if not match:
+                raise RuleCompileError(field, spec,
+                                       'bad range clause "%s"' % clause)
+            op, operand = match.groups()
+            try:
+                if op in ('>', '>=', '=', '=='):
+                    self._raise_lower(self.parse_bound(operand, op == '>'),
+                                      op != '>')
+                if op in ('<', '<=', '=', '=='):
+                    self._lower_upper(self.parse_bound(operand, op != '<'),
+                                      op != '<')
+            except ValueError as e:
+                raise RuleCompileError(field, spec, e)
+
+    def _raise_lower(self, key, incl):
+        if (self.lower is None or key > self.lower or
+                (key == self.lower and not incl)):
+            self.lower, self.lower_incl = key, incl
+
+    def _lower_upper(self, key, incl):
+        if (self.upper is None or key < self.upper or
+                (key == self.upper and not incl)):
+            self.upper, self.upper_incl = key, incl
+
+    def parse(self, value):
+        raise NotImplementedError
+
+    def parse_bound(self, value, end):
+        """Key for a range operand. Operands that stand for a period, like
+        a bare date, are taken from the end of it if end is set, so that
+        eg. <=20110331 takes in the whole day, or else from its start."""
+        return self.parse(value)
+
+    def key_for(self, value):
+        """Comparable key for a client value, or None if it can't be parsed,
+        in which case no range matches it."""
+        try:
+            return self.parse(value)
+        except ValueError:
+            return None
+
+    def contains(self, key):
+        if key is None:
+            return False
+        if self.lower is not None:
+            if key < self.lower or (key == self.lower and
+                                    not self.lower_incl):
+                return False
+        if self.upper is not None:
+            if key > self.upper or (key == self.upper and
+                                    not self.upper_incl):
+                return False
+        return True
+
+    def matches(self, value):
+        return self.contains(self.key_for(value))
+
+
+class VersionRangeCondition(RangeCondition):
+    """Range of versions, compared the way Mozilla toolkit versions are."""
+    __slots__ = ()
+
+    parse = staticmethod(parse_version)
+
+
+BUILD_ID_LENGTH = 14
+
+
+def parse_build_id(value, end=False):
+    """Integer key for a build ID timestamp (YYYYMMDDhhmmss). Shorter
+    prefixes, like a bare date, are padded out to the start of that period,
+    or to its end if end is set. Raises ValueError for anything but
+    digits."""
+    if not value.isdigit() or len(value) > BUILD_ID_LENGTH:
+        raise ValueError('bad build id %s' % value)
+    return int(value.ljust(BUILD_ID_LENGTH, end and '9' or '0'))
+
+
+class BuildIdRangeCondition(RangeCondition):
+    """Range of build IDs, compared as timestamps."""
+    __slots__ = ()
+
+    parse = staticmethod(parse_build_id)
+
+    def parse_bound(self, value, end):
+        return parse_build_id(value, end)
+
+
+# Fields that accept range conditions, with the condition class for each.
+RANGE_CONDITIONS = {
+    'version': VersionRangeCondition,
+    'startpage_version': VersionRangeCondition,
+    'appbuildid': BuildIdRangeCondition,
+}
+
+
+class LocalePrefixCondition(object):
+    """Field value must be a locale within the rule's language or region,
+    written as a prefix ending in -*. eg. pt-* matches pt, pt-BR and pt-PT.
+    """
+    __slots__ = ('field', 'prefix', 'subtags')
+
+    cost = 2
+
+    def __init__(self, field, prefix):
+        self.field = field
+        self.prefix = prefix
+        self.subtags = tuple(prefix.split('-'))
+        if '' in self.subtags or '*' in prefix:
+            raise RuleCompileError(field, prefix + '-*', 'bad locale prefix')
+
+    def matches(self, value):
+        return value == self.prefix or value.startswith(self.prefix + '-')
+
+
+# Fields that accept -* prefix conditions.
+PREFIX_FIELDS = ('locale',)
+
+
+def compile_condition(field, value):
+    """Compile a single rule field value into a condition. Returns None for
+    blank values, which match anything."""
+    if not value:
+        return None
+    if value.startswith('/'):
+        return RegexCondition(field, value[1:-1])
+    if field in RANGE_CONDITIONS and value[0] in '<>=':
+        return RANGE_CONDITIONS[field](field, value)
+    if field in PREFIX_FIELDS and value.endswith('-*'):
+        return LocalePrefixCondition(field, value[:-2])
+    return ExactCondition(field, value)
+
+
+def _condition_order(condition):
+    return (condition.cost, FIELD_SELECTIVITY.index(condition.field))
+
+
+class RuleMatcher(object):
+    """Compiled form of a client match rule.
+
+    Conditions are checked cheapest and most selective first, stopping at the
+    first one that fails.
+    """
+    __slots__ = ('id', 'exclude', 'conditions', 'error')
+
+    def __init__(self, id, exclude, conditions, error=None):
+        self.id = id
+        self.exclude = exclude
+        self.conditions = tuple(sorted(conditions, key=_condition_order))
+        self.error = error
+
+    def is_match(self, args):
+        if self.error is not None:
+            return False
+        for condition in self.conditions:
+            try:
+                value = args[condition.field]
+            except KeyError:
+                continue
+            if not condition.matches(value):
+                return False
+        return True
+
+
+# Layout of the rows in a RuleSnapshot.
+ROW_FIELDS = ('id', 'exclude') + MATCH_FIELDS
+
+# Version tag for cached snapshots. Derived from the row layout, so that a
+# change to the match fields makes previously cached snapshots unloadable.
+SNAPSHOT_SCHEMA = 'rules-1:%s' % ','.join(ROW_FIELDS)
+
+
+def rule_row(rule):
+    """Reduce a rule to a plain tuple of its ROW_FIELDS values."""
+    return tuple(getattr(rule, field) for field in ROW_FIELDS)
+
+
+def compile_rule(row):
+    """Compile a rule row into a RuleMatcher, raising RuleCompileError if any
+    of its field values is invalid."""
+    conditions = []
+    for field, value in zip(MATCH_FIELDS, row[2:]):
+        condition = compile_condition(field, value)
+        if condition is not None:
+            conditions.append(condition)
+    return RuleMatcher(row[0], row[1], conditions)
+
+
+def compile_rule_safely(row):
+    """Compile a rule row, logging an invalid one and returning a matcher
+    that never matches in its place."""
+    try:
+        return compile_rule(row)
+    except RuleCompileError as e:
+        log.warning('Invalid client match rule %s: %s' % (row[0], e))
+        return RuleMatcher(row[0], row[1], (), error=e)
+
+
+class RuleSnapshot(object):
+    """Compact copy of the set of all rules, as a tuple of rows holding just
+    the fields used for matching.
+
+    Snapshots go into the cache as plain tuples tagged with SNAPSHOT_SCHEMA,
+    rather than as pickled model instances, which keeps them small and quick
+    to load.
+
+    seq is the number of the last rule change the snapshot includes, when
+    rule changes are logged (see models.RULE_DELTAS), and cached_at the time
+    it was cached. Both are cached alongside the snapshot, not as part of it.
+    """
+    __slots__ = ('token', 'rows', 'seq', 'cached_at')
+
+    def __init__(self, token, rows, seq=0, cached_at=None):
+        self.token = token
+        self.rows = rows
+        self.seq = seq
+        self.cached_at = cached_at
+
+    @classmethod
+    def from_rules(cls, rules):
+        """Snapshot of rules, with a hash of its rows as the token, so that
+        snapshots of the same rules built anywhere share a token."""
+        rows = tuple(rule_row(rule) for rule in rules)
+        return cls(hashlib.md5(repr(rows)).hexdigest(), rows)
+
+    @classmethod
+    def load(cls, data):
+        """Rebuild a snapshot from dump() output. Returns None for data in
+        any other format, such as a snapshot from an older schema."""
+        if (not isinstance(data, tuple) or len(data) != 3 or
+                data[0] != SNAPSHOT_SCHEMA):
+            return None
+        return cls(data[1], data[2])
+
+    def dump(self):
+        return (SNAPSHOT_SCHEMA, self.token, self.rows)
+
+
+class MatcherCache(object):
+    """Memo of compiled matchers, keyed by rule row. Snapshots loaded fresh
+    from the cache reuse the matchers compiled for earlier copies of the same
+    rules."""
+
+    def __init__(self):
+        self.matchers = {}
+
+    def get_matchers(self, rows):
+        matchers, found = [], {}
+        for row in rows:
+            matcher = self.matchers.get(row)
+            if matcher is None:
+                matcher = compile_rule_safely(row)
+            found[row] = matcher
+            matchers.append(matcher)
+        # Only keep matchers for the current set of rules.
+        self.matchers = found
+        return matchers
+
+
+# Patterns that can't be merged into a combined regex: backreferences and
+# conditional group references are renumbered by merging, and inline flags
+# apply to the whole expression.
+UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]')
+
+# Python's re module tops out at 100 groups per expression.
+MAX_COMBINED_GROUPS = 99
+
+
+class FieldRegexSet(object):
+    """All the regex conditions on one field, merged for a single scan.
+
+    Each pattern is wrapped in an optional lookahead with its own group, and
+    the lookaheads are concatenated. Matching the result against a value
+    tries every pattern at the start of the value and leaves the groups of
+    the ones that matched set, so one call into the regex engine reports all
+    matching rules. Patterns that can't be merged are checked one at a time.
+    """
+
+    def __init__(self, field, conditions):
+        """conditions is a list of (rule position, RegexCondition) pairs."""
+        self.field = field
+        self.combined = []
+        self.separate = []
+
+        chunk, groups = [], 0
+        for pos, condition in conditions:
+            if (UNCOMBINABLE_RE.search(condition.pattern) or
+                    condition.regex.groupindex):
+                self.separate.append((pos, condition))
+                continue
+            size = condition.regex.groups + 1
+            if chunk and groups + size > MAX_COMBINED_GROUPS:
+                self._add_combined(chunk)
+                chunk, groups = [], 0
+            chunk.append((pos, condition))
+            groups += size
+        if chunk:
+            self._add_combined(chunk)
+
+    def _add_combined(self, chunk):
+        parts, slots, group = [], [], 0
+        for pos, condition in chunk:
+            parts.append('(?:(?=(%s)))?' % condition.pattern)
+            slots.append((group, pos))
+            group += condition.regex.groups + 1
+        self.combined.append((re.compile(''.join(parts)), tuple(slots)))
+
+    def find_matches(self, value):
+        """List of positions of the rules whose pattern matches value."""
+        matched = []
+        for regex, slots in self.combined:
+            groups = regex.match(value).groups()
+            matched.extend(pos for group, pos in slots
+                           if groups[group] is not None)
+        matched.extend(pos for pos, condition in self.separate
+                       if condition.matches(value))
+        return matched
+
+
+class IntervalIndex(object):
+    """Sorted index over the range conditions on one field.
+
+    All range bounds are sorted into a list of distinct boundaries, which
+    splits the key space into elementary segments: the gaps between
+    boundaries, and the boundaries themselves. The bitset of rules whose
+    range covers each segment is computed up front, so finding every range
+    containing a value is a binary search for its segment.
+    """
+
+    def __init__(self, field, conditions):
+        """conditions is a list of (rule position, RangeCondition) pairs."""
+        self.field = field
+        self.parse = conditions[0][1].key_for
+        bounds = set()
+        for pos, condition in conditions:
+            for bound in (condition.lower, condition.upper):
+                if bound is not None:
+                    bounds.add(bound)
+        self.bounds = sorted(bounds)
+
+        # Segment 2i is the gap before boundary i, segment 2i + 1 is
+        # boundary i itself, and the last segment is past every boundary.
+        last = 2 * len(self.bounds)
+        starts, ends = {}, {}
+        for pos, condition in conditions:
+            if condition.lower is None:
+                start = 0
+            else:
+                start = 2 * bisect_left(self.bounds, condition.lower) + (
+                    condition.lower_incl and 1 or 2)
+            if condition.upper is None:
+                end = last
+            else:
+                end = 2 * bisect_left(self.bounds, condition.upper) + (
+                    condition.upper_incl and 1 or 0)
+            if start <= end:
+                starts[start] = starts.get(start, 0) | 1 << pos
+                ends[end] = ends.get(end, 0) | 1 << pos
+
+        self.segments, bits = [], 0
+        for segment in range(last + 1):
+            bits |= starts.get(segment, 0)
+            self.segments.append(bits)
+            bits &= ~ends.get(segment, 0)
+
+    def find_bits(self, value):
+        """Bitset of the rules whose range contains value."""
+        key = self.parse(value)
+        if key is None:
+            return 0
+        idx = bisect_left(self.bounds, key)
+        if idx < len(self.bounds) and self.bounds[idx] == key:
+            return self.segments[2 * idx + 1]
+        return self.segments[2 * idx]
+
+
+class SubtagTrie(object):
+    """Trie over the -* prefix conditions on one field, keyed by subtag.
+
+    Each node holds the bitset of rules whose prefix ends there, so walking
+    a value's subtags from the root collects every prefix rule it falls
+    under, from the broadest to the most specific, in one pass.
+    """
+
+    def __init__(self, field, conditions):
+        """conditions is a list of (rule position, LocalePrefixCondition)
+        pairs."""
+        self.field = field
+        # Nodes are [bits, children] pairs, children keyed by subtag.
+        self.root = [0, {}]
+        for pos, condition in conditions:
+            node = self.root
+            for subtag in condition.subtags:
+                node = node[1].setdefault(subtag, [0, {}])
+            node[0] |= 1 << pos
+
+    def find_bits(self, value):
+        """Bitset of the rules whose prefix covers value."""
+        bits, node = 0, self.root
+        for subtag in value.split('-'):
+            node = node[1].get(subtag)
+            if node is None:
+                break
+            bits |= node[0]
+        return bits
+
+
+ONE_BIT = re.compile('1')
+
+
+def bit_positions(bits):
+    """List of the positions of the bits set in an integer bitset.
+
+    The 1s are found by a regex over the reversed binary string, which skips
+    runs of 0s without a Python step per bit.
+    """
+    return [match.start() for match in ONE_BIT.finditer(bin(bits)[:1:-1])]
+
+# Bitsets of recently seen rule ID lists. The same few partitions come up
+# request after request, and each is converted on a lookup and again for
+# its response.
+RULE_BITS_MEMO = LRUCache(64)
+
+
+def rule_bits(rule_ids):
+    """Integer bitset of rule IDs, with a bit set at each ID.
+
+    The bits are set in a byte array, converted to an integer at the end, as
+    or-ing each ID into a long integer would copy it once per ID.
+    """
+    key = tuple(rule_ids)
+    bits = RULE_BITS_MEMO.get(key)
+    if bits is None:
+        ids = [int(rule_id) for rule_id in key]
+        data = bytearray(ids and (max(ids) >> 3) + 1 or 1)
+        for rule_id in ids:
+            data[rule_id >> 3] |= 1 << (rule_id & 7)
+        data.reverse()
+        bits = int(hexlify(data), 16)
+        RULE_BITS_MEMO.set(key, bits)
+    return bits
+
+
+class RuleIndex(object):
+    """Index over a set of compiled rules, evaluated one field at a time.
+
+    Sets of rules are bitsets over rule positions. For each field, the rules
+    a client value satisfies are the rules with no condition on that field,
+    plus the rules whose exact value equals it (looked up by (field, value)),
+    plus the rules whose regex matches it (from one FieldRegexSet scan), plus
+    the rules whose range or locale prefix covers it (from an IntervalIndex
+    or SubtagTrie). The rules matching a client are the AND of those sets
+    over all fields.
+
+    The per-field sets are memoized in an LRU keyed by value, so a client
+    with one new value, eg. a fresh appbuildid, costs one field evaluation
+    rather than a pass over every rule.
+    """
+
+    def __init__(self, matchers, memo_size=1000, token=None):
+        self.token = token
+        self.matchers = list(matchers)
+        self.exact = {}
+        self.wildcard = dict((field, 0) for field in MATCH_FIELDS)
+        self.memos = dict((field, LRUCache(memo_size))
+                          for field in MATCH_FIELDS)
+        self.all_bits = 0
+
+        self.positions = {}
+        for pos, matcher in enumerate(self.matchers):
+            self._add_bits(pos, matcher)
+        self.regexes, self.ranges, self.prefixes = {}, {}, {}
+        self._build_patterns(MATCH_FIELDS)
+        self._find_referenced_fields()
+
+    def _add_bits(self, pos, matcher):
+        """Add a rule's exact and wildcard bits. Removed rules leave a None
+        in matchers, and rules that failed to compile never match."""
+        if matcher is None:
+            return
+        self.positions[str(matcher.id)] = pos
+        if matcher.error is not None:
+            return
+        bit = 1 << pos
+        self.all_bits |= bit
+        constrained = set()
+        for condition in matcher.conditions:
+            constrained.add(condition.field)
+            if isinstance(condition, ExactCondition):
+                key = (condition.field, condition.value)
+                self.exact[key] = self.exact.get(key, 0) | bit
+        for field in MATCH_FIELDS:
+            if field not in constrained:
+                self.wildcard[field] |= bit
+
+    def _remove_bits(self, pos, matcher):
+        if matcher is None:
+            return
+        del self.positions[str(matcher.id)]
+        mask = ~(1 << pos)
+        self.all_bits &= mask
+        for condition in matcher.conditions:
+            if isinstance(condition, ExactCondition):
+                key = (condition.field, condition.value)
+                self.exact[key] &= mask
+                if not self.exact[key]:
+                    del self.exact[key]
+        for field in MATCH_FIELDS:
+            self.wildcard[field] &= mask
+
+    def _build_patterns(self, fields):
+        """(Re)build the regex sets, interval indexes and tries for fields."""
+        regexes, ranges, prefixes = {}, {}, {}
+        for pos, matcher in enumerate(self.matchers):
+            if matcher is None or matcher.error is not None:
+                continue
+            for condition in matcher.conditions:
+                if condition.field not in fields:
+                    continue
+                if isinstance(condition, RangeCondition):
+                    ranges.setdefault(condition.field, []).append(
+                        (pos, condition))
+                elif isinstance(condition, LocalePrefixCondition):
+                    prefixes.setdefault(condition.field, []).append(
+                        (pos, condition))
+                elif not isinstance(condition, ExactCondition):
+                    regexes.setdefault(condition.field, []).append(
+                        (pos, condition))
+        for field in fields:
+            for structures, found, cls in (
+                    (self.regexes, regexes, FieldRegexSet),
+                    (self.ranges, ranges, IntervalIndex),
+                    (self.prefixes, prefixes, SubtagTrie)):
+                if field in found:
+                    structures[field] = cls(field, found[field])
+                else:
+                    structures.pop(field, None)
+
+    def _find_referenced_fields(self):
+        # Fields that at least one rule has a condition on. Values of other
+        # fields can't make any difference to which rules match.
+        self.referenced_fields = frozenset(
+            field for field in MATCH_FIELDS
+            if self.wildcard[field] != self.all_bits)
+
+    def copy(self):
+        """Copy of the index that can be changed with apply_change() while
+        this one carries on being used. Compiled matchers and pattern
+        structures are shared, as changes replace them rather than change
+        them."""
+        index = copy.copy(self)
+        index.matchers = list(self.matchers)
+        for name in ('exact', 'wildcard', 'positions', 'regexes', 'ranges',
+                     'prefixes'):
+            setattr(index, name, dict(getattr(self, name)))
+        index.memos = dict((field, memo.copy())
+                           for field, memo in self.memos.items())
+        return index
+
+    def apply_change(self, rule_id, matcher):
+        """Add, replace or remove (given None for matcher) a single rule.
+
+        A replaced rule keeps its position and new rules are added at the
+        end, so the bits of all other rules stay put. Only the structures for
+        fields the old or new rule has a pattern on are rebuilt, and memoized
+        field results have just the changed rule's bit patched.
+        """
+        rule_id = str(rule_id)
+        pos = self.positions.get(rule_id)
+        if pos is None:
+            if matcher is None:
+                return
+            pos = len(self.matchers)
+            self.matchers.append(None)
+        old = self.matchers[pos]
+        self._remove_bits(pos, old)
+        self.matchers[pos] = matcher
+        self._add_bits(pos, matcher)
+
+        fields = set()
+        for changed in (old, matcher):
+            if changed is not None:
+                fields.update(c.field for c in changed.conditions
+                              if not isinstance(c, ExactCondition))
+        self._build_patterns(fields)
+        self._find_referenced_fields()
+
+        bit = 1 << pos
+        valid = matcher is not None and matcher.error is None
+        conditions = valid and dict((c.field, c)
+                                    for c in matcher.conditions) or {}
+        for field, memo in self.memos.items():
+            condition = conditions.get(field)
+            for value, bits in memo.items():
+                if valid and (condition is None or condition.matches(value)):
+                    memo.replace(value, bits | bit)
+                else:
+                    memo.replace(value, bits & ~bit)
+
+    def field_matches(self, field, value):
+        """Bitset of the rules satisfied by a value on one field."""
+        memo = self.memos[field]
+        bits = memo.get(value)
+        if bits is None:
+            bits = (self.wildcard[field] | self.exact.get((field, value), 0) |
+                    self.pattern_matches(field, value))
+            memo.set(value, bits)
+        return bits
+
+    def pattern_matches(self, field, value):
+        """Bitset of the rules with a condition other than an exact value on
+        a field, eg. a regex or range, that a value satisfies."""
+        bits = 0
+        if field in self.prefixes:
+            bits |= self.prefixes[field].find_bits(value)
+        if field in self.regexes:
+            for pos in self.regexes[field].find_matches(value):
+                bits |= 1 << pos
+        if field in self.ranges:
+            bits |= self.ranges[field].find_bits(value)
+        return bits
+
+    def has_patterns(self, field):
+        """Whether any rule has a condition other than an exact value on a
+        field."""
+        return (field in self.regexes or field in self.ranges or
+                field in self.prefixes)
+
+    def match_bits(self, args):
+        """Bitset of the rules matching the given args. Conditions on fields
+        missing from args are skipped."""
+        bits = self.all_bits
+        for field in MATCH_FIELDS:
+            if field in args:
+                bits &= self.field_matches(field, args[field])
+                if not bits:
+                    break
+        return bits
+
+    def value_class(self, field, value):
+        """Equivalence class of a value on a field, as the bitset of rules
+        with a condition on that field that the value satisfies.
+
+        Values in the same class are treated the same by every rule, so they
+        can't change which rules match. Values no rule mentions or matches
+        all fall into the same class, 0.
+        """
+        return self.field_matches(field, value) & ~self.wildcard[field]
+
+    def class_vector(self, args):
+        """Tuple of the classes of the args' values for each referenced
+        field, or None for fields missing from args."""
+        return tuple(self.value_class(field, args[field])
+                     if field in args else None
+                     for field in MATCH_FIELDS
+                     if field in self.referenced_fields)
+
+    def find_matches(self, args):
+        """Set of positions of the rules matching the given args."""
+        return set(bit_positions(self.match_bits(args)))
+
+    def partition(self, args):
+        """Split rule IDs into lists of include and exclude rules for the
+        given args.
+
+        Include rules that don't match end up in the exclude list, so that
+        snippets can split required matches into multiple rules and combine
+        them together.
+        """
+        matched = self.find_matches(args)
+        include_ids, exclude_ids = [], []
+        for pos, matcher in enumerate(self.matchers):
+            if matcher is None:
+                continue
+            if pos in matched and not matcher.exclude:
+                include_ids.append(str(matcher.id))
+            elif pos in matched or not matcher.exclude:
+                exclude_ids.append(str(matcher.id))
+        return include_ids, exclude_ids
+
+    def partition_many(self, args_list):
+        """Include and exclude rule ID lists for each of a list of clients."""
+        return [self.partition(args) for args in args_list]
+
+    def update_partition(self, args, partition, rule_ids):
+        """Bring a partition computed before changes to some rules up to
+        date, checking just the changed rules against args."""
+        include_ids = [i for i in partition[0] if i not in rule_ids]
+        exclude_ids = [i for i in partition[1] if i not in rule_ids]
+        for rule_id in rule_ids:
+            pos = self.positions.get(rule_id)
+            if pos is None:
+                continue
+            matcher = self.matchers[pos]
+            matched = matcher.is_match(args)
+            if matched and not matcher.exclude:
+                include_ids.append(rule_id)
+            elif matched or not matcher.exclude:
+                exclude_ids.append(rule_id)
+        # Same order as partition() would give.
+        order = lambda rule_id: self.positions.get(rule_id, -1)
+        return sorted(include_ids, key=order), sorted(exclude_ids, key=order)
+
+
+class ScanEngine(object):
+    """Reference match engine, checking every rule against each client in
+    turn. Slow, but simple enough to hold faster engines to."""
+
+    def __init__(self, index):
+        self.index = index
+        self.token = index.token
+
+    def partition(self, args):
+        include_ids, exclude_ids = [], []
+        for matcher in self.index.matchers:
+            if matcher is None:
+                continue
+            matched = matcher.is_match(args)
+            if matched and not matcher.exclude:
+                include_ids.append(str(matcher.id))
+            elif matched or not matcher.exclude:
+                exclude_ids.append(str(matcher.id))
+        return include_ids, exclude_ids
+
+    def partition_many(self, args_list):
+        return [self.partition(args) for args in args_list]
@@ -0,0 +1,389 @@
+"""
+Pooled memcached cache backend
+
+A cache backend speaking the memcached text protocol itself, eg.
+
+    CACHE_BACKEND = 'homesnippets.memcached://10.0.0.1:11211;10.0.0.2:11211/'
+
+Connections are kept open by each thread and reused from request to request.
+Keys are spread across servers on a consistent hash ring, so adding or
+losing a server only moves the keys on its share of the ring. Multi-key
+operations send one pipelined batch of commands to each server involved.
+A server that fails or times out counts as a miss, and is left alone for a
+while, rather than failing the request.
+
+Values of min_compress_len bytes or more are stored zlib compressed, marked
+as such in their flags, so values stored uncompressed still read. The sizes
+of values before and after are totalled, for compression_stats().
+
+Besides timeout, the backend takes socket_timeout (seconds to wait on a
+server, default 0.25), retry_after (seconds to leave a failed server alone,
+default 30), replicas (points per server on the hash ring, default 100) and
+min_compress_len (default 1024, or 0 to never compress) as parameters.
+"""
+import cPickle as pickle
+import hashlib
+import socket
+import threading
+import time
+import zlib
+from bisect import bisect
+
+from django.core.cache.backends.base import BaseCache
+from django.utils.encoding import smart_str
+
+
+DEFAULT_PORT = 11211
+
+# Value flags, as used by python-memcached.
+FLAG_PICKLE     = 1
+FLAG_INTEGER    = 2
+FLAG_LONG       = 4
+FLAG_COMPRESSED = 8
+
+MAX_KEY_LENGTH = 250
+
+
+class ServerError(Exception):
+    """A server failed, timed out or gave an unexpected reply."""
+
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+def _encode(value):
+    """Flags and bytes to store value as."""
+    if isinstance(value, str):
+        return 0, value
+    if isinstance(value, bool):
+        return FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if isinstance(value, int):
+        return FLAG_INTEGER, str(value)
+    if isinstance(value, long):
+        return FLAG_LONG, str(value)
+    return FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _compress(flags, data, min_compress_len):
+    """Flags and bytes to store encoded data as, compressed if it is at least
+    min_compress_len bytes long and compresses at all."""
+    if min_compress_len and len(data) >= min_compress_len:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return flags | FLAG_COMPRESSED, compressed
+    return flags, data
+
+
+def _decode(flags, data):
+    if flags & FLAG_COMPRESSED:
+        data = zlib.decompress(data)
+    if flags & FLAG_PICKLE:
+        return pickle.loads(data)
+    if flags & FLAG_INTEGER:
+        return int(data)
+    if flags & FLAG_LONG:
+        return long(data)
+    return data
+
+
+class HashRing(object):
+    """Consistent hash ring, with replicas points for each node."""
+
+    def __init__(self, nodes, replicas=100):
+        self.points = []
+        self.nodes = {}
+        for node in nodes:
+            for idx in range(replicas):
+                point = _hash('%s-%s' % (node, idx))
+                self.points.append(point)
+                self.nodes[point] = node
+        self.points.sort()
+
+    def node_for(self, key):
+        pos = bisect(self.points, _hash(key)) % len(self.points)
+        return self.nodes[self.points[pos]]
+
+
+class Connection(object):
+    """Buffered socket to a server."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ''
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        while '\r\n' not in self.buffer:
+            self._fill()
+        line, self.buffer = self.buffer.split('\r\n', 1)
+        return line
+
+    def read(self, size):
+        """Read size bytes, and the line end after them."""
+        while len(self.buffer) < size + 2:
+            self._fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size + 2:]
+        return data
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ServerError('Connection closed')
+        self.buffer += data
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class Server(object):
+    """A memcached server, with a connection to it kept for each thread."""
+
+    def __init__(self, address, socket_timeout=0.25, retry_after=30):
+        self.address = address
+        host, sep, port = address.partition(':')
+        self.host, self.port = host, int(port or DEFAULT_PORT)
+        self.socket_timeout = socket_timeout
+        self.retry_after = retry_after
+        self.dead_until = 0
+        self.local = threading.local()
+
+    def is_dead(self):
+        """Is the server being left alone after a failure?"""
+        return self.dead_until > time.time()
+
+    def connection(self):
+        """This thread's connection to the server, opened if need be."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            try:
+                sock = socket.create_connection((self.host, self.port),
+                                                self.socket_timeout)
+            except socket.error as e:
+                raise ServerError(str(e))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self.local.conn = Connection(sock)
+        return conn
+
+    def run(self, data, read_replies):
+        """Send a batch of commands, and return read_replies(connection).
+        On failure, the server is marked dead and ServerError raised, as it
+        is without trying while the server is marked dead."""
+        if self.is_dead():
+            raise ServerError('%s is marked dead' % self.address)
+        try:
+            conn = self.connection()
+            conn.send(data)
+            return read_replies(conn)
+        except (socket.error, ServerError) as e:
+            self.mark_dead()
+            raise ServerError('%s: %s' % (self.address, e))
+
+    def mark_dead(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+        self.dead_until = time.time() + self.retry_after
+
+
+def _read_values(conn):
+    """Values from the reply to a get, as a dict.
+
+    The whole reply is always read, so that the connection is left ready
+    for the next command. Values that fail to decode, eg. corrupt or
+    written by incompatible code, are left out as misses.
+    """
+    values = {}
+    while True:
+        line = conn.readline()
+        if line == 'END':
+            return values
+        parts = line.split()
+        if len(parts) < 4 or parts[0] != 'VALUE' or not parts[2].isdigit() \
+                or not parts[3].isdigit():
+            raise ServerError('Unexpected reply: %r' % line)
+        key, flags, size = parts[1], int(parts[2]), int(parts[3])
+        data = conn.read(size)
+        try:
+            values[key] = _decode(flags, data)
+        except Exception:
+            # Unpickling can raise most anything.
+            continue
+
+
+class CacheClass(BaseCache):
+
+    def __init__(self, server, params):
+        BaseCache.__init__(self, params)
+        socket_timeout = float(params.get('socket_timeout', 0.25))
+        retry_after = float(params.get('retry_after', 30))
+        replicas = int(params.get('replicas', 100))
+        self.min_compress_len = int(params.get('min_compress_len', 1024))
+        self.compressed = self.raw_bytes = self.stored_bytes = 0
+        self.stats_lock = threading.Lock()
+
+        self.servers = dict((address, Server(address, socket_timeout,
+                                             retry_after))
+                            for address in server.split(';') if address)
+        self.ring = HashRing(sorted(self.servers.keys()), replicas)
+
+    def _get_memcache_timeout(self, timeout):
+        """
+        Memcached deals with long (> 30 days) timeouts in a special
+        way. Call this function to obtain a safe value for your timeout.
+        """
+        timeout = timeout or self.default_timeout
+        if timeout > 2592000: # 60*60*24*30, 30 days
+            timeout += int(time.time())
+        return timeout
+
+    def compression_stats(self):
+        """Number of values compressed, and total sizes of the values
+        written by this process before and after compression."""
+        return dict(compressed=self.compressed, raw_bytes=self.raw_bytes,
+                    stored_bytes=self.stored_bytes,
+                    ratio=self.stored_bytes and
+                          float(self.raw_bytes) / self.stored_bytes)
+
+    def _count_sizes(self, sizes):
+        """Total (encoded size, stored size) pairs for values written."""
+        self.stats_lock.acquire()
+        try:
+            for raw, stored in sizes:
+                self.compressed += stored < raw
+                self.raw_bytes += raw
+                self.stored_bytes += stored
+        finally:
+            self.stats_lock.release()
+
+    def _key(self, key):
+        """Key as memcached will take it: short, without whitespace."""
+        key = smart_str(key)
+        if len(key) > MAX_KEY_LENGTH or key.split() != [key]:
+            key = 'md5:%s' % hashlib.md5(key).hexdigest()
+        return key
+
+    def _by_server(self, keys):
+        """Map of servers to the memcached keys on them, for keys, and the
+        original keys for the memcached keys."""
+        batches, originals = {}, {}
+        for key in keys:
+            mc_key = self._key(key)
+            originals[mc_key] = key
+            server = self.servers[self.ring.node_for(mc_key)]
+            batches.setdefault(server, []).append(mc_key)
+        return batches, originals
+
+    def _store(self, command, items, timeout):
+        """Send a storage command for each of items, pipelined per server.
+        Returns the keys that were stored."""
+        exptime = self._get_memcache_timeout(timeout)
+        batches, originals = self._by_server(key for key, value in items)
+        values = dict((self._key(key), value) for key, value in items)
+
+        stored, sizes = [], []
+        for server, mc_keys in batches.items():
+            lines = []
+            for mc_key in mc_keys:
+                flags, data = _encode(values[mc_key])
+                size = len(data)
+                flags, data = _compress(flags, data, self.min_compress_len)
+                sizes.append((size, len(data)))
+                lines.append('%s %s %d %d %d\r\n%s\r\n' % (
+                    command, mc_key, flags, exptime, len(data), data))
+            try:
+                replies = server.run(''.join(lines), lambda conn: [
+                    conn.readline() for mc_key in mc_keys ])
+            except ServerError:
+                continue
+            stored.extend(originals[mc_key] for mc_key, reply
+                          in zip(mc_keys, replies) if reply == 'STORED')
+        self._count_sizes(sizes)
+        return stored
+
+    def add(self, key, value, timeout=0):
+        return bool(self._store('add', [(key, value)], timeout))
+
+    def set(self, key, value, timeout=0):
+        self._store('set', [(key, value)], timeout)
+
+    def set_many(self, data, timeout=0):
+        self._store('set', data.items(), timeout)
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        batches, originals = self._by_server(keys)
+        # Send every server its batch before reading any replies.
+        sent = []
+        for server, mc_keys in batches.items():
+            if server.is_dead():
+                continue
+            try:
+                conn = server.connection()
+                conn.send('get %s\r\n' % ' '.join(mc_keys))
+                sent.append((server, conn))
+            except (socket.error, ServerError):
+                server.mark_dead()
+
+        values = {}
+        for server, conn in sent:
+            try:
+                found = _read_values(conn)
+            except (socket.error, ServerError):
+                server.mark_dead()
+                continue
+            for mc_key, value in found.items():
+                values[originals[mc_key]] = value
+        return values
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        batches, originals = self._by_server(keys)
+        for server, mc_keys in batches.items():
+            try:
+                server.run(''.join('delete %s\r\n' % mc_key
+                                   for mc_key in mc_keys),
+                           lambda conn: [ conn.readline()
+                                          for mc_key in mc_keys ])
+            except ServerError:
+                pass
+
+    def _incr(self, command, key, delta):
+        mc_key = self._key(key)
+        server = self.servers[self.ring.node_for(mc_key)]
+        try:
+            reply = server.run('%s %s %d\r\n' % (command, mc_key, delta),
+                               lambda conn: conn.readline())
+        except ServerError:
+            reply = 'NOT_FOUND'
+        if not reply.isdigit():
+            raise ValueError("Key '%s' not found" % key)
+        return int(reply)
+
+    def incr(self, key, delta=1):
+        if delta < 0:
+            return self._incr('decr', key, -delta)
+        return self._incr('incr', key, delta)
+
+    def decr(self, key, delta=1):
+        return self.incr(key, -delta)
+
+    def has_key(self, key):
+        return key in self.get_many([key])
+
+    def clear(self):
+        for server in self.servers.values():
+            try:
+                server.run('flush_all\r\n', lambda conn: conn.readline())
+            except ServerError:
+                pass
@@ -0,0 +1,222 @@
+"""
+Memcached stand-in, for tests and local development
+
+Serves the part of the memcached text protocol that homesnippets.memcached
+uses from a dict in memory, so that a cluster of several nodes can be run
+from threads in a single process.
+"""
+import SocketServer
+import socket
+import threading
+import time
+
+
+# Expiry times beyond this many seconds are absolute timestamps.
+RELATIVE_EXPIRY_LIMIT = 2592000
+
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+    """Handles the commands on one client connection."""
+
+    def handle(self):
+        self.server.track(self.request)
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                parts = line.split()
+                if not parts:
+                    continue
+                command, args = parts[0], parts[1:]
+                if command == 'quit':
+                    break
+                handler = getattr(self, 'do_%s' % command, None)
+                if handler is None:
+                    self.reply('ERROR')
+                else:
+                    handler(*args)
+                self.wfile.flush()
+        except (IOError, ValueError, TypeError):
+            pass
+        finally:
+            self.server.untrack(self.request)
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def do_get(self, *keys):
+        for key in keys:
+            item = self.server.lookup(key)
+            if item is not None:
+                flags, data = item
+                self.reply('VALUE %s %d %d' % (key, flags, len(data)))
+                self.reply(data)
+        self.reply('END')
+
+    do_gets = do_get
+
+    def _store(self, mode, key, flags, exptime, size, noreply=None):
+        data = self.rfile.read(int(size) + 2)[:-2]
+        stored = self.server.store(mode, key, int(flags), int(exptime), data)
+        if noreply is None:
+            self.reply(stored and 'STORED' or 'NOT_STORED')
+
+    def do_set(self, *args):
+        self._store('set', *args)
+
+    def do_add(self, *args):
+        self._store('add', *args)
+
+    def do_replace(self, *args):
+        self._store('replace', *args)
+
+    def do_delete(self, key, *args):
+        deleted = self.server.delete(key)
+        if 'noreply' not in args:
+            self.reply(deleted and 'DELETED' or 'NOT_FOUND')
+
+    def do_incr(self, key, delta, noreply=None):
+        value = self.server.incr(key, int(delta))
+        if noreply is None:
+            self.reply(value is None and 'NOT_FOUND' or str(value))
+
+    def do_decr(self, key, delta, noreply=None):
+        value = self.server.incr(key, -int(delta))
+        if noreply is None:
+            self.reply(value is None and 'NOT_FOUND' or str(value))
+
+    def do_flush_all(self, *args):
+        self.server.flush()
+        if 'noreply' not in args:
+            self.reply('OK')
+
+    def do_version(self):
+        self.reply('VERSION homesnippets-stand-in')
+
+
+class MemcachedServer(SocketServer.ThreadingTCPServer):
+    """In-memory memcached node, listening on address. Binds to a free port
+    on localhost by default."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 MemcachedHandler)
+        self.items = {}
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.connections = 0
+        self.thread = None
+
+    @property
+    def address(self):
+        """host:port, as given to the cache backend."""
+        return '%s:%s' % self.server_address
+
+    def start(self):
+        """Serve from a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop listening, and drop every open client connection."""
+        self.shutdown()
+        self.server_close()
+        self.lock.acquire()
+        try:
+            clients = list(self.clients)
+        finally:
+            self.lock.release()
+        for sock in clients:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except socket.error:
+                pass
+
+    def track(self, sock):
+        self.lock.acquire()
+        try:
+            self.clients.add(sock)
+            self.connections += 1
+        finally:
+            self.lock.release()
+
+    def untrack(self, sock):
+        self.lock.acquire()
+        try:
+            self.clients.discard(sock)
+        finally:
+            self.lock.release()
+
+    def lookup(self, key):
+        """(flags, data) stored under key, or None if missing or expired."""
+        self.lock.acquire()
+        try:
+            item = self._live(key)
+            return item and (item[0], item[2])
+        finally:
+            self.lock.release()
+
+    def store(self, mode, key, flags, exptime, data):
+        if exptime < 0:
+            expires = -1
+        elif exptime > RELATIVE_EXPIRY_LIMIT:
+            expires = exptime
+        else:
+            expires = exptime and time.time() + exptime
+        self.lock.acquire()
+        try:
+            exists = self._live(key) is not None
+            if (mode == 'add' and exists) or \
+                    (mode == 'replace' and not exists):
+                return False
+            self.items[key] = (flags, expires, data)
+            return True
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            exists = self._live(key) is not None
+            self.items.pop(key, None)
+            return exists
+        finally:
+            self.lock.release()
+
+    def incr(self, key, delta):
+        """Add delta to the number stored under key, not going below 0, and
+        return the result, or None if missing."""
+        self.lock.acquire()
+        try:
+            item = self._live(key)
+            if item is None or not item[2].isdigit():
+                return None
+            flags, expires, data = item
+            value = max(0, int(data) + delta)
+            self.items[key] = (flags, expires, str(value))
+            return value
+        finally:
+            self.lock.release()
+
+    def _live(self, key):
+        """(flags, expires, data) item under key, dropping it if expired.
+        Call with the lock held."""
+        item = self.items.get(key)
+        if item is not None and item[1] and item[1] <= time.time():
+            del self.items[key]
+            item = None
+        return item
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.items.clear()
+        finally:
+            self.lock.release()
@@ -1,19 +1,36 @@
 """
 homesnippets models
 """
+import cPickle as pickle
 import hashlib
+import logging
+import random
+import threading
 from datetime import datetime
-from time import mktime, gmtime
+from multiprocessing.pool import ThreadPool
+from time import mktime, gmtime, time
+from timeit import default_timer
 
 from django.conf import settings
 from django.core import urlresolvers
 from django.core.cache import cache
-from django.db import models
-from django.db.models.signals import post_save, post_delete
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connection, models
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.utils.translation import ugettext_lazy as _
 
 from product_details import product_details
 
+from homesnippets import vectorized
+from homesnippets.caches import (FLUSH_PREFIX, CacheStats, LocalCache,
+                                 refresh_later, single_flight)
+from homesnippets.matching import (MATCH_FIELDS, MatcherCache,
+                                   RegexCondition, RuleIndex,
+                                   RuleCompileError, RuleSnapshot, ScanEngine,
+                                   bit_positions, compile_condition,
+                                   compile_rule_safely, regex_hazards,
+                                   rule_bits, rule_row)
+
 
 ENGLISH_COUNTRY_CHOICES = sorted(
     [(code, u'{0} ({1})'.format(name, code)) for code, name in
@@ -36,73 +53,739 @@ class CountryField(models.CharField):
         return super(CountryField, self).__init__(*args, **options)
 
 
+shadow_log = logging.getLogger('homesnippets.shadow')
+
 CACHE_TIMEOUT = getattr(settings, 'SNIPPET_MODEL_CACHE_TIMEOUT')
 
+# Number of distinct values per field whose matching rules are remembered.
+FIELD_MEMO_SIZE = getattr(settings, 'SNIPPET_MATCH_FIELD_MEMO_SIZE', 1000)
+
+# Engine used to evaluate rules on a cache miss: 'indexed', 'vectorized'
+# (requires numpy), or 'scan' (the reference, checking every rule in turn).
+MATCH_ENGINE = getattr(settings, 'SNIPPET_MATCH_ENGINE', 'indexed')
+
+# Candidate engine to compare against the reference scan over every rule, on
+# a sampled fraction of rule evaluations, eg. before switching MATCH_ENGINE.
+# Differences and timings are logged to homesnippets.shadow.
+SHADOW_ENGINE = getattr(settings, 'SNIPPET_MATCH_SHADOW_ENGINE', None)
+SHADOW_RATE = getattr(settings, 'SNIPPET_MATCH_SHADOW_RATE', 0.01)
+
+# Validate cached matches and lookups with a single content generation
+# number, bumped by every write and folded into cache keys, rather than with
+# lastmods for every rule and snippet involved.
+CACHE_GENERATIONS = getattr(settings, 'SNIPPET_CACHE_GENERATIONS', False)
+
+# Apply rule edits to in-process rule indexes as a log of single-rule
+# changes, rather than reloading all rules after every edit.
+RULE_DELTAS = getattr(settings, 'SNIPPET_RULE_DELTAS', False)
+
+# Keep up to this many rule matches and snippet lookups in process memory
+# too, for up to LOCAL_CACHE_TTL seconds. Entries are only served for the
+# content generation they were cached under, so this needs CACHE_GENERATIONS.
+LOCAL_CACHE_SIZE = getattr(settings, 'SNIPPET_LOCAL_CACHE_SIZE', 0)
+LOCAL_CACHE_TTL = getattr(settings, 'SNIPPET_LOCAL_CACHE_TTL', 60)
+
+# Cache fully rendered snippet responses per client, on top of the rule
+# matches and snippet lookups they are made from.
+RESPONSE_CACHE = getattr(settings, 'SNIPPET_RESPONSE_CACHE', False)
+
+# Let one process at a time recompute the set of all rules, a rule match or
+# a snippet lookup, holding a lease on it for up to CACHE_LOCK_LEASE seconds.
+# Others keep using the value being replaced, if any, or poll for the new one
+# every CACHE_LOCK_WAIT seconds, up to CACHE_LOCK_RETRIES times.
+CACHE_LOCKS = getattr(settings, 'SNIPPET_CACHE_LOCKS', False)
+CACHE_LOCK_LEASE = getattr(settings, 'SNIPPET_CACHE_LOCK_LEASE', 10)
+CACHE_LOCK_WAIT = getattr(settings, 'SNIPPET_CACHE_LOCK_WAIT', 0.05)
+CACHE_LOCK_RETRIES = getattr(settings, 'SNIPPET_CACHE_LOCK_RETRIES', 20)
+
+# Keep serving a snippet lookup for up to LOOKUP_GRACE seconds after
+# something it was made from changed, while one of REFRESH_THREADS background
+# threads per process looks it up again. Stale lookups are only found under
+# the same key, so this does nothing with CACHE_GENERATIONS.
+LOOKUP_GRACE = getattr(settings, 'SNIPPET_LOOKUP_GRACE', 0)
+REFRESH_THREADS = getattr(settings, 'SNIPPET_REFRESH_THREADS', 2)
+
+# Count hits, misses and invalidations of the set of all rules, rule
+# matches, snippet lookups and rendered responses, along with the sizes of
+# values cached, for the cache explorer in the admin. This also lets whole
+# families of entries be flushed from there. Counts are added into shared
+# totals, and flushes picked up, every CACHE_STATS_INTERVAL seconds. Sizes
+# are measured by pickling values again, so only for one in every
+# CACHE_STATS_SAMPLE values cached.
+CACHE_STATS = getattr(settings, 'SNIPPET_CACHE_STATS', False)
+CACHE_STATS_INTERVAL = getattr(settings, 'SNIPPET_CACHE_STATS_INTERVAL', 10)
+CACHE_STATS_SAMPLE = getattr(settings, 'SNIPPET_CACHE_STATS_SAMPLE', 20)
+
 CACHE_RULE_MATCH_PREFIX       = 'homesnippets_ClientMatchRule_Matches_'
 CACHE_RULE_LASTMOD_PREFIX     = 'homesnippets_ClientMatchRule_LastMod_'
 CACHE_RULE_ALL_PREFIX         = 'homesnippets_ClientMatchRule_All'
 CACHE_RULE_ALL_LASTMOD_PREFIX = 'homesnippets_ClientMatchRule_All_LastMod'
 CACHE_RULE_NEW_LASTMOD_PREFIX = 'homesnippets_ClientMatchRule_New_LastMod'
+CACHE_RULE_DELTA_SEQ          = 'homesnippets_ClientMatchRule_Delta_Seq'
+CACHE_RULE_DELTA_PREFIX       = 'homesnippets_ClientMatchRule_Delta_'
 CACHE_SNIPPET_LASTMOD_PREFIX  = 'homesnippets_Snippet_LastMod_'
 CACHE_SNIPPET_LOOKUP_PREFIX   = 'homesnippets_Snippet_Lookup_'
+CACHE_GENERATION              = 'homesnippets_Generation'
+CACHE_RESPONSE_PREFIX         = 'homesnippets_Response_'
+
+# Rule changes are numbered from a counter started at the time, in
+# milliseconds, shifted up by RULE_SEQ_BITS. If the counter is lost and
+# started over, the numbers it hands out next are from a new epoch, so they
+# can't be mistaken for changes already applied.
+RULE_SEQ_BITS = 20
+
+# Families of cache entries counted with CACHE_STATS, and their key prefixes.
+CACHE_FAMILIES = (
+    ('rules',    CACHE_RULE_ALL_PREFIX),
+    ('match',    CACHE_RULE_MATCH_PREFIX),
+    ('lookup',   CACHE_SNIPPET_LOOKUP_PREFIX),
+    ('response', CACHE_RESPONSE_PREFIX),
+)
 
 
-def _key_from_client(args):
-    plain = '|'.join(['%s=%s'%(k,v) for k,v in args.items()])
+def _key_from_client(args, index=None):
+    """Hash of request args, in a stable order.
+
+    Given a rule index, match fields are replaced by the equivalence classes
+    of their values under that index's rules, which leaves out fields no rule
+    refers to and maps every client the rules can't tell apart to one key.
+    """
+    if index is None:
+        parts = ['%s=%s' % (k, args[k]) for k in sorted(args.keys())]
+    else:
+        parts = ['%s=%s' % (k, args[k]) for k in sorted(args.keys())
+                 if k not in MATCH_FIELDS]
+        parts.append('rules=%s' % index.token)
+        fields = [f for f in MATCH_FIELDS if f in index.referenced_fields]
+        parts.extend('%s=%s' % (f, c is not None and '%x' % c or '-')
+                     for f, c in zip(fields, index.class_vector(args)))
+    plain = '|'.join(parts)
     return hashlib.md5(plain.encode('UTF-8')).hexdigest()
 
 
+def _match_lastmod_keys(cache_hit):
+    """Lastmod keys that invalidate a cached rule match if newer than it."""
+    keys = [ '%s%s' % (CACHE_RULE_LASTMOD_PREFIX, item)
+             for sublist in cache_hit[1] for item in sublist ]
+    keys.append(CACHE_RULE_NEW_LASTMOD_PREFIX)
+    return keys
+
+
+def _lookup_lastmod_keys(cache_hit):
+    """Lastmod keys that invalidate a cached snippet lookup if newer than it:
+    include rules, snippets found or dropped by exclude rules, and new rule
+    creation.
+
+    Snippets are found through include rules, which get bumped along with
+    the snippets using them. A snippet can only be dropped by an exclude
+    rule if it was found, so the IDs of dropped snippets are kept in the
+    entry, and bumping them covers exclude rules.
+    """
+    keys = [ '%s%s' % (CACHE_RULE_LASTMOD_PREFIX, rule_id)
+             for rule_id in bit_positions(cache_hit[1][0]) ]
+    keys.extend([ '%s%s' % (CACHE_SNIPPET_LASTMOD_PREFIX, item['id'])
+                  for item in cache_hit[2] ])
+    keys.extend([ '%s%s' % (CACHE_SNIPPET_LASTMOD_PREFIX, snippet_id)
+                  for snippet_id in cache_hit[3] ])
+    keys.append(CACHE_RULE_NEW_LASTMOD_PREFIX)
+    return keys
+
+
+def _empty_lookup():
+    """Snippet lookup entry for a client matching no rules at all, for
+    which there's nothing to look up."""
+    return ( None, (0, 0), [], (), )
+
+
+def _is_fresh(cache_hit, lastmod_keys, lastmods):
+    """Is a cache entry newer than all of the given lastmods?"""
+    for key in lastmod_keys:
+        if lastmods.get(key) > cache_hit[0]:
+            return False
+    return True
+
+
+def _check_lookup(cache_hit):
+    """Cached snippet lookup if still current, or None."""
+    if _is_flushed('lookup', cache_hit[0]):
+        return None
+    if not CACHE_GENERATIONS and _lookup_changed(cache_hit):
+        return None
+    return cache_hit
+
+
+def _lookup_changed(cache_hit):
+    """When the newest change to anything a cached snippet lookup was made
+    from happened, if since it was cached, or else None."""
+    # Invalidate if any of the lastmods of related rules, snippets, or new
+    # rule creation is newer than the cache
+    lastmod_keys = _lookup_lastmod_keys(cache_hit)
+    lastmods = cache.get_many(lastmod_keys)
+    newer = [ lastmods[key] for key in lastmod_keys
+              if lastmods.get(key) > cache_hit[0] ]
+    return newer and max(newer) or None
+
+
+def _next_date_change(snippets, time_now):
+    """Earliest time after time_now that one of snippets starts or ends
+    publication, or None."""
+    changes = [ date for s in snippets for date in (s['pub_start'], s['pub_end'])
+                if date and date > time_now ]
+    return changes and min(changes) or None
+
+
+def _response_cache_key(args, index):
+    """Cache key for the rendered response to a client, under a rule index.
+
+    Like rule matches, responses are keyed by the equivalence classes of the
+    client's values under the rules (see _key_from_client), so eg. every
+    new appbuildid the rules don't tell apart shares one response. An entry
+    looked up under an out of date index gets invalidated by the rule
+    changes since, and new entries are stored under a fresh index.
+    """
+    return '%s%s' % (CACHE_RESPONSE_PREFIX, _key_from_client(args, index))
+
+
+def _response_entry(lookup, rule_seq, generation, generated, time_now,
+                    rendered):
+    """Cache entry for a rendered response made from the snippets of a
+    snippet lookup entry, found at the time generated with rules current as
+    of rule change rule_seq, or later.
+
+    Entries start with the time generated, the lastmod keys to check and
+    the rule change they are current as of, or with CACHE_GENERATIONS, the
+    generation and the time generated."""
+    if CACHE_GENERATIONS:
+        cache_hit = ( generation, mktime(generated), None, )
+    else:
+        lastmod_keys = _lookup_lastmod_keys(lookup)
+        # Any change to rules may change which ones match. With
+        # RULE_DELTAS, this is only bumped for changes that couldn't be
+        # logged.
+        lastmod_keys.append(CACHE_RULE_ALL_LASTMOD_PREFIX)
+        if not RULE_DELTAS:
+            rule_seq = None
+        cache_hit = ( mktime(generated), lastmod_keys, rule_seq, )
+    return cache_hit + ( _next_date_change(lookup[2], time_now), rendered, )
+
+
+def _is_response_fresh(cache_hit):
+    """Is a cached rendered response newer than the lastmods of everything
+    it was made from? With RULE_DELTAS, it must also be current as of the
+    latest rule change."""
+    lastmod_keys = cache_hit[1]
+    if RULE_DELTAS:
+        lastmod_keys = lastmod_keys + [ CACHE_RULE_DELTA_SEQ ]
+    lastmods = cache.get_many(lastmod_keys)
+    if RULE_DELTAS:
+        rule_seq = lastmods.pop(CACHE_RULE_DELTA_SEQ, 0)
+        if cache_hit[2] != rule_seq:
+            return False
+    elif cache_hit[2] is not None:
+        return False
+    return _is_fresh(cache_hit, cache_hit[1], lastmods)
+
+
+def _current_generation():
+    """Content generation number with CACHE_GENERATIONS, or None."""
+    if not CACHE_GENERATIONS:
+        return None
+    generation = cache.get(CACHE_GENERATION)
+    if generation is None:
+        # A lost counter restarts from the clock, so as not to come back
+        # round to generations that entries are still cached under.
+        cache.add(CACHE_GENERATION, int(time() * 1000), CACHE_TIMEOUT)
+        generation = cache.get(CACHE_GENERATION)
+    return generation
+
+
+def _bump_generation():
+    """Move on to a new content generation, with CACHE_GENERATIONS."""
+    if not CACHE_GENERATIONS:
+        return
+    try:
+        cache.incr(CACHE_GENERATION)
+    except ValueError:
+        cache.add(CACHE_GENERATION, int(time() * 1000), CACHE_TIMEOUT)
+
+
+if LOCAL_CACHE_SIZE and not CACHE_GENERATIONS:
+    raise ImproperlyConfigured('SNIPPET_LOCAL_CACHE_SIZE requires '
+                               'SNIPPET_CACHE_GENERATIONS')
+
+local_cache = (LOCAL_CACHE_SIZE and
+               LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL) or None)
+
+
+def _local_get(key, generation):
+    """Entry for key from the in-process cache, if any for generation."""
+    if local_cache is None or generation is None:
+        return None
+    return local_cache.get(key, generation)
+
+
+def _local_set(key, value, generation):
+    """Keep an entry in the in-process cache, stamped with generation."""
+    if local_cache is not None and generation is not None:
+        local_cache.set(key, value, generation)
+
+
+cache_stats = (CACHE_STATS and
+               CacheStats([ family for family, prefix in CACHE_FAMILIES ],
+                          CACHE_STATS_INTERVAL, CACHE_TIMEOUT,
+                          sample=CACHE_STATS_SAMPLE) or None)
+
+
+def _count(family, **events):
+    """Count cache events for a family of entries, with CACHE_STATS."""
+    if cache_stats is not None:
+        cache_stats.count(cache, family, **events)
+
+
+def _count_sets(family, values):
+    """Count values cached in a family of entries, with CACHE_STATS."""
+    if cache_stats is not None:
+        cache_stats.count_sets(cache, family, values)
+
+
+def _is_flushed(family, cached_at):
+    """Was an entry cached at cached_at flushed from the admin since?"""
+    return cache_stats is not None and \
+        cache_stats.is_flushed(cache, family, cached_at)
+
+
+def _response_time(cache_hit):
+    """Time a cached rendered response was generated at."""
+    return CACHE_GENERATIONS and cache_hit[1] or cache_hit[0]
+
+
+refresh_pool = None
+refresh_pool_lock = threading.Lock()
+
+
+def _refresh_pool():
+    """Pool of REFRESH_THREADS threads for refreshing stale cache entries,
+    started on first use."""
+    global refresh_pool
+    refresh_pool_lock.acquire()
+    try:
+        if refresh_pool is None:
+            refresh_pool = ThreadPool(REFRESH_THREADS)
+        return refresh_pool
+    finally:
+        refresh_pool_lock.release()
+
+
+def _recompute(cache_key, compute, check, previous=None):
+    """Recompute the value for cache_key with compute(), guarded against
+    stampedes with CACHE_LOCKS. See caches.single_flight()."""
+    if not CACHE_LOCKS:
+        return compute()
+    return single_flight(cache, cache_key, compute, check, previous,
+                         CACHE_LOCK_LEASE, CACHE_LOCK_WAIT, CACHE_LOCK_RETRIES)
+
+
+def _build_engine(name, index):
+    """Wrap a rule index in the named matching engine."""
+    if name == 'indexed':
+        return index
+    if name == 'scan':
+        return ScanEngine(index)
+    if name == 'vectorized':
+        if vectorized.numpy is None:
+            raise ImproperlyConfigured('The vectorized snippet match engine '
+                                       'requires numpy')
+        return vectorized.VectorizedRuleSet(index)
+    raise ImproperlyConfigured('Unknown snippet match engine: %s' % name)
+
+
 class ClientMatchRuleManager(models.Manager):
     """Manager for client match rules, allows filtering against match logic"""
 
-    def find_match_ids_for_request(self, args):
+    # Compiled matchers are reused across requests for as long as the rules
+    # they were compiled from stay the same.
+    matcher_cache = MatcherCache()
+
+    # Cache token, index and match engine for the last set of all rules
+    # seen, and with RULE_DELTAS the sequence number of the last rule change
+    # applied to them. Changes are applied to a copy of the index, one thread
+    # at a time holding rule_lock, and the whole tuple swapped, so requests
+    # using it always see an index and sequence number that go together.
+    rule_index = (None, None, None, 0)
+
+    # With RULE_DELTAS, the sequence number the snapshot of the index was
+    # loaded at and the (sequence number, rule ID) of each change applied
+    # since, and the time the snapshot was cached. Both are replaced before
+    # rule_index, so they always cover the index a request is using.
+    rule_log = (0, ())
+    rule_cached_at = None
+    rule_lock = threading.Lock()
+
+    # Reference and candidate engines for shadow comparisons, along with the
+    # cache token and (with RULE_DELTAS) the last rule change of the rules
+    # they were built for, and running totals of the comparisons made.
+    shadow_engines = (None, None, None)
+    shadow_stats = dict(compared=0, mismatched=0, reference_seconds=0.0,
+                        candidate_seconds=0.0)
+
+    def find_match_ids_for_request(self, args, generation=None):
         """
         Finds all match rules that affect the given request. Returns two lists
         containing the rules that will exclude or include snippets in the
         response.
+
+        With CACHE_GENERATIONS, generation is the current content generation,
+        if already looked up.
         """
+        if generation is None:
+            generation = _current_generation()
 
-        cache_key = '%s%s' % (CACHE_RULE_MATCH_PREFIX, _key_from_client(args))
-        cache_hit = cache.get(cache_key)
-
-        if cache_hit:
-            # If since caching this hit, any of the rules involved were
-            # modified or if any new rules were created, invalidate the results.
-            lastmod_keys = [
-                '%s%s' % (CACHE_RULE_LASTMOD_PREFIX, item)
-                for sublist in cache_hit[1] for item in sublist
-            ]
-            lastmod_keys.append(CACHE_RULE_NEW_LASTMOD_PREFIX)
-            lastmods = cache.get_many(lastmod_keys).values()
-            newer_lastmods = [ m for m in lastmods if m > cache_hit[0] ]
-            if newer_lastmods:
-                cache_hit = None
+        if RULE_DELTAS:
+            # Rule changes are applied up front, so the index is current.
+            index, engine, seq = self._cached_index()
+        else:
+            index, engine, seq = self.rule_index[1:]
+        cache_key = self._match_cache_key(args, index, generation)
+        local_hit = _local_get(cache_key, generation)
+        if local_hit is not None:
+            _count('match', hits=1)
+            return local_hit
+        stale = cache.get(cache_key)
+        cache_hit = stale and self._check_match(cache_key, stale, args, index,
+                                                seq)
+        _count('match', hits=cache_hit and 1, misses=not stale and 1,
+               invalidations=stale and not cache_hit and 1)
 
         if not cache_hit:
             # Cache miss, so recalculate the results and cache them.
-            rules = self._cached_all()
-            include_ids, exclude_ids = [], []
-
-            # Check every rule
-            for rule in rules:
-                if rule.is_match(args):
-                    if rule.exclude:
-                        exclude_ids.append(str(rule.id))
-                    else:
-                        include_ids.append(str(rule.id))
-                elif not rule.exclude:
-                    # Include rule that doesn't match? Add as an exclude rule
-                    # so that snippets can split required matches into multiple
-                    # rules and combine them together.
-                    exclude_ids.append(str(rule.id))
-
-            cache_hit = (mktime(gmtime()), (include_ids, exclude_ids))
-            cache.set(cache_key, cache_hit, CACHE_TIMEOUT)
-
+            if not RULE_DELTAS:
+                index, engine, seq = self._cached_index()
+            cache_key = self._match_cache_key(args, index, generation)
+
+            def compute():
+                cache_hit = self._match_entry(self._partition_many(engine,
+                                                                   [args])[0],
+                                              seq)
+                cache.set(cache_key, cache_hit, CACHE_TIMEOUT)
+                _count_sets('match', [cache_hit])
+                return cache_hit
+
+            def check():
+                cache_hit = cache.get(cache_key)
+                return cache_hit and self._check_match(cache_key, cache_hit,
+                                                       args, index, seq)
+
+            cache_hit = _recompute(cache_key, compute, check, stale)
+
+        _local_set(cache_key, cache_hit[1], generation)
         return cache_hit[1]
 
-    def _cached_all(self):
-        """Cached version of self.all(), invalidated by change to any rule."""
+    def _check_match(self, cache_key, cache_hit, args, index, seq):
+        """Cached rule match if still current, brought up to date with
+        RULE_DELTAS as of the index at rule change seq, or None if out of
+        date."""
+        if _is_flushed('match', cache_hit[0]):
+            return None
+        if CACHE_GENERATIONS:
+            # Any change since would have moved on to another key.
+            return cache_hit
+        if RULE_DELTAS:
+            return self._patch_match(cache_key, cache_hit, args, index, seq)
+        # If since caching this hit, any of the rules involved were modified
+        # or if any new rules were created, invalidate the results.
+        lastmod_keys = _match_lastmod_keys(cache_hit)
+        lastmods = cache.get_many(lastmod_keys)
+        if not _is_fresh(cache_hit, lastmod_keys, lastmods):
+            return None
+        return cache_hit
+
+    def find_match_ids_for_requests(self, args_list, generation=None):
+        """
+        Batch version of find_match_ids_for_request(), returning a list of
+        (include_ids, exclude_ids) pairs in the same order as args_list.
+
+        Cached matches are fetched with one get_many, validated with another,
+        and misses are stored with one set_many. Requests that are the same
+        as far as the rules can tell share a single evaluation.
+        """
+        if generation is None:
+            generation = _current_generation()
+        if RULE_DELTAS:
+            index, engine, seq = self._cached_index()
+        else:
+            index, engine, seq = self.rule_index[1:]
+        keys = [ self._match_cache_key(args, index, generation)
+                 for args in args_list ]
+        cache_hits = cache.get_many(list(set(keys)))
+        for key, cache_hit in cache_hits.items():
+            if _is_flushed('match', cache_hit[0]):
+                del cache_hits[key]
+
+        results = {}
+        if CACHE_GENERATIONS:
+            for key, cache_hit in cache_hits.items():
+                results[key] = cache_hit[1]
+
+        elif RULE_DELTAS:
+            for key, args in zip(keys, args_list):
+                if key in cache_hits and key not in results:
+                    cache_hit = self._patch_match(key, cache_hits[key], args,
+                                                  index, seq)
+                    if cache_hit:
+                        results[key] = cache_hit[1]
+
+        else:
+            lastmod_keys = set()
+            for cache_hit in cache_hits.values():
+                lastmod_keys.update(_match_lastmod_keys(cache_hit))
+            lastmods = (lastmod_keys and cache.get_many(list(lastmod_keys))
+                        or {})
+
+            for key, cache_hit in cache_hits.items():
+                if _is_fresh(cache_hit, _match_lastmod_keys(cache_hit),
+                             lastmods):
+                    results[key] = cache_hit[1]
+
+        _count('match', hits=len(results),
+               misses=len(set(keys)) - len(cache_hits),
+               invalidations=len(cache_hits) - len(results))
+
+        missed = [ (key, args) for key, args in zip(keys, args_list)
+                   if key not in results ]
+        if missed:
+            if not RULE_DELTAS:
+                index, engine, seq = self._cached_index()
+            groups = {}
+            for key, args in missed:
+                fresh_key = self._match_cache_key(args, index, generation)
+                groups.setdefault(fresh_key, (args, []))[1].append(key)
+
+            fresh_keys = groups.keys()
+            partitions = self._partition_many(engine, [ groups[fresh_key][0]
+                                                   for fresh_key in fresh_keys ])
+            new_hits = {}
+            for fresh_key, partition in zip(fresh_keys, partitions):
+                new_hits[fresh_key] = self._match_entry(partition, seq)
+                for key in groups[fresh_key][1]:
+                    results[key] = partition
+            cache.set_many(new_hits, CACHE_TIMEOUT)
+            _count_sets('match', new_hits.values())
+
+        return [ results[key] for key in keys ]
+
+    def _match_cache_key(self, args, index=None, generation=None):
+        """Cache key for the rules matching args.
+
+        Keys are made from the equivalence classes of the args' values under
+        the current rules (see _key_from_client), so clients differing only
+        in values no rule tells apart share an entry. The index used to look
+        up an entry may be out of date, but anything cached under a key
+        derived from it gets invalidated by the same rule changes that would
+        have changed it, and misses are always stored under a key derived
+        from a fresh index.
+        """
+        if generation is not None:
+            return '%s%s_%s' % (CACHE_RULE_MATCH_PREFIX, generation,
+                                _key_from_client(args, index))
+        return '%s%s' % (CACHE_RULE_MATCH_PREFIX,
+                         _key_from_client(args, index))
+
+    def _partition_many(self, engine, args_list):
+        """Partition rules for each of args_list with engine. With
+        SHADOW_ENGINE, a sample of them get compared across the reference
+        and candidate engines too, without ever failing the request."""
+        partitions = engine.partition_many(args_list)
+        if SHADOW_ENGINE:
+            for args in args_list:
+                if random.random() < SHADOW_RATE:
+                    try:
+                        self._shadow_compare(args)
+                    except Exception:
+                        shadow_log.exception('Shadow comparison failed for '
+                                             '%r' % (args,))
+        return partitions
+
+    def _shadow_compare(self, args):
+        """Partition args with the reference and the candidate engines, and
+        log their timings and any difference between their results."""
+        token, index, engine, seq = self.rule_index
+        # Rule changes applied with RULE_DELTAS keep the token.
+        version = (index.token, seq)
+        if self.shadow_engines[0] != version:
+            self.shadow_engines = (version, ScanEngine(index),
+                                   _build_engine(SHADOW_ENGINE, index))
+        reference, candidate = self.shadow_engines[1:]
+
+        timings, results = [], []
+        for engine in (reference, candidate):
+            start = default_timer()
+            results.append(engine.partition(args))
+            timings.append(default_timer() - start)
+
+        stats = self.shadow_stats
+        stats['compared'] += 1
+        stats['reference_seconds'] += timings[0]
+        stats['candidate_seconds'] += timings[1]
+        shadow_log.debug('Matched in %.1fus by reference, %.1fus by %s' % (
+            timings[0] * 1e6, timings[1] * 1e6, SHADOW_ENGINE))
+
+        differences = []
+        for name, expected, found in zip(('include', 'exclude'), *results):
+            expected, found = set(expected), set(found)
+            if expected != found:
+                differences.append('%s missing %s, extra %s' % (
+                    name, sorted(expected - found), sorted(found - expected)))
+        if differences:
+            stats['mismatched'] += 1
+            shadow_log.warning('Engine %s differs from reference for %r: %s'
+                               % (SHADOW_ENGINE, args, '; '.join(differences)))
+
+    def _match_entry(self, partition, seq):
+        """Cache entry for a rule match, tagged when RULE_DELTAS is on with
+        seq, the rule change of the index it was computed with."""
+        if RULE_DELTAS:
+            return (mktime(gmtime()), partition, seq)
+        return (mktime(gmtime()), partition)
+
+    def _patch_match(self, cache_key, cache_hit, args, index, seq):
+        """With RULE_DELTAS, bring a cached rule match up to date with the
+        rule changes since it was cached, up to the index at rule change
+        seq, re-checking only the changed rules. Returns None if it can't be
+        brought up to date."""
+        if len(cache_hit) < 3:
+            # Cached without RULE_DELTAS, so can't be patched.
+            return None
+        if cache_hit[0] < self.rule_cached_at:
+            # Cached before the rules were reloaded, eg. for a change that
+            # couldn't be logged, so it may be missing changes.
+            return None
+        entry_seq = cache_hit[2]
+        if entry_seq == seq:
+            return cache_hit
+        # The log is replaced before the index, so it covers seq.
+        base_seq, changes = self.rule_log
+        if not base_seq <= entry_seq < seq:
+            return None
+        changed = set(rule_id for n, rule_id in changes
+                      if entry_seq < n <= seq)
+        partition = index.update_partition(args, cache_hit[1], changed)
+        cache_hit = self._match_entry(partition, seq)
+        cache.set(cache_key, cache_hit, CACHE_TIMEOUT)
+        _count_sets('match', [cache_hit])
+        return cache_hit
+
+    def _cached_index(self):
+        """Index and match engine for all rules, rebuilt in-process only when
+        the cached snapshot of all rules changes, and with RULE_DELTAS the
+        number of the last rule change applied to them.
+
+        The in-process index is checked against the lastmod of all rules
+        first, so the snapshot only gets fetched and loaded to compare its
+        token after a change."""
+        if RULE_DELTAS:
+            self._apply_rule_changes()
+            return self.rule_index[1:]
+        if self.rule_index[1] is not None:
+            lastmod = cache.get(CACHE_RULE_ALL_LASTMOD_PREFIX)
+            if (lastmod is not None and not lastmod > self.rule_cached_at and
+                    not _is_flushed('rules', self.rule_cached_at)):
+                return self.rule_index[1:]
+        snapshot = self._cached_all()
+        if self.rule_index[0] != snapshot.token:
+            self._set_rule_index(snapshot)
+        else:
+            self.rule_cached_at = snapshot.cached_at
+        return self.rule_index[1:]
+
+    def _set_rule_index(self, snapshot):
+        index = RuleIndex(self.matcher_cache.get_matchers(snapshot.rows),
+                          FIELD_MEMO_SIZE, snapshot.token)
+        engine = _build_engine(MATCH_ENGINE, index)
+        self.rule_log = (snapshot.seq, ())
+        self.rule_cached_at = snapshot.cached_at
+        self.rule_index = (snapshot.token, index, engine, snapshot.seq)
+
+    def _rule_log_state(self):
+        """Number of the latest rule change, and whether the rule index
+        needs reloading rather than catching up: if it's missing, if the
+        change log was started over, or if all rules were invalidated since
+        its snapshot was cached, because a change couldn't be logged."""
+        c_data = cache.get_many([CACHE_RULE_ALL_LASTMOD_PREFIX,
+                                 CACHE_RULE_DELTA_SEQ])
+        seq = c_data.get(CACHE_RULE_DELTA_SEQ)
+        if seq is None:
+            seq = _start_rule_log()
+        lastmod = c_data.get(CACHE_RULE_ALL_LASTMOD_PREFIX, None)
+        reload = (self.rule_index[1] is None or
+                  _rule_epoch(seq) != _rule_epoch(self.rule_index[3]) or
+                  lastmod > self.rule_cached_at)
+        return seq, reload
+
+    def _apply_rule_changes(self):
+        """Catch the in-process rule index up with the log of rule changes
+        recorded by rule_update_lastmods, reloading all rules only if the
+        index is missing or the log doesn't reach back far enough."""
+        seq, reload = self._rule_log_state()
+        if not reload and seq <= self.rule_index[3]:
+            return
+
+        self.rule_lock.acquire()
+        try:
+            # Another thread may have caught up while this one waited.
+            seq, reload = self._rule_log_state()
+            if reload:
+                self._set_rule_index(self._cached_all(seq))
+
+            token, index, engine, index_seq = self.rule_index
+            if seq > index_seq:
+                seqs = range(index_seq + 1, seq + 1)
+                keys = [ '%s%s' % (CACHE_RULE_DELTA_PREFIX, n)
+                         for n in seqs ]
+                deltas = cache.get_many(keys)
+                if len(deltas) < len(keys):
+                    self._set_rule_index(self._cached_all(seq, rebuild=True))
+                    return
+
+                # Changes go to a copy, swapped in once complete, as other
+                # threads carry on matching with the index meanwhile.
+                index = index.copy()
+                changes = []
+                for n, key in zip(seqs, keys):
+                    rule_id, row = deltas[key]
+                    index.apply_change(rule_id,
+                                       row and compile_rule_safely(row))
+                    changes.append((n, rule_id))
+                base_seq, applied = self.rule_log
+                self.rule_log = (base_seq, applied + tuple(changes))
+                engine = _build_engine(MATCH_ENGINE, index)
+                self.rule_index = (token, index, engine, seq)
+        finally:
+            self.rule_lock.release()
+
+    def _cached_all(self, seq=0, rebuild=False):
+        """Cached RuleSnapshot of self.all(), invalidated by change to any
+        rule.
+
+        With RULE_DELTAS, seq is the number of the latest rule change, and
+        the snapshot's seq is the change it is current as of. Snapshots
+        newer than that or from another epoch must be from before the change
+        log was started over, and snapshots cached without a seq can't be
+        caught up, so all of those get rebuilt.
+        """
+        snapshot = self._load_all(seq, rebuild)
+        if not snapshot:
+            def check():
+                # A rebuild is only done once it catches up with seq.
+                snapshot = self._load_all(seq)
+                if snapshot and (not rebuild or snapshot.seq == seq):
+                    return snapshot
+
+            snapshot = _recompute(CACHE_RULE_ALL_PREFIX,
+                                  lambda: self._build_all(seq), check)
+        return snapshot
+
+    def _load_all(self, seq=0, rebuild=False):
+        """Cached RuleSnapshot of self.all() if still current, or None."""
         c_data = cache.get_many([CACHE_RULE_ALL_PREFIX,
             CACHE_RULE_ALL_LASTMOD_PREFIX])
 
@@ -110,14 +793,50 @@ class ClientMatchRuleManager(models.Manager):
         cache_hit = c_data.get(CACHE_RULE_ALL_PREFIX, None)
 
         # Entire cached set gets invalidated if any rule changed.
-        if cache_hit and lastmod > cache_hit[0]:
+        found = cache_hit
+        if cache_hit and (rebuild or lastmod > cache_hit[0] or
+                          _is_flushed('rules', cache_hit[0])):
             cache_hit = None
 
-        if not cache_hit:
-            cache_hit = ( mktime(gmtime()), self.all() )
-            cache.set(CACHE_RULE_ALL_PREFIX, cache_hit, CACHE_TIMEOUT)
-
-        return cache_hit[1]
+        snapshot = cache_hit and RuleSnapshot.load(cache_hit[1])
+        if snapshot:
+            snapshot.cached_at = cache_hit[0]
+            if lastmod is None:
+                # Lost, so stamp the snapshot for in-process rule indexes to
+                # check against, as _build_all() does.
+                cache.add(CACHE_RULE_ALL_LASTMOD_PREFIX, cache_hit[0],
+                          CACHE_TIMEOUT)
+        if snapshot and RULE_DELTAS:
+            snapshot.seq = cache_hit[2] if len(cache_hit) > 2 else None
+            if (snapshot.seq is None or snapshot.seq > seq or
+                    _rule_epoch(snapshot.seq) != _rule_epoch(seq)):
+                snapshot = None
+
+        # Snapshots cached in some other format, eg. by an older version of
+        # this code, get rebuilt too.
+        _count('rules', hits=snapshot and 1, misses=not found and 1,
+               invalidations=found and not snapshot and 1)
+        return snapshot or None
+
+    def _build_all(self, seq=0):
+        """Snapshot all rules afresh, and cache it.
+
+        The snapshot's token is a hash of its rows, so that processes
+        loading snapshots of the same rules, eg. after one was evicted and
+        rebuilt, build indexes with the same token and share match cache
+        keys."""
+        snapshot = RuleSnapshot.from_rules(self.all())
+        cache_hit = ( mktime(gmtime()), snapshot.dump() )
+        snapshot.cached_at = cache_hit[0]
+        # Stamp for in-process rule indexes to check against, if no rule has
+        # changed since it was lost.
+        cache.add(CACHE_RULE_ALL_LASTMOD_PREFIX, cache_hit[0], CACHE_TIMEOUT)
+        if RULE_DELTAS:
+            snapshot.seq = seq
+            cache_hit += ( seq, )
+        cache.set(CACHE_RULE_ALL_PREFIX, cache_hit, CACHE_TIMEOUT)
+        _count_sets('rules', [cache_hit])
+        return snapshot
 
 
 class ClientMatchRule(models.Model):
@@ -175,29 +894,26 @@ class ClientMatchRule(models.Model):
                 '/'.join(vals)
             )
 
+    def clean(self):
+        """Reject field values that can't be compiled, eg. broken regexes, and
+        regexes prone to catastrophic backtracking."""
+        for field in MATCH_FIELDS:
+            verbose_name = self._meta.get_field(field).verbose_name
+            try:
+                condition = compile_condition(field, getattr(self, field))
+            except RuleCompileError as e:
+                raise ValidationError(u'Invalid %s: %s' % (verbose_name,
+                                                           e.reason))
+            if isinstance(condition, RegexCondition):
+                hazards = regex_hazards(condition.pattern)
+                if hazards:
+                    raise ValidationError(u'Slow %s regex: %s' % (
+                        verbose_name, '; '.join(hazards)))
+
     def is_match(self, args):
-        is_match = True
-        for ak,av in args.items():
-            mv = getattr(self, ak, None)
-            if not mv:
-                continue
-
-            if mv.startswith('/'):
-                # Regex match
-                import re
-                try:
-                    p = re.compile(mv[1:-1])
-                    if p.match(av) is None:
-                        is_match = False
-                except re.error:
-                    # TODO: log error? validate regex in form submit?
-                    is_match = False
-
-            elif av != mv:
-                # Exact match
-                is_match = False
-
-        return is_match
+        """Does this rule match the given URL segment args? Invalid rules
+        never match."""
+        return compile_rule_safely(rule_row(self)).is_match(args)
 
     def related_snippets(self):
         """HTML link to snippets covered by this client match rule"""
@@ -220,23 +936,77 @@ class ClientMatchRule(models.Model):
 
 def rule_update_lastmods(sender, instance, created=False, **kwargs):
     """On a change to a rule, bump lastmod timestamps for that rule and the set
-    of all cached rules."""
+    of all cached rules. With RULE_DELTAS, the change is logged for rule
+    indexes to pick up instead of invalidating the set of all rules, unless
+    it can't be logged."""
     now = mktime(gmtime())
     lastmods = {
         # Timestamp for this rule.
         '%s%s' % (CACHE_RULE_LASTMOD_PREFIX, instance.id): now,
-        # Timestamp for set of all rules.
-        CACHE_RULE_ALL_LASTMOD_PREFIX: now,
     }
+    deleted = kwargs.get('signal') is post_delete
+    if not (RULE_DELTAS and _log_rule_change(
+            instance.id, not deleted and rule_row(instance) or None)):
+        # Timestamp for set of all rules.
+        lastmods[CACHE_RULE_ALL_LASTMOD_PREFIX] = now
     if created:
         # Update timestamp since last new rule created.
         lastmods[CACHE_RULE_NEW_LASTMOD_PREFIX] = now
     cache.set_many(lastmods, CACHE_TIMEOUT)
+    _bump_generation()
+
+
+def _rule_epoch(seq):
+    """Epoch of a rule change number, see RULE_SEQ_BITS."""
+    return seq >> RULE_SEQ_BITS
+
+
+def _start_rule_log():
+    """Start the log of rule changes over in a new epoch, unless someone
+    else just has, and return the number of its latest change, or 0 with the
+    cache down. Starting over makes rule indexes reload all rules."""
+    cache.add(CACHE_RULE_DELTA_SEQ, int(time() * 1000) << RULE_SEQ_BITS,
+              CACHE_TIMEOUT)
+    return cache.get(CACHE_RULE_DELTA_SEQ) or 0
+
+
+def _log_rule_change(rule_id, row):
+    """Append a change to a rule to the log of rule changes, as its rule
+    row, or None if it was deleted. Returns whether the change was logged,
+    which it can't be with the cache server for the log down."""
+    start = int(time() * 1000) << RULE_SEQ_BITS
+    cache.add(CACHE_RULE_DELTA_SEQ, start, CACHE_TIMEOUT)
+    try:
+        seq = cache.incr(CACHE_RULE_DELTA_SEQ)
+    except ValueError:
+        # Evicted since the add, or the server is down.
+        cache.add(CACHE_RULE_DELTA_SEQ, start, CACHE_TIMEOUT)
+        try:
+            seq = cache.incr(CACHE_RULE_DELTA_SEQ)
+        except ValueError:
+            return False
+    cache.set('%s%s' % (CACHE_RULE_DELTA_PREFIX, seq), (str(rule_id), row),
+              CACHE_TIMEOUT)
+    return True
+
 
 post_save.connect(rule_update_lastmods, sender=ClientMatchRule)
 post_delete.connect(rule_update_lastmods, sender=ClientMatchRule)
 
 
+def _filter_by_date(snippets, time_now):
+    """Drop snippets outside of their publication dates at time_now."""
+    # Filter for date ranges here, rather than in SQL.
+    #
+    # This is a compromise to make snippet match results more cacheable -
+    # ie. cached data should only be recalculated in response to content
+    # changes, not the passage of time.
+    return [ s for s in snippets if (
+        ( not s['pub_start'] or time_now >= s['pub_start'] ) and
+        ( not s['pub_end']   or time_now <  s['pub_end'] )
+    ) ]
+
+
 class SnippetManager(models.Manager):
 
     def find_snippets_with_match_rules(self, args, time_now=None):
@@ -250,99 +1020,330 @@ class SnippetManager(models.Manager):
             time_now = datetime.now()
 
         preview = ( 'preview' in args ) and args['preview']
+        generation = _current_generation()
         include_ids, exclude_ids = \
-            ClientMatchRule.objects.find_match_ids_for_request(args)
-        snippets = self.find_snippets_for_rule_ids(preview, include_ids, exclude_ids)
-
-        # Filter for date ranges here, rather than in SQL.
-        #
-        # This is a compromise to make snippet match results more cacheable -
-        # ie. cached data should only be recalculated in response to content
-        # changes, not the passage of time.
-        snippets_data = [ s for s in snippets if (
-            ( not s['pub_start'] or time_now >= s['pub_start'] ) and
-            ( not s['pub_end']   or time_now <  s['pub_end'] )
-        ) ]
-
-        return snippets_data
-
-    def find_snippets_for_rule_ids(self, preview, include_ids, exclude_ids):
+            ClientMatchRule.objects.find_match_ids_for_request(args,
+                                                               generation)
+        snippets = self.find_snippets_for_rule_ids(preview, include_ids,
+                                                   exclude_ids, generation)
+
+        return _filter_by_date(snippets, time_now)
+
+    def find_snippets_with_match_rules_many(self, args_list, time_now=None):
+        """Batch version of find_snippets_with_match_rules(), returning a list
+        of snippet data lists in the same order as args_list."""
+        if time_now is None:
+            time_now = datetime.now()
+
+        generation = _current_generation()
+        matches = ClientMatchRule.objects.find_match_ids_for_requests(
+            args_list, generation)
+        lookups = [ (( 'preview' in args ) and args['preview'],
+                     include_ids, exclude_ids)
+                    for args, (include_ids, exclude_ids)
+                    in zip(args_list, matches) ]
+        return [ _filter_by_date(snippets, time_now) for snippets
+                 in self.find_snippets_for_rule_ids_many(lookups, generation) ]
+
+    def find_rendered_snippets(self, args, render, time_now=None):
+        """Find snippets using match rules, and render them with
+        render(snippets, generated), where generated is the time the snippets
+        were found at.
+
+        With RESPONSE_CACHE, whatever render returns is cached for the
+        client's args, until the content changes in a way that would
+        invalidate its snippet lookup, or until one of the snippets found
+        starts or ends publication. With CACHE_GENERATIONS, a hit costs a
+        single get_many.
+        """
+        if time_now is None:
+            time_now = datetime.now()
+        if not RESPONSE_CACHE:
+            return render(self.find_snippets_with_match_rules(args, time_now),
+                          gmtime())
+
+        rules = ClientMatchRule.objects
+        if RULE_DELTAS or rules.rule_index[1] is None:
+            index, engine, rule_seq = rules._cached_index()
+        else:
+            index, engine, rule_seq = rules.rule_index[1:]
+        cache_key = _response_cache_key(args, index)
+        generation = None
+        if CACHE_GENERATIONS:
+            c_data = cache.get_many([CACHE_GENERATION, cache_key])
+            found = cache_hit = c_data.get(cache_key)
+            generation = c_data.get(CACHE_GENERATION)
+            if cache_hit and cache_hit[0] != generation:
+                cache_hit = None
+        else:
+            found = cache_hit = cache.get(cache_key)
+            if cache_hit and not _is_response_fresh(cache_hit):
+                cache_hit = None
+
+        if cache_hit and cache_hit[3] and time_now >= cache_hit[3]:
+            # A snippet has started or ended publication since.
+            cache_hit = None
+        if cache_hit and _is_flushed('response', _response_time(cache_hit)):
+            cache_hit = None
+        _count('response', hits=cache_hit and 1, misses=not found and 1,
+               invalidations=found and not cache_hit and 1)
+
+        if not cache_hit:
+            if CACHE_GENERATIONS and generation is None:
+                generation = _current_generation()
+            if not RULE_DELTAS:
+                cache_key = _response_cache_key(args,
+                                                rules._cached_index()[0])
+            generated = gmtime()
+            preview = ( 'preview' in args ) and args['preview']
+            include_ids, exclude_ids = \
+                ClientMatchRule.objects.find_match_ids_for_request(args,
+                                                                   generation)
+            lookup = self._find_lookup(preview, include_ids, exclude_ids,
+                                       generation)
+            # Tagged with the rule change from before matching, so that a
+            # change applied meanwhile gets the response made again.
+            cache_hit = _response_entry(
+                lookup, rule_seq, generation, generated, time_now,
+                render(_filter_by_date(lookup[2], time_now), generated))
+            cache.set(cache_key, cache_hit, CACHE_TIMEOUT)
+            _count_sets('response', [cache_hit])
+
+        return cache_hit[4]
+
+    def warm_rendered_snippets(self, args_list, render, time_now=None):
+        """Find snippets for each of args_list, caching the rule matches and
+        snippet lookups in batches. With RESPONSE_CACHE, also render them as
+        for find_rendered_snippets(), and cache the responses afresh with a
+        single set_many. Returns the number of responses cached."""
+        if time_now is None:
+            time_now = datetime.now()
+
+        generation = _current_generation()
+        generated = gmtime()
+        # As for find_rendered_snippets(), responses are tagged with the rule
+        # change from before matching.
+        rule_seq = RULE_DELTAS and ClientMatchRule.objects._cached_index()[2]
+        matches = ClientMatchRule.objects.find_match_ids_for_requests(
+            args_list, generation)
+        lookups = [ (( 'preview' in args ) and args['preview'],
+                     include_ids, exclude_ids)
+                    for args, (include_ids, exclude_ids)
+                    in zip(args_list, matches) ]
+        found = self._find_lookups_many(lookups, generation)
+        if not RESPONSE_CACHE:
+            return 0
+
+        index = ClientMatchRule.objects._cached_index()[0]
+        responses = {}
+        for args, lookup in zip(args_list, found):
+            cache_key = _response_cache_key(args, index)
+            responses[cache_key] = _response_entry(
+                lookup, rule_seq, generation, generated, time_now,
+                render(_filter_by_date(lookup[2], time_now), generated))
+        cache.set_many(responses, CACHE_TIMEOUT)
+        _count_sets('response', responses.values())
+        return len(responses)
+
+    def find_snippets_for_rule_ids(self, preview, include_ids, exclude_ids,
+                                   generation=None):
         """Given a set of matching inclusion & exclusion rule IDs, look up the
         corresponding snippets."""
+        return self._find_lookup(preview, include_ids, exclude_ids,
+                                 generation)[2]
+
+    def _find_lookup(self, preview, include_ids, exclude_ids,
+                     generation=None):
+        """Snippet lookup entry for a set of rule IDs, from the cache if
+        current: the time looked up, bitsets of the include and exclude rule
+        IDs, the snippets found, and the IDs of the snippets dropped by
+        exclude rules."""
 
         if not include_ids and not exclude_ids:
-            return []
+            return _empty_lookup()
+
+        if generation is None:
+            generation = _current_generation()
+        include_bits, exclude_bits = rule_bits(include_ids), \
+                                     rule_bits(exclude_ids)
+        cache_key = self._lookup_cache_key(preview, include_bits,
+                                           exclude_bits, generation)
+        local_hit = _local_get(cache_key, generation)
+        if local_hit is not None:
+            _count('lookup', hits=1)
+            return local_hit
+        stale = cache_hit = cache.get(cache_key)
+        changed = None
+        if stale and _is_flushed('lookup', stale[0]):
+            cache_hit = None
+        elif stale and not CACHE_GENERATIONS:
+            changed = _lookup_changed(stale)
+
+        def compute():
+            snippets, dropped = self._lookup_snippets(preview, include_bits,
+                                                      exclude_bits)
+            cache_hit = ( mktime(gmtime()), (include_bits, exclude_bits),
+                          snippets, dropped, )
+            cache.set(cache_key, cache_hit, CACHE_TIMEOUT)
+            _count_sets('lookup', [cache_hit])
+            return cache_hit
+
+        if changed and changed + LOOKUP_GRACE > mktime(gmtime()):
+            # Changed only just now, so serve it as it is while it gets
+            # looked up again.
+            refresh_later(_refresh_pool(), cache, cache_key, compute,
+                          CACHE_LOCK_LEASE)
+        elif changed:
+            cache_hit = None
+        _count('lookup', hits=cache_hit and 1, misses=not stale and 1,
+               invalidations=stale and not cache_hit and 1)
 
+        if not cache_hit:
+            # No cache hit, look up the snippets associated with rules.
+            def check():
+                cache_hit = cache.get(cache_key)
+                return cache_hit and _check_lookup(cache_hit)
+
+            cache_hit = _recompute(cache_key, compute, check, stale)
+
+        _local_set(cache_key, cache_hit, generation)
+        return cache_hit
+
+    def find_snippets_for_rule_ids_many(self, lookups, generation=None):
+        """Batch version of find_snippets_for_rule_ids(), given a list of
+        (preview, include_ids, exclude_ids) tuples. Returns a list of snippet
+        data lists in the same order."""
+        return [ lookup[2] for lookup
+                 in self._find_lookups_many(lookups, generation) ]
+
+    def _find_lookups_many(self, lookups, generation=None):
+        """Batch version of _find_lookup(), for a list of (preview,
+        include_ids, exclude_ids) tuples."""
+        if generation is None:
+            generation = _current_generation()
+        lookups = [ (preview, rule_bits(include_ids), rule_bits(exclude_ids))
+                    for preview, include_ids, exclude_ids in lookups ]
+        keys = [ (include_bits or exclude_bits) and
+                 self._lookup_cache_key(preview, include_bits, exclude_bits,
+                                        generation)
+                 or None
+                 for preview, include_bits, exclude_bits in lookups ]
+        cache_hits = cache.get_many(list(set(key for key in keys if key)))
+        for key, cache_hit in cache_hits.items():
+            if _is_flushed('lookup', cache_hit[0]):
+                del cache_hits[key]
+
+        lastmod_keys = set()
+        if not CACHE_GENERATIONS:
+            for cache_hit in cache_hits.values():
+                lastmod_keys.update(_lookup_lastmod_keys(cache_hit))
+        lastmods = lastmod_keys and cache.get_many(list(lastmod_keys)) or {}
+
+        results = { None: _empty_lookup() }
+        for key, cache_hit in cache_hits.items():
+            if CACHE_GENERATIONS or _is_fresh(
+                    cache_hit, _lookup_lastmod_keys(cache_hit), lastmods):
+                results[key] = cache_hit
+        unique = len(set(key for key in keys if key))
+        _count('lookup', hits=len(results) - 1,
+               misses=unique - len(cache_hits),
+               invalidations=len(cache_hits) - len(results) + 1)
+
+        now = mktime(gmtime())
+        new_hits = {}
+        for key, (preview, include_bits, exclude_bits) in zip(keys, lookups):
+            if key not in results:
+                snippets, dropped = self._lookup_snippets(
+                    preview, include_bits, exclude_bits)
+                results[key] = new_hits[key] = (
+                    now, (include_bits, exclude_bits), snippets, dropped)
+        if new_hits:
+            cache.set_many(new_hits, CACHE_TIMEOUT)
+            _count_sets('lookup', new_hits.values())
+
+        return [ results[key] for key in keys ]
+
+    def _lookup_cache_key(self, preview, include_bits, exclude_bits,
+                          generation=None):
+        """Cache key for the snippets found for a set of rules, as bitsets of
+        rule IDs."""
         # Could base the cache key on the entire text of the SQL query
         # constructed below, but we might someday use something other than a DB
         # for persistence.
-        cache_key = '%s%s' % ( CACHE_SNIPPET_LOOKUP_PREFIX, hashlib.md5(
-            'include:%s;exclude:%s;preview:%s' % (
-                ','.join(include_ids), ','.join(exclude_ids), preview)
-        ).hexdigest() )
-        cache_hit = cache.get(cache_key)
-
-        if cache_hit:
-            # Invalidate if any of the lastmods of related rules, snippets, or
-            # new rule creation is newer than the cache
-            keys = [ '%s%s' % (CACHE_RULE_LASTMOD_PREFIX, item)
-                for sublist in cache_hit[1] for item in sublist ]
-            keys.extend([ '%s%s' % (CACHE_SNIPPET_LASTMOD_PREFIX, item['id'])
-                for item in cache_hit[2] ])
-            keys.append(CACHE_RULE_NEW_LASTMOD_PREFIX)
-            lastmods = cache.get_many(keys).values()
-            newer_lastmods = [ m for m in lastmods if m > cache_hit[0] ]
-            if newer_lastmods:
-                cache_hit = None
-
-        if not cache_hit:
-            # No cache hit, look up the snippets associated with rules.
-            sql_base = """
-                SELECT homesnippets_snippet.*
-                FROM homesnippets_snippet
-                WHERE ( %s )
-                ORDER BY priority, pub_start, modified
-            """
-            where = [
-                '( homesnippets_snippet.disabled <> 1 )',
-            ]
-            if not preview:
-                where.append('( homesnippets_snippet.preview <> 1 )')
-            if include_ids:
-                where.append("""
-                    homesnippets_snippet.id IN (
-                        SELECT snippet_id
-                        FROM homesnippets_snippet_client_match_rules
-                        WHERE clientmatchrule_id IN (%s)
-                    )
-                """ % ",".join(include_ids))
-            if exclude_ids:
-                where.append("""
-                    homesnippets_snippet.id NOT IN (
-                        SELECT snippet_id
-                        FROM homesnippets_snippet_client_match_rules
-                        WHERE clientmatchrule_id IN (%s)
-                    )
-                """ % ",".join(exclude_ids))
-            sql = sql_base % (' AND '.join(where))
-
-            # Reduce snippet model objects to more cacheable dicts
-            snippet_objs = self.raw(sql)
-            snippets = [
-                dict(
-                    id=snippet.id,
-                    name=snippet.name,
-                    body=snippet.body,
-                    country=snippet.country,
-                    pub_start=snippet.pub_start,
-                    pub_end=snippet.pub_end,
+        key = hashlib.md5('include:%x;exclude:%x;preview:%s' % (
+            include_bits, exclude_bits, preview)
+        ).hexdigest()
+        if generation is not None:
+            return '%s%s_%s' % ( CACHE_SNIPPET_LOOKUP_PREFIX, generation, key )
+        return '%s%s' % ( CACHE_SNIPPET_LOOKUP_PREFIX, key )
+
+    def _lookup_snippets(self, preview, include_bits, exclude_bits):
+        """Look up the snippets associated with rules in the DB, as a list of
+        dicts, along with the IDs of the snippets dropped by exclude rules.
+
+        Rules are given as bitsets of rule IDs. Only include rules go into
+        the query, and snippets with any of the exclude rules are dropped
+        here, by the rules of each snippet found, so the query doesn't grow
+        with every include rule a client fails to match. Without any include
+        rules, only snippets with no include rules are queried.
+        """
+        sql_base = """
+            SELECT homesnippets_snippet.*
+            FROM homesnippets_snippet
+            WHERE ( %s )
+            ORDER BY priority, pub_start, modified, id
+        """
+        where = [
+            '( homesnippets_snippet.disabled <> 1 )',
+        ]
+        if not preview:
+            where.append('( homesnippets_snippet.preview <> 1 )')
+        if include_bits:
+            where.append("""
+                homesnippets_snippet.id IN (
+                    SELECT snippet_id
+                    FROM homesnippets_snippet_client_match_rules
+                    WHERE clientmatchrule_id IN (%s)
                 )
-                for snippet in snippet_objs
-            ]
-            cache_hit = ( mktime(gmtime()), (include_ids, exclude_ids), snippets, )
-            cache.set(cache_key, cache_hit, CACHE_TIMEOUT)
-
-        return cache_hit[2]
+            """ % ",".join(str(rule_id) for rule_id
+                           in bit_positions(include_bits)))
+        else:
+            # Matching no include rules, only snippets without any can be
+            # found.
+            where.append("""
+                homesnippets_snippet.id NOT IN (
+                    SELECT snippet_id
+                    FROM homesnippets_snippet_client_match_rules
+                    JOIN homesnippets_clientmatchrule
+                        ON homesnippets_clientmatchrule.id =
+                            clientmatchrule_id
+                    WHERE homesnippets_clientmatchrule.exclude = 0
+                )
+            """)
+        sql = sql_base % (' AND '.join(where))
+
+        # Reduce snippet model objects to more cacheable dicts
+        snippets = [ dict(id=snippet.id, name=snippet.name, body=snippet.body,
+                          country=snippet.country,
+                          pub_start=snippet.pub_start,
+                          pub_end=snippet.pub_end)
+                     for snippet in self.raw(sql) ]
+        if not snippets or not exclude_bits:
+            return snippets, ()
+
+        # The rules of the snippets found, fetched apart from the snippets
+        # so that bodies aren't loaded once per rule.
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT snippet_id, clientmatchrule_id
+            FROM homesnippets_snippet_client_match_rules
+            WHERE snippet_id IN (%s)
+        """ % ",".join(str(snippet['id']) for snippet in snippets))
+        dropped = set(snippet_id for snippet_id, rule_id in cursor.fetchall()
+                      if (exclude_bits >> rule_id) & 1)
+        return ([ snippet for snippet in snippets
+                  if snippet['id'] not in dropped ],
+                tuple(sorted(dropped)))
 
 
 class Snippet(models.Model):
@@ -388,6 +1389,118 @@ def snippet_update_lastmod(sender, instance, **kwargs):
     for rule in instance.client_match_rules.all():
         lastmods['%s%s' % (CACHE_RULE_LASTMOD_PREFIX, rule.id)] = now
     cache.set_many(lastmods, CACHE_TIMEOUT)
+    _bump_generation()
 
 post_save.connect(snippet_update_lastmod, sender=Snippet)
 post_delete.connect(snippet_update_lastmod, sender=Snippet)
+
+
+def snippet_rules_changed(sender, **kwargs):
+    """On a change to which rules a snippet uses, move on to a new content
+    generation."""
+    if kwargs['action'].startswith('post_'):
+        _bump_generation()
+
+m2m_changed.connect(snippet_rules_changed,
+                    sender=Snippet.client_match_rules.through)
+
+
+def cache_stamps():
+    """Current values of the stamps cached entries are checked against, as
+    (key, value) pairs: the content generation, the latest logged rule
+    change, the lastmods of all rules and of new rules, and the time each
+    family of entries was last flushed."""
+    keys = [ CACHE_GENERATION, CACHE_RULE_DELTA_SEQ,
+             CACHE_RULE_ALL_LASTMOD_PREFIX, CACHE_RULE_NEW_LASTMOD_PREFIX ]
+    keys.extend('%s%s' % (FLUSH_PREFIX, family)
+                for family, prefix in CACHE_FAMILIES)
+    found = cache.get_many(keys)
+    return [ (key, found.get(key)) for key in keys ]
+
+
+def cache_totals():
+    """Shared totals of hits, misses, invalidations and sets, and of the
+    number and total size of the values measured, for each of
+    CACHE_FAMILIES, and the time counting started at, or None without
+    CACHE_STATS."""
+    if cache_stats is None:
+        return None
+    return cache_stats.totals(cache)
+
+
+def local_cache_stats():
+    """Hits, misses, evictions and expirations of this process's in-memory
+    cache, and its size, with LOCAL_CACHE_SIZE, or else None."""
+    return local_cache is not None and local_cache.stats() or None
+
+
+def cache_compression_stats():
+    """Totals of value sizes before and after compression by the cache
+    backend, if it compresses values (see homesnippets.memcached), or
+    None."""
+    stats = getattr(cache, 'compression_stats', None)
+    return stats and stats()
+
+
+def reset_cache_totals():
+    """Start counting cache events over, with CACHE_STATS."""
+    if cache_stats is not None:
+        cache_stats.reset(cache)
+
+
+def flush_cache_family(family):
+    """Invalidate every cached entry in one of CACHE_FAMILIES. Returns
+    whether it could be: the set of all rules is a single entry, but the
+    other families can only be flushed with CACHE_STATS."""
+    if family == 'rules':
+        cache.delete(CACHE_RULE_ALL_PREFIX)
+        # In-process rule indexes only reload once this is newer than them.
+        cache.set(CACHE_RULE_ALL_LASTMOD_PREFIX, mktime(gmtime()),
+                  CACHE_TIMEOUT)
+    if local_cache is not None:
+        local_cache.clear()
+    if cache_stats is None:
+        return family == 'rules'
+    cache_stats.flush(cache, family, mktime(gmtime()))
+    return True
+
+
+def client_cache_entries(args):
+    """The entries cached for a client's rule match, snippet lookup and
+    rendered response, as dicts of family, key, value (None if not cached),
+    pickled size and time cached at. Rules are matched afresh, without
+    caching anything, to find the snippet lookup."""
+    generation = _current_generation()
+    rules = ClientMatchRule.objects
+    index, engine, seq = rules._cached_index()
+    include_ids, exclude_ids = engine.partition(args)
+    keys = [ ('match', rules._match_cache_key(args, index, generation)) ]
+    if include_ids or exclude_ids:
+        preview = ( 'preview' in args ) and args['preview']
+        keys.append(('lookup', Snippet.objects._lookup_cache_key(
+            preview, rule_bits(include_ids), rule_bits(exclude_ids),
+            generation)))
+    keys.append(('response', _response_cache_key(args, index)))
+
+    found = cache.get_many([ key for family, key in keys ])
+    entries = []
+    for family, key in keys:
+        value = found.get(key)
+        entries.append(dict(
+            family=family, key=key, value=value,
+            size=value and len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+            cached_at=value and (family == 'response' and
+                                 _response_time(value) or value[0])))
+    return entries
+
+
+def flush_client_cache(args):
+    """Drop the entries cached for a client, as found by
+    client_cache_entries(). Returns the keys dropped."""
+    keys = [ entry['key'] for entry in client_cache_entries(args)
+             if entry['value'] is not None ]
+    cache.delete_many(keys)
+    if local_cache is not None:
+        for key in keys:
+            local_cache.delete(key)
+    return keys
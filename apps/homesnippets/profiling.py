@@ -0,0 +1,145 @@
+"""
+Client match rule cost profiling
+
+Times every rule against a sample of client requests, to find the rules that
+cost the most to evaluate on a cache miss, along with regexes prone to
+catastrophic backtracking.
+"""
+import json
+from timeit import default_timer
+from urllib import unquote
+from urlparse import urlparse
+
+from homesnippets.matching import MATCH_FIELDS, RegexCondition, regex_hazards
+
+
+def parse_client(line, complete=False):
+    """Client args from a line of sample data, or None if there are none.
+
+    Lines can be snippet URLs or paths, optionally in a web server access
+    log line, or JSON objects with match field values. URL path segments
+    are decoded, as for the snippets view. Malformed JSON, and objects
+    without any match fields, count as no client.
+
+    With complete, only public requests with every match field count, as
+    needed to cache entries under the keys real requests look up: JSON
+    objects missing a field or with a true preview, and preview URLs, count
+    as no client too.
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.startswith('{'):
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        args = dict((field, data[field]) for field in MATCH_FIELDS
+                    if data.get(field) is not None)
+        if complete and (len(args) < len(MATCH_FIELDS) or
+                         data.get('preview')):
+            return None
+        return args or None
+    for word in line.split():
+        word = word.strip('"')
+        if '/' not in word:
+            continue
+        segments = [unquote(s).decode('utf-8', 'replace')
+                    for s in urlparse(word).path.split('/') if s]
+        if segments and segments[0] == 'preview':
+            if complete:
+                return None
+            segments = segments[1:]
+        if len(segments) == len(MATCH_FIELDS):
+            return dict(zip(MATCH_FIELDS, segments))
+    return None
+
+
+def load_clients(lines, limit=None):
+    """List of client args parsed from lines of sample data."""
+    clients = []
+    for line in lines:
+        args = parse_client(line)
+        if args is not None:
+            clients.append(args)
+            if limit and len(clients) >= limit:
+                break
+    return clients
+
+
+def top_clients(lines, limit=None, complete=False):
+    """Distinct client args parsed from lines of sample data, most frequent
+    first, as (count, args) pairs. See parse_client() for complete."""
+    counts = {}
+    for line in lines:
+        args = parse_client(line, complete)
+        if args is not None:
+            key = tuple(sorted(args.items()))
+            counts[key] = counts.get(key, 0) + 1
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return [ (count, dict(key)) for key, count in ranked[:limit] ]
+
+
+def rule_hazards(matcher):
+    """Descriptions of the regexes of a rule prone to catastrophic
+    backtracking, by field."""
+    return [ '%s: %s' % (condition.field, hazard)
+             for condition in matcher.conditions
+             if isinstance(condition, RegexCondition)
+             for hazard in regex_hazards(condition.pattern) ]
+
+
+class RuleProfile(object):
+    """Evaluation cost of one rule over a sample of clients. Rules that
+    weren't run have seconds and matches of None."""
+
+    def __init__(self, matcher, seconds, evaluations, matches):
+        self.id = matcher.id
+        self.matcher = matcher
+        self.seconds = seconds
+        self.evaluations = evaluations
+        self.matches = matches
+        self.timed = seconds is not None
+        self.error = matcher.error and matcher.error.reason
+        self.hazards = rule_hazards(matcher)
+
+    @property
+    def micros(self):
+        """Average evaluation time in microseconds."""
+        return self.evaluations and 1e6 * self.seconds / self.evaluations
+
+
+def profile_rules(matchers, clients, repeat=1, budget=None,
+                  clock=default_timer):
+    """Time each matcher against every client, repeat times over. Returns
+    RuleProfiles, rules not run and then the most costly per evaluation
+    first.
+
+    With a budget in seconds, each matcher gets an equal share of it, and
+    stops repeating once that is used up, after at least one pass over the
+    clients. As a single pass of a regex prone to catastrophic backtracking
+    can take any time at all, matchers with one aren't run.
+    """
+    share = budget and float(budget) / max(len(matchers), 1)
+    profiles = []
+    for matcher in matchers:
+        if budget and rule_hazards(matcher):
+            profiles.append(RuleProfile(matcher, None, 0, None))
+            continue
+        is_match = matcher.is_match
+        start = clock()
+        passes = matches = 0
+        while passes < repeat:
+            for args in clients:
+                matches += is_match(args)
+            passes += 1
+            if share and clock() - start >= share:
+                break
+        seconds = clock() - start
+        profiles.append(RuleProfile(matcher, seconds, passes * len(clients),
+                                    matches // passes))
+    profiles.sort(key=lambda profile: (not profile.timed, profile.micros),
+                  reverse=True)
+    return profiles
@@ -3,10 +3,14 @@ homesnippets caching tests
 """
 import time
 import random
+import tempfile
+from datetime import datetime, timedelta
 
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.core import cache
 from django.core.cache.backends import locmem
+from django.core.management import call_command
 
 from nose.tools import eq_, ok_
 
@@ -17,8 +21,18 @@ from homesnippets.models import (Snippet, ClientMatchRule,
                                  CACHE_RULE_ALL_PREFIX,
                                  CACHE_RULE_ALL_LASTMOD_PREFIX,
                                  CACHE_RULE_NEW_LASTMOD_PREFIX,
+                                 CACHE_RULE_DELTA_SEQ,
+                                 CACHE_RULE_DELTA_PREFIX,
+                                 CACHE_GENERATION,
+                                 CACHE_RESPONSE_PREFIX,
                                  CACHE_SNIPPET_LASTMOD_PREFIX,
-                                 CACHE_SNIPPET_LOOKUP_PREFIX)
+                                 CACHE_SNIPPET_LOOKUP_PREFIX,
+                                 CACHE_FAMILIES, cache_totals,
+                                 client_cache_entries, flush_cache_family,
+                                 flush_client_cache)
+from homesnippets.caches import LOCK_PREFIX, CacheStats, LocalCache
+from homesnippets.matching import rule_bits
+from homesnippets.tests.test_caches import TaskList
 from homesnippets.tests.utils import HomesnippetsTestCase
 
 
@@ -152,18 +166,17 @@ class TestSnippetsCache(HomesnippetsTestCase):
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
             ('set', CACHE_SNIPPET_LOOKUP_PREFIX),
 
-            # Request 2
+            # Request 2, with the rule index checked against the lastmod
+            # of all rules rather than fetching them again.
             ('get', CACHE_RULE_MATCH_PREFIX),
-            ('get_many', [CACHE_RULE_ALL_PREFIX,
-                          CACHE_RULE_ALL_LASTMOD_PREFIX]),
+            ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
             ('set', CACHE_RULE_MATCH_PREFIX),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
             ('set', CACHE_SNIPPET_LOOKUP_PREFIX),
 
             # Request 3
             ('get', CACHE_RULE_MATCH_PREFIX),
-            ('get_many', [CACHE_RULE_ALL_PREFIX,
-                          CACHE_RULE_ALL_LASTMOD_PREFIX]),
+            ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
             ('set', CACHE_RULE_MATCH_PREFIX),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
             ('set', CACHE_SNIPPET_LOOKUP_PREFIX),
@@ -205,8 +218,9 @@ class TestSnippetsCache(HomesnippetsTestCase):
                           CACHE_RULE_NEW_LASTMOD_PREFIX]),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
             ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX]),
+                          CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_SNIPPET_LASTMOD_PREFIX,
+                          CACHE_SNIPPET_LASTMOD_PREFIX]),
 
             # Request 2
             ('get', CACHE_RULE_MATCH_PREFIX),
@@ -214,25 +228,137 @@ class TestSnippetsCache(HomesnippetsTestCase):
                           CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_LASTMOD_PREFIX]),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_SNIPPET_LASTMOD_PREFIX]),
+
+            # Request 3
+            ('get', CACHE_RULE_MATCH_PREFIX),
             ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_RULE_NEW_LASTMOD_PREFIX]),
+            ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
 
-            # Request 3
+        ))
+
+    def test_unreferenced_fields_share_entries(self):
+        """Requests differing only in fields no rule refers to should share
+        cached rule matches"""
+
+        self.assert_snippets({
+            '/1/Firefox/4.0/yyy/zzz/en-US/beta/OSX/acme/1.0/': (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], False),
+            ),
+        })
+
+        # Nothing but cache hits, same as the first request in setUp
+        self.assert_cache_events((
             ('get', CACHE_RULE_MATCH_PREFIX),
             ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_NEW_LASTMOD_PREFIX]),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_SNIPPET_LASTMOD_PREFIX,
+                          CACHE_SNIPPET_LASTMOD_PREFIX]),
+        ))
+
+        # Values no rule tells apart should share entries too.
+        self.assert_snippets({
+            '/7/Otter/9.3/yyy/zzz/en-US/beta/OSX/acme/1.0/': (
+                (self.snippets['expected'], False),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], False),
+            ),
+        })
+        self.assert_cache_events((
+            ('get', CACHE_RULE_MATCH_PREFIX),
             ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_RULE_NEW_LASTMOD_PREFIX]),
+            ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
+        ))
+
+        # A new rule on one of those fields splits them up again.
+        new_rule = ClientMatchRule(channel='beta')
+        new_rule.save()
+
+        args = dict(startpage_version='1', name='Firefox', version='4.0',
+                    appbuildid='xxx', build_target='xxx', locale='en-US',
+                    channel='xxx', os_version='xxx', distribution='default',
+                    distribution_version='default', preview=False)
+        beta_args = dict(args, channel='beta')
+        matches = [str(self.rules[name].id)
+                   for name in ('specific', 'vague', 'all')]
+        include_ids, exclude_ids = \
+            ClientMatchRule.objects.find_match_ids_for_request(args)
+        eq_(sorted(matches), sorted(include_ids))
+        ok_(str(new_rule.id) in exclude_ids)
+        include_ids, exclude_ids = \
+            ClientMatchRule.objects.find_match_ids_for_request(beta_args)
+        eq_(sorted(matches + [str(new_rule.id)]), sorted(include_ids))
+
+    def test_batch_lookups(self):
+        """Batch lookups should use one round trip per step, and agree with
+        single lookups"""
+
+        def client(path):
+            return dict(zip(('startpage_version', 'name', 'version',
+                             'appbuildid', 'build_target', 'locale',
+                             'channel', 'os_version', 'distribution',
+                             'distribution_version'), path.split('/')),
+                        preview=False)
+
+        args_list = [
+            client('1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default'),
+            client('9/Waterduck/9.2/xxx/xxx/en-US/xxx/xxx/default/default'),
+            client('2/Airdog/3.0/xxx/xxx/de/xxx/xxx/default/default'),
+            client('2/Airdog/3.0/yyy/yyy/de/xxx/xxx/default/default'),
+            client('1/Firefox/4.0/yyy/xxx/en-US/xxx/xxx/default/default'),
+        ]
+        results = Snippet.objects.find_snippets_with_match_rules_many(
+            args_list)
 
+        self.assert_cache_events((
+            # Three of the five are hits from setUp, all validated at once.
+            ('get_many', [CACHE_RULE_MATCH_PREFIX, CACHE_RULE_MATCH_PREFIX,
+                          CACHE_RULE_MATCH_PREFIX]),
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_RULE_NEW_LASTMOD_PREFIX]),
+            # Both Airdog requests share one evaluation.
+            ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
+            ('set_many', [CACHE_RULE_MATCH_PREFIX]),
+            ('get_many', [CACHE_SNIPPET_LOOKUP_PREFIX,
+                          CACHE_SNIPPET_LOOKUP_PREFIX,
+                          CACHE_SNIPPET_LOOKUP_PREFIX]),
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_RULE_LASTMOD_PREFIX,
+                          CACHE_RULE_NEW_LASTMOD_PREFIX,
+                          CACHE_SNIPPET_LASTMOD_PREFIX,
+                          CACHE_SNIPPET_LASTMOD_PREFIX]),
+            ('set_many', [CACHE_SNIPPET_LOOKUP_PREFIX]),
         ))
 
+        eq_(['test 2', 'test 3'],
+            sorted(snippet['name'] for snippet in results[2]))
+
+        # Single lookups should now be all cache hits, with the same results.
+        eq_([Snippet.objects.find_snippets_with_match_rules(args)
+             for args in args_list], results)
+        eq_([], [e for e in self.cache.log if e[0] in ('set', 'set_many')])
+        self.cache.log = []
+
     def test_invalidation_on_rule_change(self):
         """Exercise cache invalidation on change to a client match rule"""
 
@@ -261,7 +387,8 @@ class TestSnippetsCache(HomesnippetsTestCase):
                           CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_NEW_LASTMOD_PREFIX]),
 
-            # All rules cache miss
+            # All rules changed, so cache miss
+            ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
             ('get_many', [CACHE_RULE_ALL_PREFIX,
                           CACHE_RULE_ALL_LASTMOD_PREFIX]),
             ('set', CACHE_RULE_ALL_PREFIX),
@@ -271,7 +398,6 @@ class TestSnippetsCache(HomesnippetsTestCase):
             # Snippet cache miss
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
             ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
@@ -280,6 +406,523 @@ class TestSnippetsCache(HomesnippetsTestCase):
 
         ))
 
+    def test_rule_change_deltas(self):
+        """With rule deltas, rule changes should be applied to the rule index
+        and cached matches, rather than reloading all rules"""
+        homesnippets.models.RULE_DELTAS = True
+        ClientMatchRule.objects.rule_index = (None, None, None, 0)
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        try:
+            self.assert_snippets({url: (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], False),
+            )})
+
+            # Matches and all rules cached without rule deltas get replaced.
+            self.assert_cache_events((
+                # The change log gets started, in a new epoch.
+                ('get_many', [CACHE_RULE_DELTA_SEQ,
+                              CACHE_RULE_ALL_LASTMOD_PREFIX]),
+                ('get', CACHE_RULE_DELTA_SEQ),
+                ('get_many', [CACHE_RULE_DELTA_SEQ,
+                              CACHE_RULE_ALL_LASTMOD_PREFIX]),
+                ('get_many', [CACHE_RULE_ALL_PREFIX,
+                              CACHE_RULE_ALL_LASTMOD_PREFIX]),
+                ('set', CACHE_RULE_ALL_PREFIX),
+                ('get', CACHE_RULE_MATCH_PREFIX),
+                ('set', CACHE_RULE_MATCH_PREFIX),
+                ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+                ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
+                              CACHE_RULE_LASTMOD_PREFIX,
+                              CACHE_RULE_LASTMOD_PREFIX,
+                              CACHE_SNIPPET_LASTMOD_PREFIX,
+                              CACHE_SNIPPET_LASTMOD_PREFIX]),
+            ))
+
+            self.rules['unused'].description = 'changed'
+            self.rules['unused'].save()
+            self.assert_snippets({url: (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], False),
+            )})
+
+            self.assert_cache_events((
+                # Rule change logged, without touching the set of all rules.
+                ('get', CACHE_RULE_DELTA_SEQ),
+                ('set', CACHE_RULE_DELTA_SEQ),
+                ('set', CACHE_RULE_DELTA_PREFIX),
+                ('set_many', [CACHE_RULE_LASTMOD_PREFIX]),
+
+                # Change applied to the rule index, and the cached match
+                # patched up rather than recalculated.
+                ('get_many', [CACHE_RULE_DELTA_SEQ,
+                              CACHE_RULE_ALL_LASTMOD_PREFIX]),
+                ('get_many', [CACHE_RULE_DELTA_SEQ,
+                              CACHE_RULE_ALL_LASTMOD_PREFIX]),
+                ('get_many', [CACHE_RULE_DELTA_PREFIX]),
+                ('get', CACHE_RULE_MATCH_PREFIX),
+                ('set', CACHE_RULE_MATCH_PREFIX),
+
+                # The changed rule doesn't match, so the lookup still holds.
+                ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+                ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
+                              CACHE_RULE_LASTMOD_PREFIX,
+                              CACHE_RULE_LASTMOD_PREFIX,
+                              CACHE_SNIPPET_LASTMOD_PREFIX,
+                              CACHE_SNIPPET_LASTMOD_PREFIX]),
+            ))
+
+            self.rules['unmatched'].startpage_version = None
+            self.rules['unmatched'].name = None
+            self.rules['unmatched'].version = '>=4.0'
+            self.rules['unmatched'].locale = 'en-*'
+            self.rules['unmatched'].save()
+            self.assert_snippets({url: (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], True),
+            )})
+
+            self.rules['unmatched'].delete()
+            self.assert_snippets({url: (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+            )})
+            ok_(ClientMatchRule.objects.rule_index[3] >= 3)
+
+            # Snapshots at any change, even before the first, get reused.
+            for seq in (0, ClientMatchRule.objects.rule_index[3]):
+                self.cache.delete(CACHE_RULE_ALL_PREFIX)
+                ClientMatchRule.objects._cached_all(seq)
+                ok_(ClientMatchRule.objects._load_all(seq))
+
+        finally:
+            homesnippets.models.RULE_DELTAS = False
+            ClientMatchRule.objects.rule_index = (None, None, None, 0)
+
+    def test_rule_change_log_reset(self):
+        """Changes logged after the rule change log is lost and started over
+        should not be mistaken for changes already applied"""
+        homesnippets.models.RULE_DELTAS = True
+        ClientMatchRule.objects.rule_index = (None, None, None, 0)
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        try:
+            self.rules['unused'].description = 'changed'
+            self.rules['unused'].save()
+            self.browser.get(url)
+            rule_seq = ClientMatchRule.objects.rule_index[3]
+
+            self.cache.delete(CACHE_RULE_DELTA_SEQ)
+            time.sleep(0.01)
+            self.rules['unmatched'].locale = None
+            self.rules['unmatched'].startpage_version = None
+            self.rules['unmatched'].name = None
+            self.rules['unmatched'].version = None
+            self.rules['unmatched'].save()
+            self.assert_snippets({url: (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], True),
+            )})
+            ok_(ClientMatchRule.objects.rule_index[3] > rule_seq)
+        finally:
+            homesnippets.models.RULE_DELTAS = False
+            ClientMatchRule.objects.rule_index = (None, None, None, 0)
+
+    def test_rule_change_log_down(self):
+        """Rule changes that can't be logged should invalidate all rules
+        instead, without failing the save"""
+        homesnippets.models.RULE_DELTAS = True
+        ClientMatchRule.objects.rule_index = (None, None, None, 0)
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+
+        def incr(key, delta=1):
+            raise ValueError("Key '%s' not found" % key)
+
+        try:
+            self.browser.get(url)
+            time.sleep(1)
+            self.cache.incr = incr
+            self.rules['unmatched'].locale = None
+            self.rules['unmatched'].startpage_version = None
+            self.rules['unmatched'].name = None
+            self.rules['unmatched'].version = None
+            self.rules['unmatched'].save()
+            del self.cache.incr
+            ok_(self.cache.get(CACHE_RULE_ALL_LASTMOD_PREFIX))
+
+            self.assert_snippets({url: (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], True),
+            )})
+        finally:
+            homesnippets.models.RULE_DELTAS = False
+            ClientMatchRule.objects.rule_index = (None, None, None, 0)
+
+    def test_rule_change_during_match(self):
+        """A rule change applied by another request while a match is being
+        computed should still get applied to the cached match"""
+        homesnippets.models.RULE_DELTAS = True
+        rules = ClientMatchRule.objects
+        rules.rule_index = (None, None, None, 0)
+        args = dict(startpage_version='9', name='Waterduck', version='9.2',
+                    locale='en-US')
+        added, partition = [], rules._partition_many
+
+        def partition_many(engine, args_list):
+            partitions = partition(engine, args_list)
+            if not added:
+                rule = ClientMatchRule()
+                rule.save()
+                added.append(str(rule.id))
+                rules._cached_index()
+            return partitions
+
+        try:
+            rules._partition_many = partition_many
+            include_ids, exclude_ids = rules.find_match_ids_for_request(args)
+            del rules._partition_many
+            ok_(added[0] not in include_ids)
+            ok_(added[0] in rules.find_match_ids_for_request(args)[0])
+            ok_(added[0] in rules.find_match_ids_for_requests([args])[0][0])
+        finally:
+            rules.__dict__.pop('_partition_many', None)
+            homesnippets.models.RULE_DELTAS = False
+            rules.rule_index = (None, None, None, 0)
+
+    def test_generations(self):
+        """With content generations, a cache hit should cost a single get of
+        the generation, and any change should move on to new entries"""
+        homesnippets.models.CACHE_GENERATIONS = True
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        try:
+            for idx in range(2):
+                self.assert_snippets({url: (
+                    (self.snippets['expected'], True),
+                    (self.snippets['ever'], True),
+                    (self.snippets['never'], False),
+                )})
+
+            self.assert_cache_events((
+                # Fresh generation, so nothing cached for it yet.
+                ('get', CACHE_GENERATION),
+                ('get', CACHE_GENERATION),
+                ('get', CACHE_RULE_MATCH_PREFIX),
+                ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
+                ('set', CACHE_RULE_MATCH_PREFIX),
+                ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+                ('set', CACHE_SNIPPET_LOOKUP_PREFIX),
+
+                # Nothing but hits, without any lastmods.
+                ('get', CACHE_GENERATION),
+                ('get', CACHE_RULE_MATCH_PREFIX),
+                ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+            ))
+
+            rules = self.snippets['never'].client_match_rules
+            rules.remove(self.rules['unmatched'])
+            rules.add(self.rules['all'])
+            self.assert_snippets({url: (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], True),
+            )})
+        finally:
+            homesnippets.models.CACHE_GENERATIONS = False
+
+    def test_local_cache(self):
+        """With an in-process cache, repeat requests should only need the
+        generation from the shared cache, until something changes"""
+        homesnippets.models.CACHE_GENERATIONS = True
+        homesnippets.models.local_cache = LocalCache(100, 60)
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        try:
+            for idx in range(2):
+                self.assert_snippets({url: (
+                    (self.snippets['expected'], True),
+                    (self.snippets['ever'], True),
+                    (self.snippets['never'], False),
+                )})
+
+            self.assert_cache_events((
+                ('get', CACHE_GENERATION),
+                ('get', CACHE_GENERATION),
+                ('get', CACHE_RULE_MATCH_PREFIX),
+                ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
+                ('set', CACHE_RULE_MATCH_PREFIX),
+                ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+                ('set', CACHE_SNIPPET_LOOKUP_PREFIX),
+
+                # Served from process memory.
+                ('get', CACHE_GENERATION),
+            ))
+            eq_(2, homesnippets.models.local_cache.hits)
+
+            rules = self.snippets['never'].client_match_rules
+            rules.remove(self.rules['unmatched'])
+            rules.add(self.rules['all'])
+            self.assert_snippets({url: (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], True),
+            )})
+        finally:
+            homesnippets.models.CACHE_GENERATIONS = False
+            homesnippets.models.local_cache = None
+
+    def test_response_cache(self):
+        """Rendered responses should be cached, and invalidated along with
+        snippet lookups"""
+        homesnippets.models.RESPONSE_CACHE = True
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        try:
+            bodies = [ self.browser.get(url).content for idx in range(2) ]
+            # Including the time the content was generated at.
+            eq_(bodies[0], bodies[1])
+
+            self.assert_cache_events((
+                # Made from cached rule matches and snippet lookups, and
+                # stored under a key from a current rule index.
+                ('get', CACHE_RESPONSE_PREFIX),
+                ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
+                ('get', CACHE_RULE_MATCH_PREFIX),
+                ('get_many', [CACHE_RULE_LASTMOD_PREFIX]),
+                ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
+                ('get_many', [CACHE_RULE_LASTMOD_PREFIX]),
+                ('set', CACHE_RESPONSE_PREFIX),
+
+                # Hit, checked against lastmods.
+                ('get', CACHE_RESPONSE_PREFIX),
+                ('get_many', [CACHE_RULE_LASTMOD_PREFIX]),
+            ))
+
+            # No rule tells build IDs apart, so they share a response.
+            self.browser.get(url.replace('xxx', '20110318052756', 1))
+            self.assert_cache_events((
+                ('get', CACHE_RESPONSE_PREFIX),
+                ('get_many', [CACHE_RULE_LASTMOD_PREFIX]),
+            ))
+
+            time.sleep(1)
+            self.snippets['ever'].body = 'Changed body data'
+            self.snippets['ever'].save()
+            ok_('Changed body data' in self.browser.get(url).content)
+
+            homesnippets.models.CACHE_GENERATIONS = True
+            self.browser.get(url)
+            self.cache.log = []
+            self.browser.get(url)
+            self.assert_cache_events((
+                ('get_many', [CACHE_GENERATION, CACHE_RESPONSE_PREFIX]),
+            ))
+        finally:
+            homesnippets.models.RESPONSE_CACHE = False
+            homesnippets.models.CACHE_GENERATIONS = False
+
+    def test_response_cache_dates(self):
+        """Cached responses should expire when a snippet starts or ends
+        publication"""
+        homesnippets.models.RESPONSE_CACHE = True
+        args = dict(startpage_version='1', name='Firefox', version='4.0',
+                    locale='en-US', preview=False)
+        now = datetime.now()
+        self.snippets['expected'].pub_start = now + timedelta(hours=1)
+        self.snippets['expected'].save()
+        render = lambda snippets, generated: [ s['name'] for s in snippets ]
+        try:
+            eq_(['test 2'], Snippet.objects.find_rendered_snippets(
+                args, render, now))
+            eq_(['test 2'], Snippet.objects.find_rendered_snippets(
+                args, render, now + timedelta(minutes=30)))
+            eq_(['test 1', 'test 2'], sorted(
+                Snippet.objects.find_rendered_snippets(
+                    args, render, now + timedelta(hours=2))))
+        finally:
+            homesnippets.models.RESPONSE_CACHE = False
+
+    def test_cache_locks(self):
+        """With cache locks, a stale lookup should be served while another
+        process recomputes it"""
+        homesnippets.models.CACHE_LOCKS = True
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        args = dict(startpage_version='1', name='Firefox', version='4.0',
+                    appbuildid='xxx', build_target='xxx', locale='en-US',
+                    channel='xxx', os_version='xxx', distribution='default',
+                    distribution_version='default', preview=False)
+        try:
+            include_ids, exclude_ids = \
+                ClientMatchRule.objects.find_match_ids_for_request(args)
+            lookup_key = Snippet.objects._lookup_cache_key(
+                False, rule_bits(include_ids), rule_bits(exclude_ids))
+
+            time.sleep(1)
+            self.snippets['ever'].body = 'Changed body data'
+            self.snippets['ever'].save()
+
+            self.cache.add(LOCK_PREFIX + lookup_key, 1)
+            ok_('Ever-present body data' in self.browser.get(url).content)
+
+            self.cache.delete(LOCK_PREFIX + lookup_key)
+            ok_('Changed body data' in self.browser.get(url).content)
+        finally:
+            homesnippets.models.CACHE_LOCKS = False
+
+    def test_lookup_grace(self):
+        """Within the grace window after a change, the stale lookup should
+        be served while it gets refreshed in the background"""
+        homesnippets.models.LOOKUP_GRACE = 60
+        homesnippets.models.refresh_pool = TaskList()
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        try:
+            time.sleep(1)
+            self.snippets['ever'].body = 'Changed body data'
+            self.snippets['ever'].save()
+
+            for idx in range(2):
+                ok_('Ever-present body data' in
+                    self.browser.get(url).content)
+            # Refreshed only once.
+            eq_(1, len(homesnippets.models.refresh_pool.tasks))
+
+            homesnippets.models.refresh_pool.run()
+            ok_('Changed body data' in self.browser.get(url).content)
+
+            # Outside the grace window, lookups are refreshed up front.
+            homesnippets.models.LOOKUP_GRACE = 0
+            time.sleep(1)
+            self.snippets['ever'].body = 'Changed again'
+            self.snippets['ever'].save()
+            ok_('Changed again' in self.browser.get(url).content)
+            eq_([], homesnippets.models.refresh_pool.tasks)
+        finally:
+            homesnippets.models.LOOKUP_GRACE = 0
+            homesnippets.models.refresh_pool = None
+
+    def test_warm_snippets(self):
+        """Clients warmed from a request log should get cached responses"""
+        homesnippets.models.RESPONSE_CACHE = True
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        log = tempfile.NamedTemporaryFile()
+        log.write('"GET %s HTTP/1.1"\n' % url * 2)
+        log.write('{"name": "Firefox", "locale": "de"}\n')
+        log.flush()
+        try:
+            call_command('warmsnippets', log.name, processes=0)
+            self.cache.log = []
+
+            self.assert_snippets({url: (
+                (self.snippets['expected'], True),
+                (self.snippets['ever'], True),
+                (self.snippets['never'], False),
+            )})
+            self.assert_cache_events((
+                ('get', CACHE_RESPONSE_PREFIX),
+                ('get_many', [CACHE_RULE_LASTMOD_PREFIX]),
+            ))
+        finally:
+            homesnippets.models.RESPONSE_CACHE = False
+            log.close()
+
+    def test_cache_stats(self):
+        """Cache events should be counted per family, and families and
+        clients flushed"""
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        args = dict(startpage_version='1', name='Firefox', version='4.0',
+                    appbuildid='xxx', build_target='xxx', locale='en-US',
+                    channel='xxx', os_version='xxx', distribution='default',
+                    distribution_version='default', preview=False)
+        eq_(None, cache_totals())
+        ok_(not flush_cache_family('lookup'))
+        homesnippets.models.cache_stats = CacheStats(
+            [ family for family, prefix in CACHE_FAMILIES ], 0)
+        try:
+            for idx in range(2):
+                self.browser.get(url)
+            totals, since = cache_totals()
+            eq_(dict(hits=2, misses=0, invalidations=0, sets=0, sized=0,
+                     bytes=0),
+                totals['lookup'])
+            eq_(2, totals['match']['hits'])
+            ok_(since)
+
+            # Entries cached up until a flush are invalidated, once.
+            time.sleep(1)
+            ok_(flush_cache_family('lookup'))
+            for idx in range(2):
+                self.browser.get(url)
+            totals, since = cache_totals()
+            eq_(3, totals['lookup']['hits'])
+            eq_(1, totals['lookup']['invalidations'])
+            eq_(1, totals['lookup']['sets'])
+            eq_(1, totals['lookup']['sized'])
+            ok_(totals['lookup']['bytes'] > 0)
+
+            entries = client_cache_entries(args)
+            eq_(['match', 'lookup', 'response'],
+                [ entry['family'] for entry in entries ])
+            ok_(entries[0]['size'] > 0)
+            eq_(None, entries[2]['value'])
+            eq_([ entry['key'] for entry in entries[:2] ],
+                flush_client_cache(args))
+            self.browser.get(url)
+            totals, since = cache_totals()
+            eq_(1, totals['match']['misses'])
+            eq_(1, totals['lookup']['misses'])
+        finally:
+            homesnippets.models.cache_stats = None
+
+    def test_flush_rules(self):
+        """Flushing rules should reload in-process rule indexes, even
+        without CACHE_STATS"""
+        index = ClientMatchRule.objects._cached_index()[0]
+        # Changed behind the back of the rule change signals.
+        ClientMatchRule.objects.filter(pk=self.rules['vague'].pk).update(
+            version='5.0')
+        ClientMatchRule.objects.filter(pk=self.rules['specific'].pk).update(
+            version='5.0')
+        ok_(index is ClientMatchRule.objects._cached_index()[0])
+
+        ok_(flush_cache_family('rules'))
+        ok_(index is not ClientMatchRule.objects._cached_index()[0])
+        eq_([str(self.rules['all'].pk)],
+            ClientMatchRule.objects._cached_index()[1].partition(dict(
+                startpage_version='1', name='Firefox', version='4.0',
+                locale='en-US'))[0])
+
+    def test_cache_admin(self):
+        """The admin cache page should show stats, explore clients and
+        flush entries"""
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.browser.login(username='admin', password='admin')
+        url = '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/'
+        homesnippets.models.cache_stats = CacheStats(
+            [ family for family, prefix in CACHE_FAMILIES ], 0)
+        homesnippets.models.local_cache = LocalCache(10, 60)
+        try:
+            self.browser.get(url)
+            response = self.browser.get('/admin/cache', {'client': url})
+            eq_(200, response.status_code)
+            ok_(CACHE_SNIPPET_LOOKUP_PREFIX in response.content)
+            ok_('Not cached' in response.content)
+            ok_('0 / 10 entries' in response.content)
+
+            response = self.browser.post('/admin/cache', {
+                'action': 'flush_client', 'client': url})
+            eq_(302, response.status_code)
+            response = self.browser.get('/admin/cache', {'client': url})
+            eq_(3, response.content.count('Not cached'))
+
+            response = self.browser.post('/admin/cache', {
+                'action': 'flush_family', 'family': 'rules'})
+            eq_(302, response.status_code)
+            eq_(None, self.cache.get(CACHE_RULE_ALL_PREFIX))
+        finally:
+            homesnippets.models.cache_stats = None
+            homesnippets.models.local_cache = None
+
     def test_invalidation_on_snippet_change(self):
         """Exercise cache invalidation on change to a snippet"""
 
@@ -307,15 +950,12 @@ class TestSnippetsCache(HomesnippetsTestCase):
                           CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_NEW_LASTMOD_PREFIX]),
-            ('get_many', [CACHE_RULE_ALL_PREFIX,
-                          CACHE_RULE_ALL_LASTMOD_PREFIX]),
+            ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
             ('set', CACHE_RULE_MATCH_PREFIX),
 
             # Snippet cache miss
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
-            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX,
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
             ('set', CACHE_SNIPPET_LOOKUP_PREFIX),
 
@@ -353,37 +993,28 @@ class TestSnippetsCache(HomesnippetsTestCase):
 
             # Request #1 - cache miss on rules and snippets
             ('get', CACHE_RULE_MATCH_PREFIX),
-            ('get_many', [CACHE_RULE_ALL_PREFIX,
-                          CACHE_RULE_ALL_LASTMOD_PREFIX]),
+            ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
             ('set', CACHE_RULE_MATCH_PREFIX),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
-            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX,
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
             # Snippets looked up & cached for this request only
             ('set', CACHE_SNIPPET_LOOKUP_PREFIX),
 
             # Request #2 - cache miss on rules, but hit on snippets
             ('get', CACHE_RULE_MATCH_PREFIX),
-            ('get_many', [CACHE_RULE_ALL_PREFIX,
-                          CACHE_RULE_ALL_LASTMOD_PREFIX]),
+            ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
             ('set', CACHE_RULE_MATCH_PREFIX),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
-            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX,
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
 
             # Request #3 - cache miss on rules, but hit on snippets
             ('get', CACHE_RULE_MATCH_PREFIX),
-            ('get_many', [CACHE_RULE_ALL_PREFIX,
-                          CACHE_RULE_ALL_LASTMOD_PREFIX]),
+            ('get', CACHE_RULE_ALL_LASTMOD_PREFIX),
             ('set', CACHE_RULE_MATCH_PREFIX),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
-            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX,
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
 
             # Request #4 - cache hits, all around
@@ -393,9 +1024,7 @@ class TestSnippetsCache(HomesnippetsTestCase):
                           CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_NEW_LASTMOD_PREFIX]),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
-            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX,
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
 
             # Request #5 - cache hits, all around
@@ -405,9 +1034,7 @@ class TestSnippetsCache(HomesnippetsTestCase):
                           CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_NEW_LASTMOD_PREFIX]),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
-            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX,
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
 
             # Request #6 - cache hits, all around
@@ -417,9 +1044,7 @@ class TestSnippetsCache(HomesnippetsTestCase):
                           CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_RULE_NEW_LASTMOD_PREFIX]),
             ('get', CACHE_SNIPPET_LOOKUP_PREFIX),
-            ('get_many', [CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX, CACHE_RULE_LASTMOD_PREFIX,
-                          CACHE_RULE_LASTMOD_PREFIX,
+            ('get_many', [CACHE_RULE_LASTMOD_PREFIX,
                           CACHE_SNIPPET_LASTMOD_PREFIX]),
 
         ))
@@ -440,6 +1065,31 @@ class TestSnippetsCache(HomesnippetsTestCase):
             ),
         })
 
+    def test_invalidation_on_exclusion_removed(self):
+        """A snippet dropped by an exclude rule should show up again once
+        the exclusion is removed from it, for cached lookups and responses
+        alike"""
+        self.rules['all'].delete()
+        path = '/9/Waterduck/9.2/xxx/xxx/en-US/xxx/xxx/default/default/'
+        for response_cache in (False, True):
+            homesnippets.models.RESPONSE_CACHE = response_cache
+            try:
+                rule = ClientMatchRule(locale='en-US', exclude=True)
+                rule.save()
+                snippet = Snippet(body='Not for English %s' % response_cache)
+                snippet.save()
+                snippet.client_match_rules.add(rule)
+
+                for idx in range(2):
+                    self.assert_snippets({ path: ((snippet, False),) })
+
+                time.sleep(1)
+                snippet.client_match_rules.remove(rule)
+                snippet.save()
+                self.assert_snippets({ path: ((snippet, True),) })
+            finally:
+                homesnippets.models.RESPONSE_CACHE = False
+
     def assert_cache_events(self, expected_events):
         """Match up a set of expected cache events and prefixes with the cache
         log. Clears the log after a successful assertion set."""
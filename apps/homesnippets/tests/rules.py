@@ -264,3 +264,34 @@ class TestSnippetsMatch(HomesnippetsTestCase):
                 (snippets['4.0'], True),
             ),
         })
+
+    def test_exclusion_rules_only(self):
+        """
+        A client matching only exclusion rules should be sent the snippets
+        without any inclusion rules that it isn't excluded from.
+        """
+        rules = self.setup_rules({
+            'fields': ('name', 'locale', 'exclude'),
+            'items': {
+                'firefox': ('Firefox', None, False),
+                'not_de': (None, 'de', True),
+                'not_fr': (None, 'fr', True),
+            }
+        })
+
+        snippets = self.setup_snippets(rules, {
+            'fields': ('name', 'body', 'rules'),
+            'items': {
+                'fire': ('Firefox', 'Firefox only', (rules['firefox'],)),
+                'not_de': ('Not de', 'Anything but de', (rules['not_de'],)),
+                'not_fr': ('Not fr', 'Anything but fr', (rules['not_fr'],)),
+            }
+        })
+
+        self.assert_snippets({
+            '/1/Mudfish/4.0/xxx/xxx/de/xxx/xxx/default/default/': (
+                (snippets['fire'], False),
+                (snippets['not_de'], False),
+                (snippets['not_fr'], True),
+            ),
+        })
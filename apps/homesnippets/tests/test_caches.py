@@ -0,0 +1,260 @@
+"""
+homesnippets in-process cache tests
+"""
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
+
+from django.core.cache.backends import locmem
+from django.test import TestCase
+
+from nose.tools import eq_, ok_
+
+from homesnippets.caches import (LOCK_PREFIX, CacheStats, LocalCache,
+                                 refresh_later, single_flight)
+
+
+class TestLocalCache(TestCase):
+    """Exercise the bounded in-process cache"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = LocalCache(2, 60, clock=lambda: self.now)
+
+    def test_stamps(self):
+        """Entries should only be served under the stamp they were stored
+        with"""
+        self.cache.set('a', 'A', 1)
+        eq_('A', self.cache.get('a', 1))
+        eq_(None, self.cache.get('a', 2))
+        eq_(None, self.cache.get('a', 1))
+        eq_(dict(hits=1, misses=2, evictions=0, expirations=1, size=0,
+                 max_size=2), self.cache.stats())
+
+    def test_ttl(self):
+        self.cache.set('a', 'A', 1)
+        self.now += 59
+        eq_('A', self.cache.get('a', 1))
+        self.now += 1
+        eq_('x', self.cache.get('a', 1, 'x'))
+
+    def test_eviction(self):
+        for key in 'abc':
+            self.cache.set(key, key.upper(), 1)
+        eq_(None, self.cache.get('a', 1))
+        eq_('C', self.cache.get('c', 1))
+        eq_(1, self.cache.stats()['evictions'])
+
+
+class TaskList(object):
+    """Stand-in for a thread pool, holding on to tasks until run"""
+
+    def __init__(self):
+        self.tasks = []
+
+    def apply_async(self, func):
+        self.tasks.append(func)
+
+    def run(self):
+        while self.tasks:
+            self.tasks.pop(0)()
+
+
+class TestSingleFlight(TestCase):
+    """Exercise stampede protection for recomputed cache entries"""
+
+    def setUp(self):
+        self.cache = locmem.CacheClass('', {})
+        self.computed = []
+        self.waits = []
+
+    def compute(self):
+        self.computed.append(1)
+        self.cache.set('key', 'new')
+        return 'new'
+
+    def single_flight(self, **kwargs):
+        return single_flight(self.cache, 'key', self.compute,
+                             lambda: self.cache.get('key'),
+                             sleep=self.waits.append, **kwargs)
+
+    def test_lease(self):
+        """The caller holding the lease should recompute, and let go of it
+        after"""
+        eq_('new', self.single_flight())
+        eq_([1], self.computed)
+        eq_(None, self.cache.get(LOCK_PREFIX + 'key'))
+
+    def test_previous(self):
+        """Others should get the value being replaced, if there is one"""
+        self.cache.add(LOCK_PREFIX + 'key', 1)
+        eq_('old', self.single_flight(previous='old'))
+        eq_([], self.computed)
+        eq_([], self.waits)
+
+    def test_wait(self):
+        """Otherwise, they should poll for the new value, and give up on it
+        eventually"""
+        self.cache.add(LOCK_PREFIX + 'key', 1)
+        self.cache.set('key', 'theirs')
+        eq_('theirs', self.single_flight(wait=0.1))
+        eq_([0.1], self.waits)
+
+        self.cache.delete('key')
+        eq_('new', self.single_flight(wait=0.1, retries=3))
+        eq_([0.1] * 4, self.waits)
+        eq_([1], self.computed)
+
+
+class DownCache(locmem.CacheClass):
+    """Cache failing open, as with its server down"""
+
+    def add(self, key, value, timeout=None):
+        return False
+
+    def get(self, key, default=None):
+        return default
+
+
+class TestSingleFlightDown(TestCase):
+    """Exercise stampede protection with the cache server down"""
+
+    def test_no_lease(self):
+        """Everyone should recompute straight away, without waiting"""
+        cache, waits = DownCache('', {}), []
+        eq_('new', single_flight(cache, 'key', lambda: 'new',
+                                 lambda: cache.get('key'),
+                                 sleep=waits.append))
+        eq_([], waits)
+
+
+class TestRefreshLater(TestCase):
+    """Exercise background refreshes of cache entries"""
+
+    def setUp(self):
+        self.cache = locmem.CacheClass('', {})
+        self.pool = TaskList()
+
+    def test_refresh(self):
+        """Only one refresh should be started until it is done"""
+        compute = lambda: self.cache.set('key', 'new')
+        ok_(refresh_later(self.pool, self.cache, 'key', compute))
+        ok_(not refresh_later(self.pool, self.cache, 'key', compute))
+        eq_(None, self.cache.get('key'))
+
+        self.pool.run()
+        eq_('new', self.cache.get('key'))
+        ok_(refresh_later(self.pool, self.cache, 'key', compute))
+
+    def test_failure(self):
+        """A failed refresh should let go of the lease"""
+        refresh_later(self.pool, self.cache, 'key', lambda: 1 / 0)
+        self.pool.run()
+        eq_(None, self.cache.get(LOCK_PREFIX + 'key'))
+
+    def test_fresh_reads(self):
+        """Refreshes run one after another on the same thread should each
+        read from a new snapshot"""
+        rows = ['old']
+        reader = SnapshotReader(rows)
+        pool = ThreadPool(1)
+        try:
+            for change in ('new', None):
+                refresh_later(pool, self.cache, 'key',
+                              lambda: self.cache.set('key', reader.read()),
+                              close=reader.close)
+                pool.apply(lambda: None)
+                if change:
+                    rows[0] = change
+        finally:
+            pool.close()
+            pool.join()
+        eq_(['new'], self.cache.get('key'))
+        eq_(2, reader.snapshots)
+
+
+class SnapshotReader(object):
+    """Stands in for a database connection in a repeatable read transaction,
+    which keeps reading the rows as of its first read until closed."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.snapshot = None
+        self.snapshots = 0
+
+    def read(self):
+        if self.snapshot is None:
+            self.snapshot = list(self.rows)
+            self.snapshots += 1
+        return self.snapshot
+
+    def close(self):
+        self.snapshot = None
+
+
+class TestCacheStats(TestCase):
+    """Exercise cache event counts shared across processes"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = locmem.CacheClass('', {})
+        self.stats = [ CacheStats(['a', 'b'], 10, clock=lambda: self.now)
+                       for idx in range(2) ]
+
+    def test_totals(self):
+        """Counts should be added into shared totals every interval"""
+        first, second = self.stats
+        first.count(self.cache, 'a', hits=1)
+        second.count_sets(self.cache, 'a', ['xyz'])
+        first.count(self.cache, 'a', hits=2, misses=1)
+        second.count(self.cache, 'b', invalidations=1)
+
+        totals, since = first.totals(self.cache)
+        eq_(dict(hits=3, misses=1, invalidations=0, sets=1), dict(
+            (event, n) for event, n in totals['a'].items()
+            if event not in ('sized', 'bytes')))
+        eq_(1, totals['a']['sized'])
+        ok_(totals['a']['bytes'] > 3)
+        eq_(0, totals['b']['invalidations'])
+        eq_(1000.0, since)
+
+        self.now += 10
+        second.count(self.cache, 'a')
+        eq_(1, first.totals(self.cache)[0]['b']['invalidations'])
+
+        # Counting starts over from the next sync.
+        first.reset(self.cache)
+        totals, since = first.totals(self.cache)
+        eq_(dict.fromkeys(CacheStats.EVENTS, 0), totals['a'])
+        eq_(1010.0, since)
+
+    def test_sample(self):
+        """Only one in every sample values written should be measured"""
+        stats = CacheStats(['a'], 0, clock=lambda: self.now, sample=3)
+        for values in (['x'], ['x', 'y'], ['x', 'y', 'z', 'w'], ['x']):
+            stats.count_sets(self.cache, 'a', values)
+        totals, since = stats.totals(self.cache)
+        eq_(8, totals['a']['sets'])
+        eq_(3, totals['a']['sized'])
+        eq_(3 * len(pickle.dumps('x', pickle.HIGHEST_PROTOCOL)),
+            totals['a']['bytes'])
+
+    def test_flush(self):
+        """Flushes should reach other processes at their next sync"""
+        first, second = self.stats
+        ok_(not second.is_flushed(self.cache, 'a', 999.0))
+        first.flush(self.cache, 'a', 1000.0)
+        ok_(first.is_flushed(self.cache, 'a', 999.0))
+        ok_(not first.is_flushed(self.cache, 'a', 1000.0))
+        ok_(not first.is_flushed(self.cache, 'b', 999.0))
+
+        ok_(not second.is_flushed(self.cache, 'a', 999.0))
+        self.now += 10
+        ok_(second.is_flushed(self.cache, 'a', 999.0))
+
+    def test_down(self):
+        """Counting should carry on, dropping counts, with the cache down"""
+        cache = DownCache('', {})
+        stats = CacheStats(['a'], 0, clock=lambda: self.now)
+        stats.count(cache, 'a', hits=1)
+        stats.count_sets(cache, 'a', ['x'])
+        ok_(not stats.is_flushed(cache, 'a', 999.0))
@@ -0,0 +1,92 @@
+"""
+homesnippets LRU mapping tests
+"""
+import random
+import threading
+
+from django.test import TestCase
+
+from nose.tools import eq_, ok_
+
+from homesnippets.lru import LRUCache
+
+
+class TestLRUCache(TestCase):
+    """Exercise the bounded LRU mapping"""
+
+    def test_get_set(self):
+        lru = LRUCache(3)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        eq_(1, lru.get('a'))
+        eq_(None, lru.get('c'))
+        eq_('x', lru.get('c', 'x'))
+        ok_('b' in lru)
+        eq_(2, len(lru))
+
+    def test_eviction(self):
+        """The least recently used item should be dropped when full"""
+        lru = LRUCache(3)
+        for key in 'abc':
+            lru.set(key, key.upper())
+        lru.get('a')
+        lru.set('d', 'D')
+        eq_(['d', 'a', 'c'], lru.keys())
+        eq_(None, lru.get('b'))
+        eq_(1, lru.evictions)
+
+        lru.set('c', 'C2')
+        eq_(['c', 'd', 'a'], lru.keys())
+        eq_('C2', lru.get('c'))
+
+    def test_delete_and_clear(self):
+        lru = LRUCache(3)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.delete('a')
+        lru.delete('nope')
+        eq_(['b'], lru.keys())
+        lru.clear()
+        eq_([], lru.keys())
+        eq_(0, len(lru))
+
+    def test_replace(self):
+        """Replacing a value should not change the order of use"""
+        lru = LRUCache(3)
+        for key in 'abc':
+            lru.set(key, key.upper())
+        lru.replace('a', 'A2')
+        eq_([('c', 'C'), ('b', 'B'), ('a', 'A2')], lru.items())
+
+    def test_copy(self):
+        """Copies should keep the order of use, and change independently"""
+        lru = LRUCache(3)
+        for key in 'abc':
+            lru.set(key, key.upper())
+        lru.get('a')
+        copy = lru.copy()
+        eq_(lru.items(), copy.items())
+        copy.replace('b', 'B2')
+        copy.set('d', 'D')
+        eq_([('a', 'A'), ('c', 'C'), ('b', 'B')], lru.items())
+        eq_([('d', 'D'), ('a', 'A'), ('c', 'C')], copy.items())
+
+    def test_threads(self):
+        """Concurrent use from many threads should keep the list intact"""
+        lru = LRUCache(50)
+
+        def use():
+            for idx in range(5000):
+                key = random.randint(0, 99)
+                if lru.get(key) is None:
+                    lru.set(key, key)
+
+        threads = [ threading.Thread(target=use) for idx in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        keys = lru.keys()
+        eq_(50, len(keys))
+        eq_(sorted(keys), sorted(set(keys)))
+        eq_(sorted(keys), sorted(lru.links.keys()))
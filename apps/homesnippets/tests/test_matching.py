@@ -0,0 +1,491 @@
+"""
+homesnippets compiled rule matcher tests
+"""
+import cPickle as pickle
+import re
+
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+
+from nose.tools import eq_, ok_, assert_raises
+
+from homesnippets.matching import (BuildIdRangeCondition, ExactCondition,
+                                   FieldRegexSet, LocalePrefixCondition,
+                                   IntervalIndex, RegexCondition,
+                                   RuleCompileError, RuleIndex, RuleSnapshot,
+                                   SNAPSHOT_SCHEMA, VersionRangeCondition,
+                                   bit_positions, compile_condition,
+                                   compile_rule, compile_rule_safely,
+                                   parse_version, regex_hazards, rule_bits,
+                                   rule_row)
+from homesnippets.models import ClientMatchRule
+
+
+CLIENT = dict(startpage_version='1', name='Firefox', version='4.0',
+              appbuildid='20110318052756', build_target='WINNT_x86-msvc',
+              locale='en-US', channel='release', os_version='Windows_NT 6.1',
+              distribution='default', distribution_version='default')
+
+
+class TestRuleMatcher(TestCase):
+    """Exercise compiled client match rules"""
+
+    def test_conditions_cheapest_first(self):
+        """Exact conditions should be checked before regexes"""
+        matcher = compile_rule(rule_row(ClientMatchRule(
+            id=1, appbuildid='2011', name='/Fire.*/', locale='en-US')))
+        eq_([ExactCondition, ExactCondition, RegexCondition],
+            [type(c) for c in matcher.conditions])
+        eq_(['locale', 'appbuildid', 'name'],
+            [c.field for c in matcher.conditions])
+
+    def test_match(self):
+        """Compiled rules should match like the rules they came from"""
+        cases = (
+            (dict(), True),
+            (dict(name='Firefox', locale='en-US'), True),
+            (dict(name='Firefox', locale='de'), False),
+            (dict(name='/(Firefox|Mudfish)/', version='4.0'), True),
+            (dict(name='/Mudfish/', version='4.0'), False),
+            (dict(version='/4\.\d/', locale='/en-/'), True),
+        )
+        for values, expected in cases:
+            matcher = compile_rule(rule_row(ClientMatchRule(id=1, **values)))
+            eq_(expected, matcher.is_match(CLIENT),
+                '%s should%smatch' % (values, expected and ' ' or ' not '))
+
+    def test_missing_args_ignored(self):
+        """Conditions on fields absent from the request are skipped"""
+        matcher = compile_rule(rule_row(ClientMatchRule(
+            id=1, name='Firefox', locale='de')))
+        ok_(matcher.is_match(dict(name='Firefox')))
+
+    def test_invalid_regex(self):
+        """Invalid regexes should be flagged when compiled, not at match"""
+        rule = ClientMatchRule(id=1, name='/Fire(fox/')
+        assert_raises(RuleCompileError, compile_rule, rule_row(rule))
+
+        matcher = compile_rule_safely(rule_row(rule))
+        ok_(matcher.error is not None)
+        ok_(not matcher.is_match(CLIENT))
+        ok_(not rule.is_match(CLIENT))
+
+    def test_clean_rejects_invalid_regex(self):
+        """Model validation should reject rules with invalid regexes"""
+        assert_raises(ValidationError,
+                      ClientMatchRule(locale='/en-(US/').clean)
+        ClientMatchRule(locale='/en-(US|GB)/').clean()
+
+    def test_regex_hazards(self):
+        """Patterns prone to catastrophic backtracking should be flagged"""
+        for pattern in (r'(a+)+b', r'(.*)*', r'(\w+\s?)+$', r'.*.*x',
+                        r'(a|ab)*c', r'(a|.)*'):
+            ok_(regex_hazards(pattern), pattern)
+        for pattern in (r'4\.\d', r'(beta|aurora)*', r'(\d+\.)+\d+',
+                        r'([^.]+\.)+x', r'[a-z]+.*', r'(?:a|b)+', r'(x'):
+            eq_([], regex_hazards(pattern), pattern)
+
+    def test_clean_rejects_slow_regex(self):
+        """Model validation should reject regexes prone to catastrophic
+        backtracking, though they still compile"""
+        rule = ClientMatchRule(id=1, version='/(\d+)+\.0/')
+        assert_raises(ValidationError, rule.clean)
+        ok_(compile_rule(rule_row(rule)).is_match(CLIENT))
+
+
+class TestRuleIndex(TestCase):
+    """Exercise the inverted index over exact-value rules"""
+
+    def setUp(self):
+        rules = [
+            ClientMatchRule(id=1, locale='en-US'),
+            ClientMatchRule(id=2, locale='de', exclude=True),
+            ClientMatchRule(id=3, name='Firefox', version='4.0'),
+            ClientMatchRule(id=4, name='Firefox', version='3.6'),
+            ClientMatchRule(id=5, version='/4\.\d/', locale='en-US'),
+            ClientMatchRule(id=6),
+            ClientMatchRule(id=7, channel='/(beta|aurora)/', exclude=True),
+            ClientMatchRule(id=8, locale='/en-(US/'),
+        ]
+        self.matchers = [compile_rule_safely(rule_row(r)) for r in rules]
+        self.index = RuleIndex(self.matchers)
+
+    def test_layout(self):
+        """Exact values should be indexed, regexes merged per field"""
+        eq_(0x7f, self.index.all_bits)
+        eq_(0x0c, self.index.exact[('name', 'Firefox')])
+        eq_(0x11, self.index.exact[('locale', 'en-US')])
+        eq_(0x6c, self.index.wildcard['locale'])
+        eq_(0x7f, self.index.wildcard['appbuildid'])
+        eq_(['channel', 'version'], sorted(self.index.regexes.keys()))
+
+    def test_field_memo(self):
+        """Per-field results should be remembered by value"""
+        args = dict(CLIENT, appbuildid='20110401000000')
+        self.index.find_matches(args)
+        eq_(['20110401000000'], self.index.memos['appbuildid'].keys())
+        eq_(0x6e, self.index.field_matches('locale', 'de'))
+
+        memo_index = RuleIndex(self.matchers, memo_size=2)
+        for build in ('1', '2', '3'):
+            memo_index.find_matches(dict(CLIENT, appbuildid=build))
+        eq_(['3', '2'], memo_index.memos['appbuildid'].keys())
+
+    def test_value_classes(self):
+        """Values treated alike by every rule should share a class"""
+        eq_(0, self.index.value_class('locale', 'fr'))
+        eq_(0, self.index.value_class('locale', 'ja-JP-mac'))
+        eq_(0x11, self.index.value_class('locale', 'en-US'))
+        eq_(self.index.value_class('version', '4.1'),
+            self.index.value_class('version', '4.2'))
+        ok_(self.index.value_class('version', '4.0') !=
+            self.index.value_class('version', '4.1'))
+
+        eq_(('channel', 'locale', 'name', 'version'),
+            tuple(sorted(self.index.referenced_fields)))
+        eq_(self.index.class_vector(dict(CLIENT, appbuildid='1', locale='fr')),
+            self.index.class_vector(dict(CLIENT, appbuildid='2', locale='it')))
+        eq_((0x0c, 0x0, 0x02, None),
+            self.index.class_vector(dict(name='Firefox', version='3.0',
+                                         locale='de', appbuildid='1')))
+
+    def test_same_as_scan(self):
+        """The index should find the same rules as checking every rule"""
+        clients = (
+            CLIENT,
+            dict(CLIENT, locale='de'),
+            dict(CLIENT, version='3.6', channel='beta'),
+            dict(CLIENT, name='Mudfish', locale='en-GB', channel='aurora'),
+            dict(name='Firefox'),
+            dict(),
+        )
+        for args in clients:
+            expected = set(pos for pos, m in enumerate(self.matchers)
+                           if m.is_match(args))
+            eq_(expected, self.index.find_matches(args))
+
+    def test_partition(self):
+        """Unmatched include rules should land in the exclude list"""
+        eq_((['1', '3', '5', '6'], ['4', '8']), self.index.partition(CLIENT))
+        eq_((['4', '6'], ['1', '2', '3', '5', '7', '8']),
+            self.index.partition(dict(CLIENT, locale='de', version='3.6',
+                                      channel='beta')))
+
+
+    def test_apply_change(self):
+        """Changing rules one at a time should give the same results as
+        indexing the changed rules from scratch"""
+        clients = (CLIENT, dict(CLIENT, locale='de', channel='beta'),
+                   dict(CLIENT, version='3.6', locale='pt-BR'), dict())
+        # Warm up the field memos, which should get patched.
+        for args in clients:
+            self.index.partition(args)
+
+        changes = (
+            (3, ClientMatchRule(id=3, name='Firefox', version='>=3.6')),
+            (1, None),
+            (9, ClientMatchRule(id=9, locale='pt-*', exclude=True)),
+            (8, ClientMatchRule(id=8, locale='/en-(US|GB)/')),
+            (10, ClientMatchRule(id=10, channel='beta')),
+            (6, None),
+        )
+        matchers = list(self.matchers)
+        for rule_id, rule in changes:
+            matcher = rule and compile_rule_safely(rule_row(rule))
+            self.index.apply_change(rule_id, matcher)
+            ids = [m and m.id for m in matchers]
+            if rule_id in ids:
+                matchers[ids.index(rule_id)] = matcher
+            else:
+                matchers.append(matcher)
+
+            fresh = RuleIndex(matchers)
+            eq_(fresh.all_bits, self.index.all_bits)
+            eq_(fresh.referenced_fields, self.index.referenced_fields)
+            for args in clients:
+                eq_(fresh.partition(args), self.index.partition(args))
+                eq_(fresh.class_vector(args), self.index.class_vector(args))
+
+        eq_(None, self.index.matchers[0])
+        ok_('1' not in self.index.positions)
+
+    def test_copy(self):
+        """Changes to a copy of the index should leave the original as it
+        was, memos included"""
+        clients = (CLIENT, dict(CLIENT, locale='de', channel='beta'))
+        before = [self.index.partition(args) for args in clients]
+        memo = self.index.memos['locale'].items()
+        copy = self.index.copy()
+        copy.apply_change(1, None)
+        copy.apply_change(7, compile_rule_safely(
+            rule_row(ClientMatchRule(id=7, channel='/beta/'))))
+        copy.apply_change(9, compile_rule_safely(
+            rule_row(ClientMatchRule(id=9, locale='de'))))
+        eq_(before, [self.index.partition(args) for args in clients])
+        eq_(memo, self.index.memos['locale'].items())
+        ok_('1' in self.index.positions)
+        fresh = RuleIndex(copy.matchers)
+        eq_([fresh.partition(args) for args in clients],
+            [copy.partition(args) for args in clients])
+
+    def test_update_partition(self):
+        """Stale partitions should be fixed up by checking changed rules"""
+        args = dict(CLIENT, channel='beta')
+        before = self.index.partition(args)
+        self.index.apply_change(4, compile_rule_safely(
+            rule_row(ClientMatchRule(id=4, channel='beta'))))
+        self.index.apply_change(2, None)
+        self.index.apply_change(9, compile_rule_safely(
+            rule_row(ClientMatchRule(id=9, exclude=True))))
+        eq_(self.index.partition(args),
+            self.index.update_partition(args, before, set(['2', '4', '9'])))
+
+
+def test_bit_positions():
+    """Bitsets should convert back to rule positions"""
+    eq_([], bit_positions(0))
+    eq_([0, 2, 70], bit_positions(1 | 4 | 1 << 70))
+
+
+def test_rule_bits():
+    """Rule IDs should make bitsets that convert back to them"""
+    eq_(0, rule_bits([]))
+    eq_([3, 17, 4096], bit_positions(rule_bits(['17', 3, '4096'])))
+    ids = [str(i) for i in range(0, 20000, 7)]
+    eq_(sum(1 << int(i) for i in ids), rule_bits(ids))
+    eq_(rule_bits(ids), rule_bits(list(reversed(ids))))
+    eq_(range(0, 20000, 7), bit_positions(rule_bits(ids)))
+
+
+class TestFieldRegexSet(TestCase):
+    """Exercise merged regexes for a single field"""
+
+    def build(self, patterns):
+        return FieldRegexSet('version', [
+            (pos, RegexCondition('version', pattern))
+            for pos, pattern in enumerate(patterns)])
+
+    def test_all_matches_reported(self):
+        """Every matching pattern should be reported by one scan"""
+        patterns = (r'4\.', r'4\.0$', r'3\.6', r'(4|5)\.(\d+)', r'.*',
+                    r'(?:x|4)', r'4\.0b\d+')
+        regexes = self.build(patterns)
+        eq_(1, len(regexes.combined))
+        eq_([], regexes.separate)
+        for value in ('4.0', '4.0b12', '3.6.13', '5.1', ''):
+            expected = [pos for pos, pattern in enumerate(patterns)
+                        if re.match(pattern, value)]
+            eq_(expected, sorted(regexes.find_matches(value)))
+
+    def test_uncombinable_patterns(self):
+        """Backreferences, conditional group references and inline flags
+        should be checked separately"""
+        regexes = self.build((r'(\d)\.\1', r'(?i)FIREFOX', r'(?P<v>4)',
+                              r'4\.0', r'(x)?(?(1)y|z)'))
+        eq_([0, 1, 2, 4], [pos for pos, c in regexes.separate])
+        eq_([2, 3], sorted(regexes.find_matches('4.0')))
+        eq_([0, 2], sorted(regexes.find_matches('4.4')))
+        eq_([4], sorted(regexes.find_matches('xy')))
+
+    def test_group_limit(self):
+        """Patterns should be split across expressions before running out of
+        groups"""
+        regexes = self.build([r'(%s)(\.\d+)' % n for n in range(100)])
+        eq_(4, len(regexes.combined))
+        eq_([42], regexes.find_matches('42.1'))
+
+
+class TestVersionRanges(TestCase):
+    """Exercise version range conditions and their interval index"""
+
+    def test_parse_version(self):
+        """Versions should sort the way the toolkit compares them"""
+        ordered = ('1.0a1', '1.0b1', '1.0b2', '1.0pre', '1.0', '1.0.1',
+                   '1.1', '4.0b7pre', '4.0b7', '4.0', '4.0.1', '10.0')
+        keys = [parse_version(v) for v in ordered]
+        eq_(keys, sorted(keys))
+        eq_(parse_version('4'), parse_version('4.0.0'))
+        assert_raises(ValueError, parse_version, '')
+
+    def test_parse_version_wildcards(self):
+        """* should sort above any other part, and + mean the prerelease of
+        the next number"""
+        ordered = ('4.0', '4.99.1', '4.*', '5.0a1', '5.0', '*')
+        keys = [parse_version(v) for v in ordered]
+        eq_(keys, sorted(keys))
+        eq_(parse_version('4.0+'), parse_version('4.1pre'))
+        ok_(parse_version('4.0+') < parse_version('4.1'))
+
+    def test_compile(self):
+        """Range syntax should only apply to version fields"""
+        ok_(isinstance(compile_condition('version', '>=4.0,<10'),
+                       VersionRangeCondition))
+        ok_(isinstance(compile_condition('startpage_version', '>1'),
+                       VersionRangeCondition))
+        ok_(isinstance(compile_condition('locale', '>=4.0'),
+                       ExactCondition))
+        for spec in ('>=', '>=4.0,', '>=4.0,~5', '>=4.0;<10'):
+            assert_raises(RuleCompileError, compile_condition, 'version',
+                          spec)
+
+    def test_matches(self):
+        condition = VersionRangeCondition('version', '>=4.0, <10')
+        for value in ('4.0', '4.0.1', '9.0.1', '9.0b1'):
+            ok_(condition.matches(value), value)
+        for value in ('3.6.13', '4.0b12', '10.0', '10', ''):
+            ok_(not condition.matches(value), value)
+        ok_(VersionRangeCondition('version', '=3.6').matches('3.6.0'))
+        ok_(not VersionRangeCondition('version', '>4,<4').matches('4'))
+
+        condition = VersionRangeCondition('version', '>=4.0,<=4.*')
+        for value in ('4.0', '4.0.1', '4.6b1', '4.99'):
+            ok_(condition.matches(value), value)
+        for value in ('3.6', '4.0b1', '5.0a1', '5.0'):
+            ok_(not condition.matches(value), value)
+
+    def test_interval_index(self):
+        """The interval index should find the same rules as checking each
+        range"""
+        specs = ('>=4.0,<10', '<4.0b1', '=3.6', '>3.6', '<=3.6', '>=10',
+                 '>5,<5', '>=1.0')
+        conditions = [(pos, VersionRangeCondition('version', spec))
+                      for pos, spec in enumerate(specs)]
+        index = IntervalIndex('version', conditions)
+        for value in ('1.0', '0.9', '3.5', '3.6', '3.6.1', '4.0a1', '4.0',
+                      '5', '9.9', '10', '10.0.1', '99'):
+            expected = [pos for pos, c in conditions if c.matches(value)]
+            eq_(expected, bit_positions(index.find_bits(value)), value)
+
+    def test_rule_index(self):
+        rules = [ClientMatchRule(id=1, version='>=4.0,<10'),
+                 ClientMatchRule(id=2, version='/^4/'),
+                 ClientMatchRule(id=3, version='>=4.0,<10', exclude=True)]
+        index = RuleIndex([compile_rule(rule_row(r)) for r in rules])
+        eq_((['1', '2'], ['3']), index.partition(CLIENT))
+        eq_(([], ['1', '2']),
+            index.partition(dict(CLIENT, version='3.6')))
+        eq_((['1'], ['2', '3']),
+            index.partition(dict(CLIENT, version='9.0')))
+
+
+class TestBuildIdRanges(TestCase):
+    """Exercise build ID range conditions"""
+
+    def test_matches(self):
+        condition = compile_condition('appbuildid',
+                                      '>=20110301,<20110401120000')
+        ok_(isinstance(condition, BuildIdRangeCondition))
+        for value in ('20110301000000', '20110318052756', '20110401115959'):
+            ok_(condition.matches(value), value)
+        for value in ('20110228235959', '20110401120000', '2011031805275x',
+                      '201103180527561', ''):
+            ok_(not condition.matches(value), value)
+        assert_raises(RuleCompileError, compile_condition, 'appbuildid',
+                      '>=2011-03-01')
+
+    def test_short_bounds(self):
+        """Short operands should stand for the whole period they name"""
+        condition = compile_condition('appbuildid', '<=20110331')
+        for value in ('20110331000000', '20110331235959'):
+            ok_(condition.matches(value), value)
+        ok_(not condition.matches('20110401000000'))
+
+        condition = compile_condition('appbuildid', '>20110330')
+        ok_(condition.matches('20110331000000'))
+        ok_(not condition.matches('20110330235959'))
+
+        condition = compile_condition('appbuildid', '=20110331')
+        for value in ('20110331000000', '20110331235959'):
+            ok_(condition.matches(value), value)
+        for value in ('20110330235959', '20110401000000'):
+            ok_(not condition.matches(value), value)
+
+    def test_rule_index(self):
+        """Build ID ranges should be found through the interval index"""
+        rules = [ClientMatchRule(id=1, appbuildid='>=20110301'),
+                 ClientMatchRule(id=2, appbuildid='<20110318052756'),
+                 ClientMatchRule(id=3, appbuildid='=20110318052756'),
+                 ClientMatchRule(id=4, appbuildid='/^2011/')]
+        index = RuleIndex([compile_rule(rule_row(r)) for r in rules])
+        ok_('appbuildid' in index.ranges)
+        eq_((['1', '3', '4'], ['2']), index.partition(CLIENT))
+        eq_((['2', '4'], ['1', '3']),
+            index.partition(dict(CLIENT, appbuildid='20110201000000')))
+        eq_((['1'], ['2', '3', '4']),
+            index.partition(dict(CLIENT, appbuildid='20120101000000')))
+
+
+class TestLocalePrefixes(TestCase):
+    """Exercise locale prefix conditions and their trie"""
+
+    def test_matches(self):
+        condition = compile_condition('locale', 'pt-*')
+        ok_(isinstance(condition, LocalePrefixCondition))
+        for value in ('pt', 'pt-BR', 'pt-PT'):
+            ok_(condition.matches(value), value)
+        for value in ('ptx', 'p', 'en-US', ''):
+            ok_(not condition.matches(value), value)
+        ok_(isinstance(compile_condition('name', 'pt-*'), ExactCondition))
+        for value in ('-*', 'en--*', 'en-*-*'):
+            assert_raises(RuleCompileError, compile_condition, 'locale',
+                          value)
+
+    def test_rule_index(self):
+        """Exact, prefix and catch-all locale rules should be found in one
+        lookup"""
+        rules = [ClientMatchRule(id=1, locale='en-*'),
+                 ClientMatchRule(id=2, locale='en-US'),
+                 ClientMatchRule(id=3, locale='zh-Hant-*'),
+                 ClientMatchRule(id=4, locale='zh-*'),
+                 ClientMatchRule(id=5)]
+        index = RuleIndex([compile_rule(rule_row(r)) for r in rules])
+        ok_('locale' in index.prefixes)
+        eq_((['1', '2', '5'], ['3', '4']), index.partition(CLIENT))
+        eq_((['1', '5'], ['2', '3', '4']),
+            index.partition(dict(CLIENT, locale='en')))
+        eq_((['3', '4', '5'], ['1', '2']),
+            index.partition(dict(CLIENT, locale='zh-Hant-TW')))
+        eq_((['4', '5'], ['1', '2', '3']),
+            index.partition(dict(CLIENT, locale='zh-CN')))
+        eq_((['5'], ['1', '2', '3', '4']),
+            index.partition(dict(CLIENT, locale='english')))
+
+
+class TestRuleSnapshot(TestCase):
+    """Exercise the compact cached form of the set of all rules"""
+
+    def setUp(self):
+        self.rules = [ClientMatchRule(id=idx, description='rule %s' % idx,
+                                      name='Firefox', version='4.0',
+                                      locale='locale-%s' % idx)
+                      for idx in range(50)]
+
+    def test_round_trip(self):
+        """Snapshots should survive a trip through pickle"""
+        snapshot = RuleSnapshot.from_rules(self.rules)
+        loaded = RuleSnapshot.load(pickle.loads(pickle.dumps(snapshot.dump())))
+        eq_(snapshot.token, loaded.token)
+        eq_(snapshot.rows, loaded.rows)
+        eq_((7, False, None, 'Firefox', '4.0', None, None, 'locale-7', None,
+             None, None, None), loaded.rows[7])
+
+    def test_token(self):
+        """Snapshots of the same rules should share a token"""
+        token = RuleSnapshot.from_rules(self.rules).token
+        eq_(token, RuleSnapshot.from_rules(list(self.rules)).token)
+        self.rules[7].locale = 'fr'
+        ok_(token != RuleSnapshot.from_rules(self.rules).token)
+
+    def test_smaller_than_models(self):
+        """Snapshots should pickle much smaller than model instances"""
+        snapshot = RuleSnapshot.from_rules(self.rules)
+        snapshot_size = len(pickle.dumps(snapshot.dump(), 2))
+        models_size = len(pickle.dumps(self.rules, 2))
+        ok_(snapshot_size * 3 < models_size,
+            '%s vs %s bytes' % (snapshot_size, models_size))
+
+    def test_other_formats_rejected(self):
+        """Data not tagged with the current schema should not load"""
+        eq_(None, RuleSnapshot.load(self.rules))
+        eq_(None, RuleSnapshot.load(('rules-0:id', 'abc', ())))
+        ok_(RuleSnapshot.load((SNAPSHOT_SCHEMA, 'abc', ())))
@@ -0,0 +1,179 @@
+"""
+homesnippets pooled memcached backend tests
+"""
+import threading
+import time
+
+from django.core.cache import get_cache
+from django.test import TestCase
+
+from nose.tools import eq_, ok_
+
+from homesnippets.memcached import FLAG_COMPRESSED, FLAG_PICKLE, HashRing
+from homesnippets.memcached_server import MemcachedServer
+
+
+class TestPooledMemcached(TestCase):
+    """Exercise the memcached backend against a cluster of local stand-ins"""
+
+    def setUp(self):
+        self.servers = [MemcachedServer().start() for idx in range(3)]
+        self.cache = get_cache(
+            'homesnippets.memcached://%s/?socket_timeout=1&retry_after=60' %
+            ';'.join(server.address for server in self.servers))
+
+    def tearDown(self):
+        for server in self.servers:
+            try:
+                server.stop()
+            except Exception:
+                pass
+
+    def test_operations(self):
+        """Values of any type should round trip, with memcached semantics"""
+        values = dict(str='abc', unicode=u'\xe9', int=3, long=1L << 40,
+                      bool=True, none=None, tuple=(1.5, [u'x', {'y': 2}]),
+                      big='x' * 100000)
+        for key, value in values.items():
+            self.cache.set(key, value)
+            eq_(value, self.cache.get(key))
+        eq_('default', self.cache.get('missing', 'default'))
+
+        ok_(self.cache.add('added', 1))
+        ok_(not self.cache.add('added', 2))
+        eq_(3, self.cache.incr('added', 2))
+        eq_(2, self.cache.decr('added'))
+        self.assertRaises(ValueError, self.cache.incr, 'missing')
+
+        self.cache.delete('added')
+        eq_(None, self.cache.get('added'))
+        ok_('str' in self.cache)
+
+        self.cache.set('spaced out key', 1)
+        eq_(1, self.cache.get('spaced out key'))
+
+        self.cache.set('expiring', 1, -1)
+        eq_(None, self.cache.get('expiring'))
+
+        self.cache.clear()
+        eq_({}, self.cache.get_many(values.keys()))
+
+    def test_distribution(self):
+        """Keys should be spread over every node, and fetched together in a
+        single batch per node over one connection each"""
+        data = dict(('key%s' % idx, idx) for idx in range(300))
+        self.cache.set_many(data)
+        for server in self.servers:
+            ok_(len(server.items) > 50)
+        eq_(data, self.cache.get_many(data.keys() + ['missing']))
+        eq_([1, 1, 1], [server.connections for server in self.servers])
+
+    def test_thread_connections(self):
+        """Each thread should get its own connections"""
+        thread = threading.Thread(target=self.cache.get_many,
+                                  args=[['key%s' % idx for idx in range(30)]])
+        self.cache.get_many(['key%s' % idx for idx in range(30)])
+        thread.start()
+        thread.join()
+        eq_([2, 2, 2], [server.connections for server in self.servers])
+
+    def test_consistent_hashing(self):
+        """Dropping a node should only move the keys that were on it"""
+        nodes = [server.address for server in self.servers]
+        ring, smaller = HashRing(nodes), HashRing(nodes[:2])
+        moved = [key for key in ('key%s' % idx for idx in range(1000))
+                 if ring.node_for(key) != smaller.node_for(key)]
+        ok_(moved)
+        ok_(all(ring.node_for(key) == nodes[2] for key in moved))
+
+    def test_fail_open(self):
+        """A node going away should turn into misses on its keys, without
+        errors, and be left alone for a while"""
+        data = dict(('key%s' % idx, idx) for idx in range(100))
+        self.cache.set_many(data)
+        lost = self.servers.pop()
+        on_lost = set(key for key in data
+                      if self.cache.ring.node_for(key) == lost.address)
+        lost.stop()
+
+        start = time.time()
+        found = self.cache.get_many(data.keys())
+        eq_(set(data) - on_lost, set(found))
+        key = list(on_lost)[0]
+        eq_(None, self.cache.get(key))
+        self.cache.set(key, 1)
+        ok_(not self.cache.add(key, 1))
+        self.assertRaises(ValueError, self.cache.incr, key)
+        ok_(time.time() - start < 1)
+        ok_(self.cache.servers[lost.address].dead_until > time.time())
+
+    def test_recovery(self):
+        """A node should be tried again retry_after seconds after it failed,
+        however often it is asked for meanwhile"""
+        cache = get_cache(
+            'homesnippets.memcached://%s/?socket_timeout=1&retry_after=0.5' %
+            ';'.join(server.address for server in self.servers))
+        lost = self.servers.pop()
+        key = [ 'key%s' % idx for idx in range(100)
+                if cache.ring.node_for('key%s' % idx) == lost.address ][0]
+        lost.stop()
+
+        cache.set(key, 1)
+        dead_until = cache.servers[lost.address].dead_until
+        for idx in range(3):
+            time.sleep(0.1)
+            eq_(None, cache.get(key))
+            cache.set(key, 1)
+        eq_(dead_until, cache.servers[lost.address].dead_until)
+
+        host, port = lost.server_address
+        self.servers.append(MemcachedServer((host, port)).start())
+        time.sleep(max(0, dead_until - time.time()))
+        cache.set(key, 1)
+        eq_(1, cache.get(key))
+
+    def test_compression(self):
+        """Large values should be stored compressed, and values stored
+        uncompressed still read"""
+        body = '<img src="data:image/png;base64,%s" />' % ('iVBORw0K' * 2000)
+        lookup = (1000.0, (6, 8), [dict(id=idx, body=body)
+                                   for idx in range(5)])
+        self.cache.set('lookup', lookup)
+        self.cache.set('small', 'x' * 100)
+        eq_(lookup, self.cache.get('lookup'))
+
+        flags, data = self.server_for('lookup').lookup('lookup')
+        ok_(flags & FLAG_COMPRESSED)
+        ok_(len(data) * 10 < len(body) * 5)
+        eq_(0, self.server_for('small').lookup('small')[0])
+
+        stats = self.cache.compression_stats()
+        eq_(1, stats['compressed'])
+        ok_(stats['ratio'] > 5)
+
+        # Written by a backend that doesn't compress.
+        self.server_for('plain').store('set', 'plain', 0, 0, body)
+        eq_(body, self.cache.get('plain'))
+
+    def test_undecodable(self):
+        """Values that fail to decode should be misses, and leave the
+        connection in step for what follows"""
+        server = self.server_for('bad-zlib')
+        keys = [ 'key%s' % idx for idx in range(100)
+                 if self.server_for('key%s' % idx) is server ][:3]
+        self.cache.set_many(dict((key, key) for key in keys))
+        server.store('set', 'bad-zlib', FLAG_COMPRESSED, 0, 'not zlib')
+        server.store('set', 'bad-pickle', FLAG_PICKLE, 0, 'not a pickle')
+
+        found = self.cache.get_many(['bad-zlib'] + keys + ['bad-pickle'])
+        eq_(dict((key, key) for key in keys), found)
+        eq_(None, self.cache.get('bad-pickle'))
+        eq_(keys[0], self.cache.get(keys[0]))
+        self.cache.set('bad-zlib', 1)
+        eq_(1, self.cache.get('bad-zlib'))
+        ok_(not self.cache.servers[server.address].is_dead())
+
+    def server_for(self, key):
+        address = self.cache.ring.node_for(key)
+        return [ server for server in self.servers
+                 if server.address == address ][0]
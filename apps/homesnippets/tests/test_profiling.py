@@ -0,0 +1,151 @@
+"""
+homesnippets rule profiling tests
+"""
+import json
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from nose.tools import eq_, ok_
+
+from homesnippets.matching import compile_rule_safely, rule_row
+from homesnippets.models import ClientMatchRule
+from homesnippets.profiling import (load_clients, parse_client, profile_rules,
+                                    top_clients)
+from homesnippets.tests.utils import HomesnippetsTestCase
+
+
+PATH = '/1/Firefox/4.0/20110318052756/WINNT_x86-msvc/en-US/release/' \
+       'Windows_NT%206.1/default/default/'
+
+
+class TestProfiling(TestCase):
+    """Exercise timing rules against sample clients"""
+
+    def test_parse_client(self):
+        """Clients should be read from URLs, log lines and JSON"""
+        args = parse_client(PATH)
+        eq_('Firefox', args['name'])
+        eq_('en-US', args['locale'])
+        eq_(u'Windows_NT 6.1', args['os_version'])
+        eq_(args, parse_client('http://snippets.mozilla.com/preview' + PATH))
+        eq_(args, parse_client('1.2.3.4 - - [18/Mar/2011:05:27:56 -0700] '
+                               '"GET %s HTTP/1.1" 200 1234' % PATH))
+        eq_(dict(name='Firefox', locale='de'),
+            parse_client('{"name": "Firefox", "locale": "de", "x": 1}'))
+        for line in ('', '# comment', '/1/Firefox/4.0/', 'GET / HTTP/1.1',
+                     '{"request_id": "user-001"}', '{"name": "Fire',
+                     '{"name": "Firefox"} [1]'):
+            eq_(None, parse_client(line))
+
+        eq_(2, len(load_clients([PATH, '', PATH, PATH], limit=2)))
+
+    def test_parse_complete_client(self):
+        """Only public clients with every match field should be complete"""
+        args = parse_client(PATH)
+        eq_(args, parse_client(PATH, complete=True))
+        eq_(args, parse_client(json.dumps(args), complete=True))
+        for line in ('/preview' + PATH,
+                     json.dumps(dict(args, preview=True)),
+                     '{"name": "Firefox", "locale": "de"}'):
+            ok_(parse_client(line))
+            eq_(None, parse_client(line, complete=True))
+
+    def test_top_clients(self):
+        """Distinct clients should be counted, most frequent first"""
+        other = PATH.replace('en-US', 'de')
+        clients = top_clients([other, PATH, '', PATH, other, PATH])
+        eq_([3, 2], [count for count, args in clients])
+        eq_('en-US', clients[0][1]['locale'])
+        eq_(1, len(top_clients([other, PATH], 1)))
+
+    def test_profile_rules(self):
+        rules = [ClientMatchRule(id=1, locale='en-US'),
+                 ClientMatchRule(id=2, version='/(\d+)+\.0/'),
+                 ClientMatchRule(id=3, name='/Fire(fox/')]
+        clients = load_clients([PATH, PATH.replace('en-US', 'de')])
+        profiles = profile_rules([compile_rule_safely(rule_row(r))
+                                  for r in rules], clients, repeat=3)
+        profiles = dict((p.id, p) for p in profiles)
+        eq_(6, profiles[1].evaluations)
+        eq_(1, profiles[1].matches)
+        eq_(2, profiles[2].matches)
+        eq_(0, profiles[3].matches)
+        eq_([], profiles[1].hazards)
+        ok_(profiles[2].hazards[0].startswith('version: '))
+        ok_(profiles[3].error)
+        ok_(profiles[1].micros >= 0)
+
+    def test_budget(self):
+        """Rules should stop repeating once their share of the budget is
+        used up"""
+        ticks = iter(range(1000))
+        matchers = [compile_rule_safely(rule_row(ClientMatchRule(id=id)))
+                    for id in (1, 2)]
+        clients = load_clients([PATH])
+        profiles = profile_rules(matchers, clients, repeat=10, budget=5,
+                                 clock=lambda: ticks.next())
+        eq_([3, 3], [p.evaluations for p in profiles])
+        eq_([10], [p.evaluations for p in profile_rules(matchers[:1],
+                                                        clients, repeat=10)])
+
+    def test_budget_hazards(self):
+        """With a budget, rules with hazardous regexes should be reported
+        first without being run"""
+        matchers = [compile_rule_safely(rule_row(rule)) for rule in (
+            ClientMatchRule(id=1, locale='en-US'),
+            ClientMatchRule(id=2, version='/(\d+)+\.0/'))]
+        clients = load_clients([PATH])
+        profiles = profile_rules(matchers, clients, budget=5)
+        eq_([2, 1], [p.id for p in profiles])
+        ok_(not profiles[0].timed)
+        eq_((0, None), (profiles[0].evaluations, profiles[0].matches))
+        ok_(profiles[0].hazards)
+        eq_((1, 1), (profiles[1].evaluations, profiles[1].matches))
+
+    def test_order(self):
+        """Rules should come most costly per evaluation first, however
+        many times each was evaluated"""
+        ticks = iter([0, 5, 12, 12, 20, 30, 30])
+        matchers = [compile_rule_safely(rule_row(ClientMatchRule(id=id)))
+                    for id in (1, 2)]
+        clients = load_clients([PATH])
+        profiles = profile_rules(matchers, clients, repeat=2, budget=20,
+                                 clock=lambda: ticks.next())
+        eq_([(2, 1), (1, 2)], [(p.id, p.evaluations) for p in profiles])
+
+
+class TestRuleProfileView(HomesnippetsTestCase):
+    """Exercise the admin rule profiling page"""
+
+    def test_profile(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.browser.login(username='admin', password='admin')
+        rules = self.setup_rules({
+            'fields': ('locale', 'version'),
+            'items': {
+                'english': ('en-US', None),
+                'slow': (None, '/(\d+)+\.0/'),
+            }
+        })
+
+        response = self.browser.get('/admin/rule_profile?ids=%s' %
+                                    rules['slow'].id)
+        eq_(200, response.status_code)
+
+        response = self.browser.post('/admin/rule_profile', {
+            'clients': PATH, 'repeat': 2, 'ids': str(rules['slow'].id)})
+        eq_(200, response.status_code)
+        ok_('Slow:' in response.content)
+        ok_('version: nested unbounded repeats' in response.content)
+        ok_('Not run' in response.content)
+        ok_('clientmatchrule/%s/' % rules['slow'].id in response.content)
+        ok_('clientmatchrule/%s/' % rules['english'].id
+            not in response.content)
+
+        response = self.browser.post('/admin/rule_profile', {
+            'clients': '%s\n{"request_id": "user-001"}\n{"name"' % PATH,
+            'repeat': 2, 'ids': ''})
+        eq_(200, response.status_code)
+        ok_('No client found on line 2, 3' in response.content)
+        ok_('Slow:' not in response.content)
@@ -0,0 +1,137 @@
+"""
+homesnippets shadow match engine tests
+"""
+import logging
+
+from nose.tools import eq_, ok_
+
+import homesnippets.models
+from homesnippets.matching import ScanEngine
+from homesnippets.models import ClientMatchRule
+from homesnippets.tests.utils import HomesnippetsTestCase
+
+
+class BrokenEngine(object):
+    """Engine that never matches anything"""
+
+    def partition(self, args):
+        return [], []
+
+
+class FailingEngine(object):
+    """Engine that always fails"""
+
+    def partition(self, args):
+        raise IndexError('Out of date')
+
+
+class LogCapture(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestShadowEngine(HomesnippetsTestCase):
+    """Exercise comparing a candidate engine against the reference scan"""
+
+    def setUp(self):
+        HomesnippetsTestCase.setUp(self)
+        self.old_settings = (homesnippets.models.SHADOW_ENGINE,
+                             homesnippets.models.SHADOW_RATE)
+        homesnippets.models.SHADOW_ENGINE = 'indexed'
+        homesnippets.models.SHADOW_RATE = 1.0
+        self.manager = ClientMatchRule.objects
+        self.manager.rule_index = (None, None, None, 0)
+        self.manager.shadow_engines = (None, None, None)
+        self.manager.shadow_stats = dict(compared=0, mismatched=0,
+                                         reference_seconds=0.0,
+                                         candidate_seconds=0.0)
+        self.capture = LogCapture()
+        homesnippets.models.shadow_log.addHandler(self.capture)
+
+        self.setup_rules({
+            'fields': ('name', 'locale', 'exclude'),
+            'items': {
+                'firefox': ('Firefox', None, False),
+                'not_de': (None, '/de/', True),
+            }
+        })
+        self.args = dict(name='Firefox', locale='en-US', version='4.0')
+
+    def tearDown(self):
+        (homesnippets.models.SHADOW_ENGINE,
+         homesnippets.models.SHADOW_RATE) = self.old_settings
+        homesnippets.models.shadow_log.removeHandler(self.capture)
+        del self.manager.shadow_stats
+        self.manager.rule_index = (None, None, None, 0)
+        self.manager.shadow_engines = (None, None, None)
+
+    def test_agreement(self):
+        """Agreeing engines should be timed, but not logged as different"""
+        self.manager.find_match_ids_for_request(self.args)
+        self.manager.find_match_ids_for_requests([
+            dict(self.args, locale='de'), dict(self.args, name='Mudfish')])
+
+        stats = self.manager.shadow_stats
+        eq_(3, stats['compared'])
+        eq_(0, stats['mismatched'])
+        ok_(stats['reference_seconds'] > 0)
+        ok_(isinstance(self.manager.shadow_engines[1], ScanEngine))
+        eq_([], [r for r in self.capture.records
+                 if r.levelno >= logging.WARNING])
+
+    def test_mismatch(self):
+        """Differences from the reference should be logged"""
+        index, engine, seq = self.manager._cached_index()
+        self.manager.shadow_engines = ((index.token, seq),
+                                       ScanEngine(index), BrokenEngine())
+        include_ids, exclude_ids = \
+            self.manager.find_match_ids_for_request(self.args)
+
+        eq_(1, self.manager.shadow_stats['mismatched'])
+        warnings = [r for r in self.capture.records
+                    if r.levelno == logging.WARNING]
+        eq_(1, len(warnings))
+        ok_('include missing %s' % include_ids in warnings[0].getMessage())
+
+    def test_failure(self):
+        """A failing candidate should be logged, without failing the
+        request"""
+        index, engine, seq = self.manager._cached_index()
+        self.manager.shadow_engines = ((index.token, seq),
+                                       ScanEngine(index), FailingEngine())
+        ok_(self.manager.find_match_ids_for_request(self.args)[0])
+        errors = [r for r in self.capture.records
+                  if r.levelno == logging.ERROR]
+        eq_(1, len(errors))
+
+    def test_rule_deltas(self):
+        """Engines should be rebuilt for rule changes applied as deltas"""
+        homesnippets.models.RULE_DELTAS = True
+        homesnippets.models.SHADOW_ENGINE = 'vectorized'
+        try:
+            self.manager.find_match_ids_for_request(self.args)
+            engines = self.manager.shadow_engines
+            self.setup_rules({
+                'fields': ('locale',),
+                'items': {'english': ('en-US',)}
+            })
+            include_ids, exclude_ids = \
+                self.manager.find_match_ids_for_request(self.args)
+            eq_(engines[0][0], self.manager.shadow_engines[0][0])
+            ok_(engines[0] != self.manager.shadow_engines[0])
+            eq_(0, self.manager.shadow_stats['mismatched'])
+            eq_(2, len(include_ids))
+        finally:
+            homesnippets.models.RULE_DELTAS = False
+            self.manager.rule_log = (0, ())
+
+    def test_sampling(self):
+        """Nothing should be compared at a rate of 0"""
+        homesnippets.models.SHADOW_RATE = 0
+        self.manager.find_match_ids_for_request(self.args)
+        eq_(0, self.manager.shadow_stats['compared'])
@@ -0,0 +1,126 @@
+"""
+homesnippets vectorized rule matching tests
+"""
+import random
+
+from django.test import TestCase
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+import homesnippets.models
+from homesnippets import vectorized
+from homesnippets.matching import (MATCH_FIELDS, RuleIndex,
+                                   compile_rule_safely, rule_row)
+from homesnippets.models import ClientMatchRule
+from homesnippets.tests.utils import HomesnippetsTestCase
+
+
+VALUES = {
+    'startpage_version': ('1', '2', '>=2'),
+    'name': ('Firefox', 'Mudfish', '/(Firefox|Airdog)/'),
+    'version': ('4.0', '3.6', '/4\.\d/', '/[0-9]+\.0$/', '>=4.0,<10',
+                '<4.0b1', '=3.6'),
+    'locale': ('en-US', 'de', 'fr', '/en-/', '/(de|fr)$/', 'en-*', 'pt-*'),
+    'channel': ('release', 'beta', '/(beta|aurora)/'),
+    'distribution': ('default', 'acme'),
+    'appbuildid': ('20110318052756', '>=20110301,<20110401', '<20110318'),
+}
+
+
+def random_rules(count, seed):
+    rand = random.Random(seed)
+    rules = []
+    for idx in range(count):
+        values = {}
+        for field, choices in VALUES.items():
+            if rand.random() < 0.3:
+                values[field] = rand.choice(choices)
+        if rand.random() < 0.05:
+            values['version'] = '/4.(/'
+        rules.append(ClientMatchRule(id=idx + 1, exclude=rand.random() < 0.2,
+                                     **values))
+    return rules
+
+
+def random_clients(count, seed):
+    rand = random.Random(seed)
+    clients = []
+    for idx in range(count):
+        args = {}
+        for field in MATCH_FIELDS:
+            choices = [v for v in VALUES.get(field, ('xxx',))
+                       if v[0] not in '/<>='] + ['4.2', 'aurora', 'en-GB', 'en',
+                                          'pt-BR']
+            if rand.random() < 0.95:
+                args[field] = rand.choice(choices)
+        clients.append(args)
+    return clients
+
+
+class TestVectorizedRuleSet(TestCase):
+    """Exercise the numpy columnar match engine"""
+
+    def setUp(self):
+        if vectorized.numpy is None:
+            raise SkipTest('numpy not installed')
+        matchers = [compile_rule_safely(rule_row(rule))
+                    for rule in random_rules(300, 1)]
+        self.index = RuleIndex(matchers)
+        self.engine = vectorized.VectorizedRuleSet(self.index, chunk_size=64)
+
+    def test_same_as_index(self):
+        """Vectorized matching should agree with the rule index"""
+        for args in random_clients(50, 2):
+            eq_(self.index.partition(args), self.engine.partition(args))
+
+    def test_batch(self):
+        """Batches should give the same results as single clients"""
+        clients = random_clients(200, 3) + [{}]
+        eq_([self.index.partition(args) for args in clients],
+            self.engine.partition_many(clients))
+
+
+class TestVectorizedEngineSetting(HomesnippetsTestCase):
+    """Exercise serving snippets with the vectorized engine selected"""
+
+    def setUp(self):
+        if vectorized.numpy is None:
+            raise SkipTest('numpy not installed')
+        HomesnippetsTestCase.setUp(self)
+        self.old_engine = homesnippets.models.MATCH_ENGINE
+        homesnippets.models.MATCH_ENGINE = 'vectorized'
+        ClientMatchRule.objects.rule_index = (None, None, None, 0)
+
+    def tearDown(self):
+        homesnippets.models.MATCH_ENGINE = self.old_engine
+        ClientMatchRule.objects.rule_index = (None, None, None, 0)
+
+    def test_snippets(self):
+        rules = self.setup_rules({
+            'fields': ('name', 'locale', 'exclude'),
+            'items': {
+                'firefox': ('Firefox', None, False),
+                'not_de': (None, '/de/', True),
+            }
+        })
+        snippets = self.setup_snippets(rules, {
+            'fields': ('name', 'body', 'rules'),
+            'items': {
+                'fire': ('Fire', 'Firefox but not de',
+                         (rules['firefox'], rules['not_de'])),
+            }
+        })
+        self.assert_snippets({
+            '/1/Firefox/4.0/xxx/xxx/en-US/xxx/xxx/default/default/': (
+                (snippets['fire'], True),
+            ),
+            '/1/Firefox/4.0/xxx/xxx/de/xxx/xxx/default/default/': (
+                (snippets['fire'], False),
+            ),
+            '/1/Mudfish/4.0/xxx/xxx/en-US/xxx/xxx/default/default/': (
+                (snippets['fire'], False),
+            ),
+        })
+        engine = ClientMatchRule.objects.rule_index[2]
+        eq_(vectorized.VectorizedRuleSet, type(engine))
@@ -20,6 +20,7 @@ class HomesnippetsTestCase(TestCase):
         settings.DEBUG = True
 
         ClientMatchRule.objects.all().delete()
+        ClientMatchRule.objects.rule_index = (None, None, None, 0)
         Snippet.objects.all().delete()
 
         homesnippets.models.cache.clear()
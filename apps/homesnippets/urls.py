@@ -19,6 +19,9 @@ urlpatterns = patterns("homesnippets.views",
     url(r'^base64encode$', 'base64_encode', name='base64_encode'),
     url(r'^admin/bulk_date_change$', 'admin_bulk_date_change',
         name='admin_bulk_date_change'),
+    url(r'^admin/rule_profile$', 'admin_rule_profile',
+        name='admin_rule_profile'),
+    url(r'^admin/cache$', 'admin_cache', name='admin_cache'),
     url(r'^show_all_snippets$', 'show_all_snippets', name='show_all_snippets'),
     url(r'^$', 'index', name='index'),
 )
@@ -0,0 +1,116 @@
+"""
+Vectorized client match rule evaluation
+
+An optional alternative to evaluating a RuleIndex one client at a time: the
+rule set is kept as numpy columns, one per match field, and clients are
+matched with a handful of array operations. Batches of clients are matched
+together, which suits cache warming and log replay. Requires numpy.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from homesnippets.matching import MATCH_FIELDS, ExactCondition, bit_positions
+
+
+class VectorizedRuleSet(object):
+    """Columnar form of the rules in a RuleIndex.
+
+    For each field, exact rule values are interned to small integers and
+    stored in a column with one entry per rule (0 for rules without an exact
+    value on that field), alongside a mask of the rules with no condition on
+    the field. Other conditions, like regexes and ranges, are looked up
+    through the index's per-field structures. Produces the same include and
+    exclude rule lists as RuleIndex.partition().
+    """
+
+    def __init__(self, index, chunk_size=256):
+        if numpy is None:
+            raise ImportError('numpy is required for vectorized matching')
+
+        self.index = index
+        self.token = index.token
+        self.chunk_size = chunk_size
+
+        matchers = index.matchers
+        size = len(matchers)
+        # Rules removed from the index leave a None in its matchers.
+        self.present = numpy.array([m is not None for m in matchers],
+                                   dtype=bool)
+        self.ids = numpy.array([m is not None and str(m.id) or ''
+                                for m in matchers], dtype=object)
+        self.exclude = numpy.array([m is not None and bool(m.exclude)
+                                    for m in matchers], dtype=bool)
+        self.valid = numpy.array([m is not None and m.error is None
+                                  for m in matchers], dtype=bool)
+
+        self.vocab = dict((field, {}) for field in MATCH_FIELDS)
+        self.columns = dict((field, numpy.zeros(size, dtype=numpy.int32))
+                            for field in MATCH_FIELDS)
+        self.wildcard = dict((field, self.valid.copy())
+                             for field in MATCH_FIELDS)
+
+        for pos, matcher in enumerate(matchers):
+            if matcher is None or matcher.error is not None:
+                continue
+            for condition in matcher.conditions:
+                self.wildcard[condition.field][pos] = False
+                if isinstance(condition, ExactCondition):
+                    vocab = self.vocab[condition.field]
+                    value_id = vocab.setdefault(condition.value,
+                                                len(vocab) + 1)
+                    self.columns[condition.field][pos] = value_id
+
+        self.fields = [field for field in MATCH_FIELDS
+                       if field in index.referenced_fields]
+
+    def field_mask(self, field, args_list):
+        """Boolean array with a row per client and a column per rule, set
+        where the client's value for field satisfies the rule."""
+        vocab = self.vocab[field]
+        values = [args.get(field) for args in args_list]
+        value_ids = numpy.array([vocab.get(value, -1) for value in values],
+                                dtype=numpy.int32)
+
+        mask = self.columns[field][numpy.newaxis, :] == \
+            value_ids[:, numpy.newaxis]
+        mask |= self.wildcard[field]
+
+        patterns = self.index.has_patterns(field)
+        for row, args in enumerate(args_list):
+            if field not in args:
+                # Conditions on missing fields are skipped.
+                mask[row, :] = True
+            elif patterns:
+                bits = self.index.pattern_matches(field, values[row])
+                if bits:
+                    mask[row, bit_positions(bits)] = True
+
+        return mask
+
+    def match_many(self, args_list):
+        """Boolean array with a row per client and a column per rule, set
+        where the rule matches the client."""
+        matched = numpy.empty((len(args_list), len(self.valid)), dtype=bool)
+        matched[:] = self.valid
+        for field in self.fields:
+            matched &= self.field_mask(field, args_list)
+        return matched
+
+    def partition_many(self, args_list):
+        """Include and exclude rule ID lists for each of a list of clients."""
+        results = []
+        for start in range(0, len(args_list), self.chunk_size):
+            matched = self.match_many(args_list[start:start + self.chunk_size])
+            include = matched & ~self.exclude
+            # Matching exclude rules, and include rules that don't match.
+            exclude = (matched == self.exclude) & self.present
+            for row in range(len(matched)):
+                results.append((list(self.ids[include[row]]),
+                                list(self.ids[exclude[row]])))
+        return results
+
+    def partition(self, args):
+        """Include and exclude rule ID lists for a single client."""
+        return self.partition_many([args])[0]
@@ -3,23 +3,45 @@ Views for home snippets server
 """
 import base64
 import json
-from time import gmtime, strftime
+from datetime import datetime
+from time import strftime
+from urllib import urlencode
 from urllib2 import urlopen, URLError
 
 from django.conf import settings
+from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
+from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.views.decorators.cache import cache_control
 
-from homesnippets.forms import BulkDateForm
-from homesnippets.models import Snippet
+from homesnippets.forms import (BulkDateForm, CacheClientForm,
+                                CacheFamilyForm, RuleProfileForm)
+from homesnippets.matching import compile_rule_safely, rule_row
+from homesnippets.models import (CACHE_FAMILIES, ClientMatchRule, Snippet,
+                                 cache_compression_stats, cache_stamps,
+                                 cache_totals,
+                                 client_cache_entries, flush_cache_family,
+                                 flush_client_cache, local_cache_stats,
+                                 reset_cache_totals)
+from homesnippets.profiling import profile_rules
 
 
 HTTP_MAX_AGE = getattr(settings, 'SNIPPET_HTTP_MAX_AGE', 1)
 DEBUG = getattr(settings, 'DEBUG', False)
 
+# File of sample client requests to start the rule profiler off with.
+PROFILE_SAMPLE = getattr(settings, 'SNIPPET_PROFILE_SAMPLE', None)
+
+# Most client requests the rule profiler will time rules against.
+PROFILE_MAX_CLIENTS = 200
+
+# Seconds the rule profiler may spend repeating evaluations, shared between
+# the rules profiled, so that profiling many rules can't tie up a worker.
+PROFILE_TIME_BUDGET = getattr(settings, 'SNIPPET_PROFILE_TIME_BUDGET', 5)
+
 
 @cache_control(public=True, max_age=HTTP_MAX_AGE)
 def index(request):
@@ -46,7 +68,19 @@ def view_snippets(request, **kwargs):
     """Fetch and render snippets matching URL segment args."""
 
     preview = kwargs['preview']
-    snippets = Snippet.objects.find_snippets_with_match_rules(kwargs)
+    out_txt, headers = Snippet.objects.find_rendered_snippets(
+        kwargs, lambda snippets, generated: render_snippets(snippets, preview,
+                                                            generated))
+
+    resp = HttpResponse(out_txt)
+    for name, value in headers:
+        resp[name] = value
+    return resp
+
+
+def render_snippets(snippets, preview, generated):
+    """Render the body and headers of a snippets response, for snippets found
+    at the time generated."""
 
     if len(snippets) == 0:
         out_txt = ''
@@ -62,28 +96,27 @@ def view_snippets(request, **kwargs):
             out.append('<div %s>%s</div>' % (attrs_string, snippet['body']))
 
         out.append('<!-- content generated at %s -->' %
-            (strftime('%Y-%m-%dT%H:%M:%SZ', gmtime())))
+            (strftime('%Y-%m-%dT%H:%M:%SZ', generated)))
 
         out_txt = '<div class="snippet_set">%s</div>' % "\n\n".join(out)
 
-    resp = HttpResponse(out_txt)
-
+    headers = []
     if preview:
         # Try to force preview request to be fresh.
         max_age = 0
-        resp['Cache-Control'] = 'public, must-revalidate, max-age=0'
+        headers.append(('Cache-Control', 'public, must-revalidate, max-age=0'))
     else:
         max_age = HTTP_MAX_AGE
-        resp['Cache-Control'] = 'public, max-age=%s' % (HTTP_MAX_AGE)
+        headers.append(('Cache-Control', 'public, max-age=%s' % (HTTP_MAX_AGE)))
 
     # TODO: bug 606555 - Get ACAO working with about:home?
-    resp['Access-Control-Allow-Origin'] = '*'
-    resp['Access-Control-Max-Age'] = max_age
-    resp['Access-Control-Allow-Methods'] = 'GET, HEAD, OPTIONS'
+    headers.append(('Access-Control-Allow-Origin', '*'))
+    headers.append(('Access-Control-Max-Age', max_age))
+    headers.append(('Access-Control-Allow-Methods', 'GET, HEAD, OPTIONS'))
 
-    resp['X-FRAME-OPTIONS'] = None
+    headers.append(('X-FRAME-OPTIONS', None))
 
-    return resp
+    return out_txt, headers
 
 
 @staff_member_required
@@ -124,6 +157,120 @@ def admin_bulk_date_change(request, **kwargs):
                               context_instance=RequestContext(request))
 
 
+@staff_member_required
+def admin_rule_profile(request, **kwargs):
+    """Time client match rules against sample client requests."""
+
+    profiles, rules = None, {}
+    if request.method == 'POST':
+        form = RuleProfileForm(request.POST)
+        if form.is_valid():
+            queryset = ClientMatchRule.objects.all()
+            if form.cleaned_data['ids']:
+                queryset = queryset.filter(
+                    id__in=form.cleaned_data['ids'].split(','))
+            rules = dict((rule.id, rule) for rule in queryset)
+            clients = form.cleaned_data['clients'][:PROFILE_MAX_CLIENTS]
+            profiles = profile_rules([compile_rule_safely(rule_row(rule))
+                                      for rule in rules.values()],
+                                     clients, form.cleaned_data['repeat'],
+                                     PROFILE_TIME_BUDGET)
+    else:
+        initial = dict(request.GET.items())
+        if PROFILE_SAMPLE:
+            initial['clients'] = open(PROFILE_SAMPLE, 'r').read()
+        form = RuleProfileForm(initial=initial)
+
+    rows = [(profile, rules[profile.id]) for profile in profiles or ()]
+    return render_to_response('adminRuleProfile.html',
+                              {'form': form, 'rows': rows,
+                               'profiled': profiles is not None},
+                              context_instance=RequestContext(request))
+
+
+def _stamp_time(stamp):
+    """Cache timestamps, made with mktime(gmtime()), as UTC datetimes."""
+    return stamp and datetime.fromtimestamp(stamp)
+
+
+@staff_member_required
+def admin_cache(request, **kwargs):
+    """Show cache statistics and the entries cached for a client, and flush
+    cached entries by family or by client."""
+
+    if request.method == 'POST':
+        action = request.POST.get('action')
+        if action == 'flush_family':
+            form = CacheFamilyForm(request.POST)
+            if form.is_valid():
+                family = form.cleaned_data['family']
+                if flush_cache_family(family):
+                    messages.info(request, 'Flushed %s entries' % family)
+                else:
+                    messages.error(request, 'Flushing %s entries needs '
+                                   'SNIPPET_CACHE_STATS' % family)
+        elif action == 'flush_client':
+            form = CacheClientForm(request.POST)
+            if form.is_valid():
+                keys = flush_client_cache(form.cleaned_data['client'])
+                messages.info(request, 'Flushed %d entries for client' %
+                              len(keys))
+        elif action == 'reset':
+            reset_cache_totals()
+            messages.info(request, 'Cache statistics reset')
+        url = reverse('admin_cache')
+        if request.POST.get('client'):
+            url = '%s?%s' % (url,
+                             urlencode({'client': request.POST['client']}))
+        return HttpResponseRedirect(url)
+
+    entries = None
+    if 'client' in request.GET:
+        client_form = CacheClientForm(request.GET)
+        if client_form.is_valid():
+            entries = client_cache_entries(client_form.cleaned_data['client'])
+            for entry in entries:
+                entry['cached_at'] = _stamp_time(entry['cached_at'])
+    else:
+        client_form = CacheClientForm()
+
+    families, since = [], None
+    totals = cache_totals()
+    if totals is not None:
+        totals, since = totals
+        for family, prefix in CACHE_FAMILIES:
+            counts = totals[family]
+            lookups = counts['hits'] + counts['misses'] + \
+                      counts['invalidations']
+            # Sizes are only measured for a sample of the values written.
+            average_size = counts['sized'] and \
+                           counts['bytes'] / counts['sized']
+            families.append(dict(counts, name=family, prefix=prefix,
+                hit_rate=lookups and 100.0 * counts['hits'] / lookups,
+                average_size=average_size,
+                bytes=average_size * counts['sets']))
+    else:
+        families = [ dict(name=family, prefix=prefix)
+                     for family, prefix in CACHE_FAMILIES ]
+
+    # Lastmods and flush times are timestamps, the others counters.
+    stamps = [ (key, value, isinstance(value, float) and _stamp_time(value)
+                or None)
+               for key, value in cache_stamps() ]
+
+    return render_to_response('adminCache.html',
+                              {'families': families,
+                               'counting': totals is not None,
+                               'since': since and
+                                        datetime.utcfromtimestamp(since),
+                               'stamps': stamps,
+                               'compression': cache_compression_stats(),
+                               'local': local_cache_stats(),
+                               'client_form': client_form,
+                               'entries': entries},
+                              context_instance=RequestContext(request))
+
+
 @cache_control(public=True, max_age=3600)
 def show_all_snippets(request):
     """